@@ -22,7 +22,8 @@ module load conda/analysis3
 
 OM2run="OM2run_placeholder"
 echo $OM2run
+basin_masks_file="" # optional NetCDF of basin masks (atlantic, indopacific, southern) to also write *_basins.nc
 
 echo "Running transport-state script"
-python3 scripts/MOC_ACCESS-OM2-01.py $OM2run \
+python3 scripts/MOC_ACCESS-OM2-01.py $OM2run $basin_masks_file \
 &> output/MOC_ACCESS-OM2-01.$OM2run.$PBS_JOBID.out
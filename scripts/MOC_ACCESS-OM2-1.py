@@ -5,6 +5,8 @@ import sys
 # interactive use only
 model = "ACCESS-OM2-1"
 subcatalog = sys.argv[1]
+# optional NetCDF file of basin masks (one 0/1 variable per basin, see tmip.overturning.basin_masks)
+basin_masks_file = sys.argv[2] if len(sys.argv) > 2 else None
 
 # 1. Load packages
 
@@ -16,9 +18,6 @@ PROJECT = environ["PROJECT"]
 # Import makedirs to create directories where I write new files
 from os import makedirs
 
-# Load dask
-from dask.distributed import Client
-
 # Load intake and cosima cookbook
 import intake
 
@@ -34,38 +33,16 @@ import traceback
 # Load pandas for data manipulation
 import pandas as pd
 
-# Import numpy
-import numpy as np
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalog import select_data
+from tmip.overturning import basin_masks, masked_lonsum, overturning_streamfunction
+from tmip.averaging import write_outputs
+from tmip.cluster import make_client
 
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def select_data(cat, xarray_open_kwargs, **kwargs):
-    selectedcat = cat.search(**kwargs)
-    print("\nselectedcat: ", selectedcat)
-    xarray_combine_by_coords_kwargs=dict(
-        compat="override",
-        data_vars="minimal",
-        coords="minimal"
-    )
-    datadask = selectedcat.to_dask(
-        xarray_open_kwargs=xarray_open_kwargs,
-        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
-        parallel=True,
-    )
-    return datadask
-
-def yearlymeans(ds):
-    # Make a DataArray with the number of days in each month, size = len(time)
-    month_length = ds.time.dt.days_in_month
-    # Calculate the weights by grouping by 'time.year'
-    weights = month_length.groupby("time.year") / month_length.groupby("time.year").sum()
-    # Test that the sum of the weights for each year is 1.0
-    np.testing.assert_allclose(weights.groupby("time.year").sum().values, 1.0)
-    # Calculate the weighted average
-    return (ds * weights).groupby("time.year").sum(dim="time")
-
 # 3. Load catalog
 
 catalogs = intake.cat.access_nri
@@ -83,20 +60,22 @@ datadir = f'/scratch/{PROJECT}/TMIP/data'
 
 
 
-
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=48, threads_per_worker=1) #, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
 
     # directory to save the data to (as NetCDF)
     outputdir = f'{datadir}/{model}/{subcatalog}'
     print("Creating directory: ", outputdir)
     makedirs(outputdir, exist_ok=True)
 
+    # Lazy outputs, written together at the end
+    outputs = {}
+    masks = None
+    # Lazy inputs, to size the cluster from their chunks
+    inputs = []
+
     # ty_trans_rho
     try:
         print("Loading ty_trans_rho data")
@@ -108,18 +87,21 @@ if __name__ == '__main__':
             frequency = "1mon",
         )
         print("\nty_trans_rho_datadask: ", ty_trans_rho_datadask)
-        print("Sum longitudinally and cumsum vertically")
-        psi = ty_trans_rho_datadask.sum("grid_xt_ocean")
-        psi = psi.cumulative('potrho').sum() - psi.sum('potrho')
+        inputs.append(ty_trans_rho_datadask.ty_trans_rho)
+        if basin_masks_file is not None:
+            print("Loading basin masks from: ", basin_masks_file)
+            masks = basin_masks(basin_masks_file, ty_trans_rho_datadask.ty_trans_rho)
+            print("\nmasks: ", masks)
+        print("Sum longitudinally (within each basin) and cumsum vertically")
+        psi = overturning_streamfunction(ty_trans_rho_datadask.ty_trans_rho, masks).to_dataset(name='ty_trans_rho')
         print("\npsi: ", psi)
-        print("Saving psi to: ", f'{outputdir}/psi.nc')
-        psi.to_netcdf(f'{outputdir}/psi.nc', compute=True)
+        outputs["psi"] = psi
     except Exception:
         print(f'Error processing {model} ty_trans_rho')
         print(traceback.format_exc())
 
 
-    # ty_trans_rho_gm_gm
+    # ty_trans_rho_gm
     try:
         print("Loading ty_trans_rho_gm data")
         ty_trans_rho_gm_datadask = select_data(searched_cat,
@@ -130,11 +112,11 @@ if __name__ == '__main__':
             frequency = "1mon",
         )
         print("\nty_trans_rho_gm_datadask: ", ty_trans_rho_gm_datadask)
-        print("Sum longitudinally")
-        psi_gm = ty_trans_rho_gm_datadask.sum("grid_xt_ocean")
+        inputs.append(ty_trans_rho_gm_datadask.ty_trans_rho_gm)
+        print("Sum longitudinally (within each basin)")
+        psi_gm = masked_lonsum(ty_trans_rho_gm_datadask.ty_trans_rho_gm, masks).to_dataset(name='ty_trans_rho_gm')
         print("\npsi_gm: ", psi_gm)
-        print("Saving psi_gm to: ", f'{outputdir}/psi_gm.nc')
-        psi_gm.to_netcdf(f'{outputdir}/psi_gm.nc', compute=True)
+        outputs["psi_gm"] = psi_gm
     except Exception:
         print(f'Error processing {model} ty_trans_rho_gm')
         print(traceback.format_exc())
@@ -143,13 +125,27 @@ if __name__ == '__main__':
         print("Calculating total overturning streamfunction")
         psi_tot = (psi.ty_trans_rho + psi_gm.ty_trans_rho_gm).to_dataset(name='psi_tot')
         print("\npsi_tot: ", psi_tot)
-        psi_tot.to_netcdf(f'{outputdir}/psi_tot.nc', compute=True)
+        outputs["psi_tot"] = psi_tot
     except Exception:
         print(f'Error processing {model} psi_tot')
         print(traceback.format_exc())
 
-    client.close()
+    if masks is not None:
+        # Global streamfunctions as before, and all basins in `{name}_basins.nc`
+        outputs = {
+            **{name: ds.sel(basin="global", drop=True) for name, ds in outputs.items()},
+            **{f'{name}_basins': ds for name, ds in outputs.items()},
+        }
+
+    # Start the cluster, sized so that the chunks of ty_trans_rho and ty_trans_rho_gm fit in memory
+    # (the data are only opened lazily above, nothing is computed before this)
+    print("Starting client")
+    client = make_client(*inputs, max_workers=48)
 
+    # Write everything together so that ty_trans_rho and ty_trans_rho_gm are only read once
+    write_outputs(outputs, outputdir, label=model, profile="derived")
+
+    client.close()
 
 
 
@@ -16,9 +16,6 @@ PROJECT = environ["PROJECT"]
 # Import makedirs to create directories where I write new files
 from os import makedirs
 
-# Load dask
-from dask.distributed import Client
-
 # Load intake and cosima cookbook
 import intake
 
@@ -34,38 +31,16 @@ import traceback
 # Load pandas for data manipulation
 import pandas as pd
 
-# Import numpy
-import numpy as np
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalog import select_data
+from tmip.climatology import yearlymeans
+from tmip.output import save_output
+from tmip.cluster import make_client
 
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def select_data(cat, xarray_open_kwargs, **kwargs):
-    selectedcat = cat.search(**kwargs)
-    print("\nselectedcat: ", selectedcat)
-    xarray_combine_by_coords_kwargs=dict(
-        compat="override",
-        data_vars="minimal",
-        coords="minimal"
-    )
-    datadask = selectedcat.to_dask(
-        xarray_open_kwargs=xarray_open_kwargs,
-        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
-        parallel=True,
-    )
-    return datadask
-
-def yearlymeans(ds):
-    # Make a DataArray with the number of days in each month, size = len(time)
-    month_length = ds.time.dt.days_in_month
-    # Calculate the weights by grouping by 'time.year'
-    weights = month_length.groupby("time.year") / month_length.groupby("time.year").sum()
-    # Test that the sum of the weights for each year is 1.0
-    np.testing.assert_allclose(weights.groupby("time.year").sum().values, 1.0)
-    # Calculate the weighted average
-    return (ds * weights).groupby("time.year").sum(dim="time")
-
 # 3. Load catalog
 
 catalogs = intake.cat.access_nri
@@ -84,21 +59,18 @@ datadir = f'/scratch/{PROJECT}/TMIP/data'
 
 
 
-
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=48, threads_per_worker=1) #, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
-
 
     # directory to save the data to (as NetCDF)
     outputdir = f'{datadir}/{model}/{subcatalog}'
     print("Creating directory: ", outputdir)
     makedirs(outputdir, exist_ok=True)
 
+    # Lazy inputs, to size the cluster from their chunks
+    inputs = []
 
     # ty_trans_rho
     try:
@@ -111,18 +83,12 @@ if __name__ == '__main__':
             frequency = "1mon",
         )
         print("\nty_trans_rho_datadask: ", ty_trans_rho_datadask)
-        print("Sum longitudinally and cumsum vertically")
-        psi = ty_trans_rho_datadask.sum("grid_xt_ocean")
-        psi = psi.cumulative('potrho').sum() - psi.sum('potrho')
-        print("\npsi: ", psi)
-        print("Saving psi to: ", f'{outputdir}/psi.nc')
-        psi.to_netcdf(f'{outputdir}/psi.nc', compute=True)
+        inputs.append(ty_trans_rho_datadask.ty_trans_rho)
     except Exception:
-        print(f'Error processing {model} ty_trans_rho')
+        print(f'Error loading {model} ty_trans_rho')
         print(traceback.format_exc())
 
-
-    # ty_trans_rho_gm_gm
+    # ty_trans_rho_gm
     try:
         print("Loading ty_trans_rho_gm data")
         ty_trans_rho_gm_datadask = select_data(searched_cat,
@@ -133,11 +99,36 @@ if __name__ == '__main__':
             frequency = "1mon",
         )
         print("\nty_trans_rho_gm_datadask: ", ty_trans_rho_gm_datadask)
+        inputs.append(ty_trans_rho_gm_datadask.ty_trans_rho_gm)
+    except Exception:
+        print(f'Error loading {model} ty_trans_rho_gm')
+        print(traceback.format_exc())
+
+    # Start the cluster, sized so that the chunks of ty_trans_rho and ty_trans_rho_gm fit in memory
+    # (the data are only opened lazily above, nothing is computed before this)
+    print("Starting client")
+    client = make_client(*inputs, max_workers=48)
+
+    # ty_trans_rho
+    try:
+        print("Sum longitudinally and cumsum vertically")
+        psi = ty_trans_rho_datadask.sum("grid_xt_ocean")
+        psi = psi.cumulative('potrho').sum() - psi.sum('potrho')
+        print("\npsi: ", psi)
+        print("Saving psi to: ", f'{outputdir}/psi.nc')
+        save_output(psi, f'{outputdir}/psi.nc', "derived", compute=True)
+    except Exception:
+        print(f'Error processing {model} ty_trans_rho')
+        print(traceback.format_exc())
+
+
+    # ty_trans_rho_gm_gm
+    try:
         print("Sum longitudinally")
         psi_gm = ty_trans_rho_gm_datadask.sum("grid_xt_ocean")
         print("\npsi_gm: ", psi_gm)
         print("Saving psi_gm to: ", f'{outputdir}/psi_gm.nc')
-        psi_gm.to_netcdf(f'{outputdir}/psi_gm.nc', compute=True)
+        save_output(psi_gm, f'{outputdir}/psi_gm.nc', "derived", compute=True)
     except Exception:
         print(f'Error processing {model} ty_trans_rho_gm')
         print(traceback.format_exc())
@@ -146,7 +137,7 @@ if __name__ == '__main__':
         print("Calculating total overturning streamfunction")
         psi_tot = (psi.ty_trans_rho + psi_gm.ty_trans_rho_gm).to_dataset(name='psi_tot')
         print("\npsi_tot: ", psi_tot)
-        psi_tot.to_netcdf(f'{outputdir}/psi_tot.nc', compute=True)
+        save_output(psi_tot, f'{outputdir}/psi_tot.nc', "derived", compute=True)
     except Exception:
         print(f'Error processing {model} psi_tot')
         print(traceback.format_exc())
@@ -155,7 +146,7 @@ if __name__ == '__main__':
         print("Yearly means")
         psi_tot_year = yearlymeans(psi_tot)
         print("\npsi_tot_year: ", psi_tot_year)
-        psi_tot_year.to_netcdf(f'{outputdir}/psi_tot_year.nc', compute=True)
+        save_output(psi_tot_year, f'{outputdir}/psi_tot_year.nc', "derived", compute=True)
     except Exception:
         print(f'Error processing {model} psi_tot_year')
         print(traceback.format_exc())
@@ -164,7 +155,7 @@ if __name__ == '__main__':
         print("Averaging total overturning streamfunction")
         psi_tot_avg = psi_tot.weighted(psi_tot.time.dt.days_in_month).mean(dim="time")
         print("\npsi_tot_avg: ", psi_tot_avg)
-        psi_tot_avg.to_netcdf(f'{outputdir}/psi_tot_avg.nc', compute=True)
+        save_output(psi_tot_avg, f'{outputdir}/psi_tot_avg.nc', "derived", compute=True)
     except Exception:
         print(f'Error processing {model} psi_tot_avg')
         print(traceback.format_exc())
@@ -189,7 +180,7 @@ if __name__ == '__main__':
         print("\npsi_tot_rolling_weighted: ", psi_tot_rolling_weighted)
         psi_tot_rollingyear = psi_tot_rolling_weighted.mean("window", skipna=False)
         print("\npsi_tot_rollingyear: ", psi_tot_rollingyear)
-        psi_tot_rollingyear.to_netcdf(f'{outputdir}/psi_tot_rollingyear.nc', compute=True)
+        save_output(psi_tot_rollingyear, f'{outputdir}/psi_tot_rollingyear.nc', "derived", compute=True)
     except Exception:
         print(f'Error processing {model} psi_tot_rollingyear')
         print(traceback.format_exc())
@@ -207,7 +198,7 @@ if __name__ == '__main__':
         print("\npsi_tot_rolling_weighted: ", psi_tot_rolling_weighted)
         psi_tot_rollingdecade = psi_tot_rolling_weighted.mean("window", skipna=False)
         print("\npsi_tot_rollingdecade: ", psi_tot_rollingdecade)
-        psi_tot_rollingdecade.to_netcdf(f'{outputdir}/psi_tot_rollingdecade.nc', compute=True)
+        save_output(psi_tot_rollingdecade, f'{outputdir}/psi_tot_rollingdecade.nc', "derived", compute=True)
     except Exception:
         print(f'Error processing {model} psi_tot_rollingdecade')
         print(traceback.format_exc())
@@ -217,4 +208,3 @@ if __name__ == '__main__':
 
 
 
-
@@ -1,3 +1,8 @@
+# Submit all the runs listed in scripts/sweeps/MOC_ACCESS-OM2.toml
+# (small runs are packed into shared jobs sized from their inputs, see scripts/sweep.py)
+# Use `dryrun` as an argument (forwarded to scripts/sweep.py) to only print the job scripts.
+python3 scripts/sweep.py scripts/sweeps/MOC_ACCESS-OM2.toml "$@"
+
 # for OM2run in 1deg_jra55_iaf_omip2_cycle{3..3}; do
 #     # change placeholders in script, submit, and clean up
 #     sed "s/OM2run_placeholder/$OM2run/g" scripts/MOC_ACCESS-OM2-1.sh > tmp.sh
@@ -29,6 +34,6 @@
 #     rm tmp.sh
 # done
 
-sed "s/OM2run_placeholder/01deg_jra55v150_iaf_cycle1/g" scripts/MOC_ACCESS-OM2-01.sh > tmp.sh
-qsub tmp.sh
-rm tmp.sh
\ No newline at end of file
+# sed "s/OM2run_placeholder/01deg_jra55v150_iaf_cycle1/g" scripts/MOC_ACCESS-OM2-01.sh > tmp.sh
+# qsub tmp.sh
+# rm tmp.sh
\ No newline at end of file
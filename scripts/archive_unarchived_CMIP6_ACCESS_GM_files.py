@@ -30,57 +30,54 @@ print("decade_end: ", decade_end, " (type: ", type(decade_end), ")")
 import os
 os.environ["PYTHONWARNINGS"] = "ignore"
 
-# Load dask
-from dask.distributed import Client
-
 # import glob for searching directories
 from glob import glob
 
-# Load xarray for N-dimensional arrays
-import xarray as xr
-
 # Load traceback to print exceptions
 import traceback
 
 # # Load xmip for preprocessing (trying to get consistent metadata for making matrices down the road)
 # from xmip.preprocessing import combined_preprocessing
 
+# Load shared TMIP helpers (see scripts/tmip)
+# (archived files get a sidecar `.chunks.json` manifest of chunk digests,
+#  used by check_archive_unarchived_CMIP6_ACCESS_GM_files.py)
+from tmip.io import open_my_dataset
+from tmip.references import open_history
+from tmip.checksums import write_with_manifest
+from tmip.cluster import make_client
+from tmip.layout import SCRATCH_DATADIR, GDATA_DATADIR, OutputKey, output_dir, output_path, decade_years
+
+# Variables to keep from the raw ocean_month.nc files
+# (everything else is dropped before decoding, except coordinate dependencies)
+keep_variables = ['tx_trans_gm', 'ty_trans_gm', 'tx_trans_submeso', 'ty_trans_submeso']
+
 decades = range(decade_start, decade_end, 10)
 print(f"\nDecades:\n")
 print(*decades)
 
-# Historical runs go from 1850 to 2015, and future scenarios from 2015 to 2100.
-# I want to save data per decade, so I need some logic branching to deal with the 2010s.
-def decade_years(decade, experiment):
-    if decade == 2010:
-        if (experiment == "historical"):
-            return range(2010, 2015)
-        else:
-            return range(2015, 2020)
-    else:
-        return range(decade, decade + 10)
+# Historical runs go from 1850 to 2015, and future scenarios from 2015 to 2100,
+# so data is saved per decade with the 2010s special case (see tmip.layout.decade_years).
+def archivepathfun(member, variable, decade):
+    return output_path(OutputKey("archive", model, experiment, member, variable=variable, decade=decade), gdatadatadir)
 
 
 
 
 # Create directory on scratch to save the data
-scratchdatadir = '/scratch/xv83/TMIP/data'
-gdatadatadir = '/g/data/xv83/TMIP/data'
+scratchdatadir = SCRATCH_DATADIR
+gdatadatadir = GDATA_DATADIR
 
 # members = ["HI-05", "HI-06", "HI-07", "HI-08"]
 # members = ["HI-09", "HI-10", "HI-11", "HI-12"]
 # members = ["HI-05"]
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=40, threads_per_worker=1)
-    #, threads_per_worker=1, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
-    # added threads_per_worker=1 back again because I possibly hitting some random unsafe multithreading issue:
-    # https://forum.access-hive.org.au/t/netcdf-not-a-valid-id-errors/389
-
-
+    # Open the whole history of each member once through its (cached) reference index
+    # (falls back to opening the files of each decade if the index cannot be built)
+    inputdirs = {}
+    histories = {}
     for member in members:
 
         # print ensemble/member
@@ -88,8 +85,30 @@ if __name__ == '__main__':
             inputdir = f'/scratch/p66/pbd562/petrichor/get/{member}/history/ocn'
         else:
             inputdir = f'/scratch/p66/pbd562/petrichor/get/{experiment}/{member}/history/ocn'
+        inputdirs[member] = inputdir
+        try:
+            print("Opening history reference index of: ", inputdir)
+            histories[member] = open_history(inputdir, keep_variables=keep_variables)
+        except Exception:
+            print(f'Could not open reference index for {model} {member}, opening files directly')
+            print(traceback.format_exc())
+            histories[member] = None
+
+    # Start the cluster, sized from the chunks of the member histories
+    # (they are only opened lazily above, nothing is computed before this)
+    print("Starting client")
+    client = make_client(*[h for h in histories.values() if h is not None], max_workers=40)
+    #, threads_per_worker=1, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
+    # added threads_per_worker=1 back again because I possibly hitting some random unsafe multithreading issue:
+    # https://forum.access-hive.org.au/t/netcdf-not-a-valid-id-errors/389
+
+
+    for member in members:
+
+        inputdir = inputdirs[member]
+        history = histories[member]
 
-        outputdir = f'{gdatadatadir}/{model}/{experiment}/{member}'
+        outputdir = output_dir(OutputKey("archive", model, experiment, member), gdatadatadir)
         print(f"\nProcessing {member}")
 
         # directory to save the data to (as NetCDF)
@@ -113,64 +132,10 @@ if __name__ == '__main__':
 
             # load the data
             try:
-                ds = xr.open_mfdataset(
-                    paths,
-                    chunks={'time':-1, 'st_ocean':-1},
-                    concat_dim="time",
-                    compat='override',
-                    preprocess=None,
-                    # preprocess=combined_preprocessing,
-                    engine='netcdf4',
-                    data_vars='minimal',
-                    coords='minimal',
-                    combine='nested',
-                    parallel=True,
-                    join='outer',
-                    attrs_file=None,
-                    combine_attrs='override',
-                    drop_variables=[ # Drop all the variables I don't need. Can I use a `keep_variables` instead?
-                        'ht', 'hu', 'kmt', 'kmu', 'pbot_t', 'patm_t', 'sea_level', 'sea_level_sq',
-                        'rho', 'rho_dzt', 'dht', 'pot_temp', 'sst', 'sst_sq', 'salt', 'sss', 'pot_rho_0',
-                        'age_global', 'psiu', 'mld', 'mld_max', 'mld_min', 'mld_sq', 'hblt_max',
-                        'u', 'v', 'tz_trans', 'tz_trans_sq', 'tx_trans_rho', 'ty_trans_rho',
-                        'tx_trans_rho_gm', 'ty_trans_rho_gm', 'temp_xflux_ndiffuse_int_z', 'temp_yflux_ndiffuse_int_z',
-                        'temp_xflux_sigma', 'temp_yflux_sigma', 'temp_yflux_submeso_int_z', 'temp_xflux_submeso_int_z',
-                        'temp_merid_flux_advect_global', 'temp_merid_flux_over_global', 'temp_merid_flux_gyre_global',
-                        'salt_merid_flux_advect_global', 'salt_merid_flux_over_global', 'salt_merid_flux_gyre_global',
-                        'temp_merid_flux_advect_southern', 'temp_merid_flux_over_southern', 'temp_merid_flux_gyre_southern',
-                        'salt_merid_flux_advect_southern', 'salt_merid_flux_over_southern', 'salt_merid_flux_gyre_southern',
-                        'temp_merid_flux_advect_atlantic', 'temp_merid_flux_over_atlantic', 'temp_merid_flux_gyre_atlantic',
-                        'salt_merid_flux_advect_atlantic', 'salt_merid_flux_over_atlantic', 'salt_merid_flux_gyre_atlantic',
-                        'temp_merid_flux_advect_pacific', 'temp_merid_flux_over_pacific', 'temp_merid_flux_gyre_pacific',
-                        'salt_merid_flux_advect_pacific', 'salt_merid_flux_over_pacific', 'salt_merid_flux_gyre_pacific',
-                        'temp_merid_flux_advect_arctic', 'temp_merid_flux_over_arctic', 'temp_merid_flux_gyre_arctic',
-                        'salt_merid_flux_advect_arctic', 'salt_merid_flux_over_arctic', 'salt_merid_flux_gyre_arctic',
-                        'temp_merid_flux_advect_indian', 'temp_merid_flux_over_indian', 'temp_merid_flux_gyre_indian',
-                        'salt_merid_flux_advect_indian', 'salt_merid_flux_over_indian', 'salt_merid_flux_gyre_indian',
-                        'lprec', 'fprec', 'evap', 'runoff', 'ice_calving', 'melt', 'pme_river', 'sfc_salt_flux_ice',
-                        'sfc_salt_flux_runoff', 'sfc_hflux_from_water_prec', 'sfc_hflux_from_water_evap',
-                        'sfc_hflux_from_runoff', 'sfc_hflux_from_calving', 'fprec_melt_heat', 'calving_melt_heat',
-                        'lw_heat', 'evap_heat', 'sens_heat', 'swflx', 'sw_heat', 'tau_x', 'tau_y', 'frazil_2d',
-                        'pme', 'pme_mass', 'river', 'swflx_vis', 'sw_frac', 'sfc_hflux_coupler', 'sfc_hflux_pme',
-                        'tau_curl', 'ekman_we', 'salt_calvingmix', 'temp_calvingmix', 'temp_runoffmix', 'temp_rivermix',
-                        'temp_runoff', 'temp_calving', 'wfimelt', 'wfiform', 'pbot0', 'anompb', 'eta_t', 'eta_u',
-                        'rhobarz', 'conv_rho_ud_t', 'urhod', 'vrhod', 'u_surf', 'v_surf', 'u_bott', 'v_bott', 'bottom_temp',
-                        'bottom_salt', 'bottom_age_global', 'temp', 'temp_xflux_adv', 'temp_yflux_adv', 'temp_zflux_adv',
-                        'salt_xflux_adv', 'salt_yflux_adv', 'salt_zflux_adv', 'temp_vdiffuse_impl', 'salt_vdiffuse_impl',
-                        'temp_tendency', 'salt_tendency', 'temp_tendency_expl', 'salt_tendency_expl', 'temp_submeso',
-                        'salt_submeso', 'neutral_rho', 'pot_rho_2', 'potrho_mix_base', 'potrho_mix_depth', 'press',
-                        'wt', 'wrhot', 'drhodtheta', 'drhodsalinity', 'cabbeling', 'thermobaricity',
-                        'salt_xflux_ndiffuse_int_z', 'salt_yflux_ndiffuse_int_z', 'psiv', 'temp_sigma',
-                        'mixdownslope_temp', 'mixdownslope_salt', 'eddy_depth', 'agm_grid_scaling',
-                        'bv_freq', 'rossby', 'rossby_radius', 'buoy_freq_ave_submeso', 'hblt_submeso',
-                        'viscosity_scaling', 'visc_crit_bih', 'lap_fric_u', 'lap_fric_v', 'diff_cbt_wave',
-                        'diff_cbt_drag', 'bvfreq_bottom', 'mix_efficiency', 'power_waves', 'power_diss_wave',
-                        'power_diss_drag', 'energy_flux', 'diff_cbt_kpp_t', 'diff_cbt_kpp_s', 'tide_speed_wave',
-                        'tide_speed_drag', 'tide_speed_mask', 'roughness_length', 'roughness_amp', 'langmuirfactor',
-                        'bmf_u', 'bmf_v', 'bottom_power_u', 'bottom_power_v', 'wind_power_u', 'wind_power_v',
-                        'average_T1', 'average_T2', 'average_DT', 'nv', 'potrho', 'potrho_edges'
-                    ]
-                )
+                if history is not None:
+                    ds = history.sel(time=slice(f'{years[0]}', f'{years[-1]}'))
+                else:
+                    ds = open_my_dataset(paths, keep_variables=keep_variables)
             except Exception:
                 print(f'Error processing {model} {member} data')
                 print(traceback.format_exc())
@@ -186,8 +151,8 @@ if __name__ == '__main__':
             #     # tx_trans = tx_trans_var.weighted(ds.time.dt.days_in_month).groupby("time.year").mean(dim="time")
             #     tx_trans = tx_trans_var
             #     print("\ntx_trans: ", tx_trans)
-            #     print("Saving tx_trans to: ", f'{outputdir}/month_tx_trans_{decade}s.nc')
-            #     tx_trans.to_netcdf(f'{outputdir}/month_tx_trans_{decade}s.nc', compute=True)
+            #     print("Saving tx_trans to: ", archivepathfun(member, "tx_trans", decade))
+            #     tx_trans.to_netcdf(archivepathfun(member, "tx_trans", decade), compute=True)
             # except Exception:
             #     print(f'Error processing {model} {member} tx_trans')
             #     print(traceback.format_exc())
@@ -201,8 +166,8 @@ if __name__ == '__main__':
             #     # ty_trans = ty_trans_var.weighted(ds.time.dt.days_in_month).groupby("time.year").mean(dim="time")
             #     ty_trans = ty_trans_var
             #     print("\nty_trans: ", ty_trans)
-            #     print("Saving ty_trans to: ", f'{outputdir}/month_ty_trans_{decade}s.nc')
-            #     ty_trans.to_netcdf(f'{outputdir}/month_ty_trans_{decade}s.nc', compute=True)
+            #     print("Saving ty_trans to: ", archivepathfun(member, "ty_trans", decade))
+            #     ty_trans.to_netcdf(archivepathfun(member, "ty_trans", decade), compute=True)
             # except Exception:
             #     print(f'Error processing {model} {member} ty_trans')
             #     print(traceback.format_exc())
@@ -214,8 +179,8 @@ if __name__ == '__main__':
                 print("Loading tx_trans_gm")
                 tx_trans_gm = ds["tx_trans_gm"].chunk({'time':-1})
                 print("\ntx_trans_gm: ", tx_trans_gm)
-                print("Saving tx_trans_gm to: ", f'{outputdir}/month_tx_trans_gm_{decade}s.nc')
-                tx_trans_gm.to_netcdf(f'{outputdir}/month_tx_trans_gm_{decade}s.nc', compute=True)
+                print("Saving tx_trans_gm to: ", archivepathfun(member, "tx_trans_gm", decade))
+                write_with_manifest(tx_trans_gm, archivepathfun(member, "tx_trans_gm", decade), profile="archive")
             except Exception:
                 print(f'Error processing {model} {member} tx_trans_gm')
                 print(traceback.format_exc())
@@ -225,8 +190,8 @@ if __name__ == '__main__':
                 print("Loading ty_trans_gm")
                 ty_trans_gm = ds["ty_trans_gm"].chunk({'time':-1})
                 print("\nty_trans_gm: ", ty_trans_gm)
-                print("Saving ty_trans_gm to: ", f'{outputdir}/month_ty_trans_gm_{decade}s.nc')
-                ty_trans_gm.to_netcdf(f'{outputdir}/month_ty_trans_gm_{decade}s.nc', compute=True)
+                print("Saving ty_trans_gm to: ", archivepathfun(member, "ty_trans_gm", decade))
+                write_with_manifest(ty_trans_gm, archivepathfun(member, "ty_trans_gm", decade), profile="archive")
             except Exception:
                 print(f'Error processing {model} {member} ty_trans_gm')
                 print(traceback.format_exc())
@@ -238,8 +203,8 @@ if __name__ == '__main__':
                 print("Loading tx_trans_submeso")
                 tx_trans_submeso = ds["tx_trans_submeso"].chunk({'time':-1})
                 print("\ntx_trans_submeso: ", tx_trans_submeso)
-                print("Saving tx_trans_submeso to: ", f'{outputdir}/month_tx_trans_submeso_{decade}s.nc')
-                tx_trans_submeso.to_netcdf(f'{outputdir}/month_tx_trans_submeso_{decade}s.nc', compute=True)
+                print("Saving tx_trans_submeso to: ", archivepathfun(member, "tx_trans_submeso", decade))
+                write_with_manifest(tx_trans_submeso, archivepathfun(member, "tx_trans_submeso", decade), profile="archive")
             except Exception:
                 print(f'Error processing {model} {member} tx_trans_submeso')
                 print(traceback.format_exc())
@@ -249,8 +214,8 @@ if __name__ == '__main__':
                 print("Loading ty_trans_submeso")
                 ty_trans_submeso = ds["ty_trans_submeso"].chunk({'time':-1})
                 print("\nty_trans_submeso: ", ty_trans_submeso)
-                print("Saving ty_trans_submeso to: ", f'{outputdir}/month_ty_trans_submeso_{decade}s.nc')
-                ty_trans_submeso.to_netcdf(f'{outputdir}/month_ty_trans_submeso_{decade}s.nc', compute=True)
+                print("Saving ty_trans_submeso to: ", archivepathfun(member, "ty_trans_submeso", decade))
+                write_with_manifest(ty_trans_submeso, archivepathfun(member, "ty_trans_submeso", decade), profile="archive")
             except Exception:
                 print(f'Error processing {model} {member} ty_trans_submeso')
                 print(traceback.format_exc())
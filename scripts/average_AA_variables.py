@@ -16,12 +16,6 @@ num_years=10
 import os
 os.environ["PYTHONWARNINGS"] = "ignore"
 
-# Load dask
-from dask.distributed import Client
-
-# Load xarray for N-dimensional arrays
-import xarray as xr
-
 # Load traceback to print exceptions
 import traceback
 
@@ -29,39 +23,16 @@ import traceback
 # from xmip.preprocessing import combined_preprocessing
 
 
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.timewindow import time_window_strings
+from tmip.io import open_my_dataset
+from tmip.averaging import yearlymax_reduction, write_outputs
+from tmip.cluster import make_client
+
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def time_window_strings(year_start, num_years):
-    """
-    return strings for start_time and end_time
-    """
-    # start_time is first second of year_start
-    start_time = f'{year_start}'
-    # end_time is last second of last_year
-    end_time = f'{year_start + num_years - 1}'
-    # Return the weighted average
-    return start_time, end_time
-
-def open_my_dataset(paths):
-    ds = xr.open_mfdataset(
-        paths,
-        chunks={'time':-1, 'st_ocean':-1},
-        concat_dim="time",
-        compat='override',
-        preprocess=None,
-        engine='netcdf4',
-        data_vars='minimal',
-        coords='minimal',
-        combine='nested',
-        parallel=True,
-        join='outer',
-        attrs_file=None,
-        combine_attrs='override',
-    )
-    return ds
-
 # Create directory on scratch to save the data
 scratchdatadir = '/scratch/xv83/TMIP/data'
 AAdatadir = '/scratch/xv83/bp3051/access-esm/archive/andersonacceleration_test-n10-5415f621/'
@@ -75,11 +46,8 @@ end_time_str = f'Dec{end_time}'
 # Simulation years from AA output
 simyears = range(10) # AA cycles of 10 years
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=44, threads_per_worker=1) #, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
     # print ensemble/member
     print(f"\nProcessing AA output")
     # directory to save the data to (as NetCDF)
@@ -178,25 +146,37 @@ if __name__ == '__main__':
     # except Exception:
     #     print(f'Error processing ty_trans_submeso')
     #     print(traceback.format_exc())
+    # Lazy inputs, to size the cluster from their chunks
+    inputs = []
     # MLD
     paths = [f'{AAdatadir}/output00{simyear}/ocean/ocean-2d-mld-1monthly-mean-ym_185{simyear}_01.nc' for simyear in simyears]
     try:
         print("Loading mlotst data")
         mlotst_ds = open_my_dataset(paths)
         print("\nmlotst_ds: ", mlotst_ds)
+        inputs.append(mlotst_ds)
+    except Exception:
+        print(f'Error loading {model} mlotst')
+        print(traceback.format_exc())
+
+    # Start the cluster, sized from the chunks of the inputs
+    # (they are only opened lazily above, nothing is computed before this)
+    print("Starting client")
+    client = make_client(*inputs, max_workers=44)
+
+    try:
         print("Slicing mlotst for the time period")
         mlotst_ds_sel = mlotst_ds.sel(time=slice(start_time, end_time))
-        print("Averaging mlotst (mean of the yearly maximum of monthly data)")
-        mlotst_yearlymax = mlotst_ds_sel.groupby("time.year").max(dim="time")
-        print("\nmlotst_yearlymax: ", mlotst_yearlymax)
-        mlotst = mlotst_yearlymax.mean(dim="year")
+        print("Averaging mlotst (mean of the yearly maximum of monthly data) and maximum in a single pass")
+        mlotst, mlotst_max = yearlymax_reduction(mlotst_ds_sel["mld"])
         print("\nmlotst: ", mlotst)
-        print("Saving mlotst to: ", f'{outputdir}/mlotst.nc')
-        mlotst.to_netcdf(f'{outputdir}/mlotst.nc', compute=True)
-        mlotst_max = mlotst_ds_sel.max(dim="time")
         print("\nmlotst_max: ", mlotst_max)
-        print("Saving mlotst_max to: ", f'{outputdir}/mlotst_max.nc')
-        mlotst_max.to_netcdf(f'{outputdir}/mlotst_max.nc', compute=True)
+        write_outputs(
+            dict(mlotst=mlotst.to_dataset(name="mld"), mlotst_max=mlotst_max.to_dataset(name="mld")),
+            outputdir,
+            label=model,
+            profile="matrix-build",
+        )
     except Exception:
         print(f'Error processing {model} {member} mlotst')
         print(traceback.format_exc())
@@ -204,5 +184,3 @@ if __name__ == '__main__':
 
 
 
-
-
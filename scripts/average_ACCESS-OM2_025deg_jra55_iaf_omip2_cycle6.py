@@ -19,9 +19,6 @@ PROJECT = environ["PROJECT"]
 # Import makedirs to create directories where I write new files
 from os import makedirs
 
-# Load dask
-from dask.distributed import Client
-
 # Load intake and cosima cookbook
 import intake
 
@@ -37,37 +34,32 @@ import traceback
 # Load pandas for data manipulation
 import pandas as pd
 
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.timewindow import time_window_strings
+from tmip.catalog import select_data, select_variables
+from tmip.averaging import build_averages, write_outputs
+from tmip.ledger import load_ledger, task_key, input_fingerprint, needs_build, record_status
+from tmip.cluster import make_client
+
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def time_window_strings(year_start, num_years):
+def needs_average(ledger, outputdir, variable, frequency, names=None):
     """
-    return strings for start_time and end_time
-    """
-    # start_time is first second of year_start
-    start_time = f'{year_start:04d}'
-    # end_time is last second of last_year
-    end_time = f'{year_start + num_years - 1:04d}'
-    # Return the weighted average
-    return start_time, end_time
-
-def select_data(cat, xarray_open_kwargs, **kwargs):
-    selectedcat = cat.search(**kwargs)
-    print("\nselectedcat: ", selectedcat)
-    xarray_combine_by_coords_kwargs=dict(
-        compat="override",
-        data_vars="minimal",
-        coords="minimal"
-    )
-    datadask = selectedcat.to_dask(
-        xarray_open_kwargs=xarray_open_kwargs,
-        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
-        parallel=True,
-    )
-    return datadask
-
+    return whether the outputs `names` (default `[variable]`) of `variable` still have to be built
 
+    Outputs that are done in the ledger with the same input files are skipped.
+    """
+    names = [variable] if names is None else names
+    inputs = searched_cat.search(variable=variable, frequency=frequency).df.path
+    fingerprint = input_fingerprint(inputs, start_time=start_time, end_time=end_time, profile="matrix-build")
+    pending = [
+        needs_build(ledger, f'{outputdir}/{name}.nc', task_key(model=model, experiment=subcatalog,
+            window=f'{start_time_str}-{end_time_str}', variable=name), fingerprint)
+        for name in names
+    ]
+    return any(pending)
 
 # 3. Load catalog
 
@@ -92,180 +84,81 @@ end_time_str = f'Dec{end_time}'
 
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=48, threads_per_worker=1) #, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
-
 
     # directory to save the data to (as NetCDF)
     outputdir = f'{datadir}/{model}/{subcatalog}/{start_time_str}-{end_time_str}'
     print("Creating directory: ", outputdir)
     makedirs(outputdir, exist_ok=True)
 
-    # area_t
-    try:
-        print("Loading area_t data")
-        area_t_datadask = select_data(searched_cat,
-            dict(
-                chunks={'xt_ocean':240, 'yt_ocean':216}
-            ),
-            variable = "area_t",
-            frequency = "fx",
-        )
-        print("\narea_t_datadask: ", area_t_datadask)
-        area_t = area_t_datadask["area_t"]
-        print("\narea_t: ", area_t)
-        print("Saving area_t to: ", f'{outputdir}/area_t.nc')
-        area_t.to_netcdf(f'{outputdir}/area_t.nc', compute=True)
-    except Exception:
-        print(f'Error processing {model} area_t')
-        print(traceback.format_exc())
-
-
-    # tx_trans
-    try:
-        print("Loading tx_trans data")
-        tx_trans_datadask = select_data(searched_cat,
-            dict(
-                chunks={'time': -1, 'xu_ocean':120, 'yt_ocean':108, 'lev':25}
-            ),
-            variable = "tx_trans",
-            frequency = "1mon",
-        )
-        print("\ntx_trans_datadask: ", tx_trans_datadask)
-        print("Slicing tx_trans for the time period")
-        tx_trans_datadask_sel = tx_trans_datadask.sel(time=slice(start_time, end_time))
-        print("Averaging tx_trans")
-        tx_trans = tx_trans_datadask_sel["tx_trans"].weighted(tx_trans_datadask_sel.time.dt.days_in_month).mean(dim="time")
-        print("\ntx_trans: ", tx_trans)
-        print("Saving tx_trans to: ", f'{outputdir}/tx_trans.nc')
-        tx_trans.to_dataset(name="tx_trans").to_netcdf(f'{outputdir}/tx_trans.nc', compute=True)
-    except Exception:
-        print(f'Error processing {model} tx_trans')
-        print(traceback.format_exc())
-
-    # ty_trans
-    try:
-        print("Loading ty_trans data")
-        ty_trans_datadask = select_data(searched_cat,
-            dict(
-                chunks={'time': -1, 'xt_ocean':120, 'yu_ocean':108, 'lev':25}
-            ),
-            variable = "ty_trans",
-            frequency = "1mon",
-        )
-        print("\nty_trans_datadask: ", ty_trans_datadask)
-        print("Slicing ty_trans for the time period")
-        ty_trans_datadask_sel = ty_trans_datadask.sel(time=slice(start_time, end_time))
-        print("Averaging ty_trans")
-        ty_trans = ty_trans_datadask_sel["ty_trans"].weighted(ty_trans_datadask_sel.time.dt.days_in_month).mean(dim="time")
-        print("\nty_trans: ", ty_trans)
-        print("Saving ty_trans to: ", f'{outputdir}/ty_trans.nc')
-        ty_trans.to_dataset(name="ty_trans").to_netcdf(f'{outputdir}/ty_trans.nc', compute=True)
-    except Exception:
-        print(f'Error processing {model} ty_trans')
-        print(traceback.format_exc())
-
-    # tx_trans_gm
-    try:
-        print("Loading tx_trans_gm data")
-        tx_trans_gm_datadask = select_data(searched_cat,
-            dict(
-                chunks={'time': -1, 'xu_ocean':120, 'yt_ocean':108, 'lev':25}
-            ),
-            variable = "tx_trans_gm",
-            frequency = "1mon",
-        )
-        print("\ntx_trans_gm_datadask: ", tx_trans_gm_datadask)
-        print("Slicing tx_trans_gm for the time period")
-        tx_trans_gm_datadask_sel = tx_trans_gm_datadask.sel(time=slice(start_time, end_time))
-        print("Averaging tx_trans_gm")
-        tx_trans_gm = tx_trans_gm_datadask_sel["tx_trans_gm"].weighted(tx_trans_gm_datadask_sel.time.dt.days_in_month).mean(dim="time")
-        print("\ntx_trans_gm: ", tx_trans_gm)
-        print("Saving tx_trans_gm to: ", f'{outputdir}/tx_trans_gm.nc')
-        tx_trans_gm.to_dataset(name="tx_trans_gm").to_netcdf(f'{outputdir}/tx_trans_gm.nc', compute=True)
-    except Exception:
-        print(f'Error processing {model} tx_trans_gm')
-        print(traceback.format_exc())
-
-    # ty_trans_gm
-    try:
-        print("Loading ty_trans_gm data")
-        ty_trans_gm_datadask = select_data(searched_cat,
-            dict(
-                chunks={'time': -1, 'xt_ocean':120, 'yu_ocean':108, 'lev':25}
-            ),
-            variable = "ty_trans_gm",
-            frequency = "1mon",
-        )
-        print("\nty_trans_gm_datadask: ", ty_trans_gm_datadask)
-        print("Slicing ty_trans_gm for the time period")
-        ty_trans_gm_datadask_sel = ty_trans_gm_datadask.sel(time=slice(start_time, end_time))
-        print("Averaging ty_trans_gm")
-        ty_trans_gm = ty_trans_gm_datadask_sel["ty_trans_gm"].weighted(ty_trans_gm_datadask_sel.time.dt.days_in_month).mean(dim="time")
-        print("\nty_trans_gm: ", ty_trans_gm)
-        print("Saving ty_trans_gm to: ", f'{outputdir}/ty_trans_gm.nc')
-        ty_trans_gm.to_dataset(name="ty_trans_gm").to_netcdf(f'{outputdir}/ty_trans_gm.nc', compute=True)
-    except Exception:
-        print(f'Error processing {model} ty_trans_gm')
-        print(traceback.format_exc())
-
-    # mld dataset
-    try:
-        print("Loading mld data")
-        mld_datadask = select_data(searched_cat,
-            dict(
-                chunks={'time': -1, 'xt_ocean':240, 'yt_ocean':216}
-            ),
-            variable = "mld",
-            frequency = "1mon",
-        )
-        print("\nmld_datadask: ", mld_datadask)
-        print("Slicing mld for the time period")
-        mld_datadask_sel = mld_datadask.sel(time=slice(start_time, end_time))
-        print("Averaging mld (mean of the yearly maximum of monthly data)")
-        mld_yearlymax = mld_datadask_sel.groupby("time.year").max(dim="time")
-        print("\nmld_yearlymax: ", mld_yearlymax)
-        mld = mld_yearlymax.mean(dim="year")
-        print("\nmld: ", mld)
-        print("Saving mld to: ", f'{outputdir}/mld.nc')
-        mld.to_dataset(name="mld").to_netcdf(f'{outputdir}/mld.nc', compute=True)
-        mld_max = mld_datadask_sel.max(dim="time")
-        print("\nmld_max: ", mld_max)
-        print("Saving mld_max to: ", f'{outputdir}/mld_max.nc')
-        mld_max.to_dataset(name="mld_max").to_netcdf(f'{outputdir}/mld_max.nc', compute=True)
-    except Exception:
-        print(f'Error processing {model} mld')
-        print(traceback.format_exc())
-
-    # dht
-    try:
-        print("Loading dht data")
-        dht_datadask = select_data(searched_cat,
-            dict(
-                chunks={'time': -1, 'xt_ocean':120, 'yt_ocean':108, 'lev':25}
-            ),
-            variable = "dht",
-            frequency = "1mon",
-        )
-        print("\ndht_datadask: ", dht_datadask)
-        print("Slicing dht for the time period")
-        dht_datadask_sel = dht_datadask.sel(time=slice(start_time, end_time))
-        print("Averaging dht")
-        dht = dht_datadask_sel["dht"].weighted(dht_datadask_sel.time.dt.days_in_month).mean(dim="time")
-        print("\ndht: ", dht)
-        print("Saving dht to: ", f'{outputdir}/dht.nc')
-        dht.to_dataset(name="dht").to_netcdf(f'{outputdir}/dht.nc', compute=True)
-    except Exception:
-        print(f'Error processing {model} dht')
-        print(traceback.format_exc())
+    # Load the ledger (outputs already built by a previous job are skipped)
+    ledger = load_ledger(f'{outputdir}/ledger.jsonl')
+
+    # variables whose outputs still have to be built
+    fixed_variables = [v for v in ['area_t'] if needs_average(ledger, outputdir, v, "fx")]
+    monthly_variables = [v for v, names in [
+        ('tx_trans', None), ('ty_trans', None), ('tx_trans_gm', None), ('ty_trans_gm', None),
+        ('mld', ['mld', 'mld_max']), ('dht', None),
+    ] if needs_average(ledger, outputdir, v, "1mon", names=names)]
+
+    # monthly variables (in the same files), opened once for all of them
+    monthly_datadask = xr.Dataset()
+    if monthly_variables:
+        print("Loading monthly data: ", monthly_variables)
+        try:
+            monthly_datadask = select_variables(searched_cat,
+                dict(
+                    chunks="auto-for:timemean"
+                ),
+                monthly_variables,
+                allow_missing = True,
+                frequency = "1mon",
+            )
+        except Exception:
+            print(f'Error loading {model} monthly data')
+            print(traceback.format_exc())
+            # (each variable below then reports its own error)
+
+    # Start the cluster, sized from the chunks of the monthly data
+    # (they are only opened lazily above, nothing is computed before this)
+    print("Starting client")
+    client = make_client(monthly_datadask, max_workers=48)
+
+    def open_variable(variable):
+        if variable in fixed_variables:
+            return select_data(searched_cat,
+                dict(
+                    chunks={'xt_ocean':240, 'yt_ocean':216}
+                ),
+                variable = variable,
+                frequency = "fx",
+            )
+        return monthly_datadask
+
+    # Build the lazy averages of all the variables (mld: mean of the yearly maximum and maximum in a single pass)
+    outputs = build_averages(
+        open_variable,
+        fixed_variables + monthly_variables,
+        start_time,
+        end_time,
+        reducers=dict(area_t="fixed", mld="yearlymax"),
+        label=model,
+    )
+    if "mld_max" in outputs:
+        outputs["mld_max"] = outputs["mld_max"].rename(mld="mld_max")
+
+    # Record the variables that failed to open or average
+    for name in fixed_variables + monthly_variables + (["mld_max"] if "mld" in monthly_variables else []):
+        if name not in outputs:
+            record_status(ledger, f'{outputdir}/{name}.nc', "failed")
 
+    # Write all outputs together (their status is recorded in the ledger)
+    write_outputs(outputs, outputdir, label=model, profile="matrix-build", ledger=ledger)
 
 
-    client.close()
 
+    client.close()
 
 
 
@@ -28,9 +28,6 @@ PROJECT = environ["PROJECT"]
 # Import makedirs to create directories where I write new files
 from os import makedirs
 
-# Load dask
-from dask.distributed import Client
-
 # Load intake and cosima cookbook
 import intake
 
@@ -46,38 +43,17 @@ import traceback
 # Load pandas for data manipulation
 import pandas as pd
 
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.timewindow import time_window_strings
+from tmip.catalog import select_data, select_variables
+from tmip.averaging import yearlymax_reduction, write_outputs
+from tmip.output import save_output
+from tmip.cluster import make_client
+
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def time_window_strings(year_start, num_years):
-    """
-    return strings for start_time and end_time
-    """
-    # start_time is first second of year_start
-    start_time = f'{year_start:04d}'
-    # end_time is last second of last_year
-    end_time = f'{year_start + num_years - 1:04d}'
-    # Return the weighted average
-    return start_time, end_time
-
-def select_data(cat, xarray_open_kwargs, **kwargs):
-    selectedcat = cat.search(**kwargs)
-    print("\nselectedcat: ", selectedcat)
-    xarray_combine_by_coords_kwargs=dict(
-        compat="override",
-        data_vars="minimal",
-        coords="minimal"
-    )
-    datadask = selectedcat.to_dask(
-        xarray_open_kwargs=xarray_open_kwargs,
-        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
-        parallel=True,
-    )
-    return datadask
-
-
-
 # 3. Load catalog
 
 catalogs = intake.cat.access_nri
@@ -102,18 +78,39 @@ end_time_str = f'Dec{end_time}'
 
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=24, threads_per_worker=1) #, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
-
 
     # directory to save the data to (as NetCDF)
     outputdir = f'{datadir}/{model}/{subcatalog}/{start_time_str}-{end_time_str}'
     print("Creating directory: ", outputdir)
     makedirs(outputdir, exist_ok=True)
 
+    # monthly variables (in the same `ocean_month.nc` files), opened once for all of them
+    monthly_variables = ['tx_trans', 'ty_trans', 'mld']
+    print("Loading monthly data: ", monthly_variables)
+    try:
+        monthly_datadask = select_variables(searched_cat,
+            dict(
+                chunks={'time': -1, 'lev':-1}
+            ),
+            monthly_variables,
+            allow_missing = True,
+        )
+        print("\nmonthly_datadask: ", monthly_datadask)
+        print("Slicing monthly data for the time period")
+        monthly_datadask_sel = monthly_datadask.sel(time=slice(start_time, end_time))
+    except Exception:
+        print(f'Error loading {model} monthly data')
+        print(traceback.format_exc())
+        # (each variable below then reports its own error)
+        monthly_datadask_sel = xr.Dataset()
+
+    # Start the cluster, sized from the chunks of the monthly data
+    # (they are only opened lazily above, nothing is computed before this)
+    print("Starting client")
+    client = make_client(monthly_datadask_sel, max_workers=24)
+
     # dzt
     try:
         print("Loading dzt data")
@@ -126,7 +123,7 @@ if __name__ == '__main__':
         print("\ndzt_datadask: ", dzt_datadask)
         dzt_file = f'{outputdir}/dzt.nc'
         print("Saving dzt to: ", dzt_file)
-        dzt_datadask.to_netcdf(dzt_file, compute=True)
+        save_output(dzt_datadask, dzt_file, "matrix-build", compute=True)
     except Exception:
         print(f'Error processing {model} dzt')
         print(traceback.format_exc())
@@ -148,7 +145,7 @@ if __name__ == '__main__':
         area_t = area_t_datadask_sel["area_t"].weighted(area_t_datadask_sel.time.dt.days_in_month).mean(dim="time")
         print("\narea_t: ", area_t)
         print("Saving area_t to: ", f'{outputdir}/area_t.nc')
-        area_t.to_netcdf(f'{outputdir}/area_t.nc', compute=True)
+        save_output(area_t, f'{outputdir}/area_t.nc', "matrix-build", compute=True)
     except Exception:
         print(f'Error processing {model} area_t')
         print(traceback.format_exc())
@@ -156,43 +153,22 @@ if __name__ == '__main__':
 
     # tx_trans
     try:
-        print("Loading tx_trans data")
-        tx_trans_datadask = select_data(searched_cat,
-            dict(
-                chunks={'time': -1, 'lev':-1}
-            ),
-            variable = "tx_trans",
-        )
-        print("\ntx_trans_datadask: ", tx_trans_datadask)
-        print("Slicing tx_trans for the time period")
-        tx_trans_datadask_sel = tx_trans_datadask.sel(time=slice(start_time, end_time))
         print("Averaging tx_trans")
-        tx_trans = tx_trans_datadask_sel["tx_trans"].weighted(tx_trans_datadask_sel.time.dt.days_in_month).mean(dim="time")
+        tx_trans = monthly_datadask_sel["tx_trans"].weighted(monthly_datadask_sel.time.dt.days_in_month).mean(dim="time")
         print("\ntx_trans: ", tx_trans)
         print("Saving tx_trans to: ", f'{outputdir}/tx_trans.nc')
-        tx_trans.to_netcdf(f'{outputdir}/tx_trans.nc', compute=True)
+        save_output(tx_trans, f'{outputdir}/tx_trans.nc', "matrix-build", compute=True)
     except Exception:
         print(f'Error processing {model} tx_trans')
         print(traceback.format_exc())
 
     # ty_trans
     try:
-        print("Loading ty_trans data")
-        ty_trans_datadask = select_data(searched_cat,
-            dict(
-                chunks={'time': -1, 'lev':-1}
-            ),
-            variable = "ty_trans",
-            # frequency = "mon",
-        )
-        print("\nty_trans_datadask: ", ty_trans_datadask)
-        print("Slicing ty_trans for the time period")
-        ty_trans_datadask_sel = ty_trans_datadask.sel(time=slice(start_time, end_time))
         print("Averaging ty_trans")
-        ty_trans = ty_trans_datadask_sel["ty_trans"].weighted(ty_trans_datadask_sel.time.dt.days_in_month).mean(dim="time")
+        ty_trans = monthly_datadask_sel["ty_trans"].weighted(monthly_datadask_sel.time.dt.days_in_month).mean(dim="time")
         print("\nty_trans: ", ty_trans)
         print("Saving ty_trans to: ", f'{outputdir}/ty_trans.nc')
-        ty_trans.to_netcdf(f'{outputdir}/ty_trans.nc', compute=True)
+        save_output(ty_trans, f'{outputdir}/ty_trans.nc', "matrix-build", compute=True)
     except Exception:
         print(f'Error processing {model} ty_trans')
         print(traceback.format_exc())
@@ -200,28 +176,16 @@ if __name__ == '__main__':
 
     # mld dataset
     try:
-        print("Loading mld data")
-        mld_datadask = select_data(searched_cat,
-            dict(
-                chunks={'time': -1, 'lev':-1}
-            ),
-            variable = "mld",
-            # frequency = "mon",
-        )
-        print("\nmld_datadask: ", mld_datadask)
-        print("Slicing mld for the time period")
-        mld_datadask_sel = mld_datadask.sel(time=slice(start_time, end_time))
-        print("Averaging mld (mean of the yearly maximum of monthly data)")
-        mld_yearlymax = mld_datadask_sel.groupby("time.year").max(dim="time")
-        print("\nmld_yearlymax: ", mld_yearlymax)
-        mld = mld_yearlymax.mean(dim="year")
+        print("Averaging mld (mean of the yearly maximum of monthly data) and maximum in a single pass")
+        mld, mld_max = yearlymax_reduction(monthly_datadask_sel["mld"])
         print("\nmld: ", mld)
-        print("Saving mld to: ", f'{outputdir}/mld.nc')
-        mld.to_netcdf(f'{outputdir}/mld.nc', compute=True)
-        mld_max = mld_datadask_sel.max(dim="time")
         print("\nmld_max: ", mld_max)
-        print("Saving mld_max to: ", f'{outputdir}/mld_max.nc')
-        mld_max.to_netcdf(f'{outputdir}/mld_max.nc', compute=True)
+        write_outputs(
+            dict(mld=mld.to_dataset(name="mld"), mld_max=mld_max.to_dataset(name="mld")),
+            outputdir,
+            label=model,
+            profile="matrix-build",
+        )
     except Exception:
         print(f'Error processing {model} mld')
         print(traceback.format_exc())
@@ -231,4 +195,3 @@ if __name__ == '__main__':
 
 
 
-
@@ -41,89 +41,32 @@ environ["PYTHONWARNINGS"] = "ignore"
 # Import makedirs to create directories where I write new files
 from os import makedirs
 
-# Load dask
-from dask.distributed import Client
-
-# Load intake and cosima cookbook
-import intake
-
 # Load xarray for N-dimensional arrays
 import xarray as xr
 
 # Load datetime to deal with time formats
 import datetime
 
-# Load xmip for preprocessing (trying to get consistent metadata for making matrices down the road)
-from xmip.preprocessing import combined_preprocessing
-
 # Load traceback to print exceptions
 import traceback
 
-# Load pandas for data manipulation
-import pandas as pd
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalogcache import cached_search
+from tmip.timewindow import time_window_strings
+from tmip.catalog import latest_version_manifest, open_manifest_data, summary_variable_availability, sort_members
+from tmip.averaging import yearlymax_reduction, write_outputs
+from tmip.output import save_output
+from tmip.cluster import make_client
 
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def time_window_strings(year_start, num_years):
-    """
-    return strings for start_time and end_time
-    """
-    # start_time is first second of year_start
-    start_time = f'{year_start}'
-    # end_time is last second of last_year
-    end_time = f'{year_start + num_years - 1}'
-    # Return the weighted average
-    return start_time, end_time
-
-def find_latest_version(cat):
-    """
-    find latest version of selected data
-    """
-    sorted_versions = cat.df.version.to_list()
-    sorted_versions.sort()
-    latest_version = sorted_versions[-1]
-    return latest_version
-
-def select_latest_cat(cat, **kwargs):
-    """
-    search latest version of selected data
-    """
-    selectedcat = cat.search(**kwargs)
-    # if dataframe is empty, error
-    if selectedcat.df.empty:
-        raise ValueError(f"No data found for {kwargs}")
-
-    latestselectedcat = selectedcat.search(version=find_latest_version(selectedcat))
-    return latestselectedcat
-
-def select_latest_data(cat, xarray_open_kwargs, **kwargs):
-    latestselectedcat = select_latest_cat(cat, **kwargs)
-    print("\nlatestselectedcat: ", latestselectedcat)
-    xarray_combine_by_coords_kwargs=dict(
-        compat="override",
-        data_vars="minimal",
-        coords="minimal"
-    )
-    datadask = latestselectedcat.to_dask(
-        xarray_open_kwargs=xarray_open_kwargs,
-        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
-        parallel=True,
-        # preprocess=combined_preprocessing, <- xmip does not work for CMIP5 data ATM
-    )
-    return datadask
-
-
-
 # 3. Load catalog
 
-catalogs = intake.cat.access_nri
-cat = catalogs["cmip5_rr3"]
-print(cat)
-
 # Only keep the required data
-searched_cat = cat.search(
+# (the search result is cached on disk and reused by all jobs, see tmip/catalogcache.py)
+searched_cat = cached_search("cmip5_rr3",
     model = model,
     experiment = experiment,
     # ensemble = ensemble,
@@ -132,44 +75,10 @@ searched_cat = cat.search(
 print(searched_cat)
 
 cmip_version = "CMIP5"
-# Find ensembles that have all the required data
-def summary_variable_availability(df, cmip_version):
-    if cmip_version == "CMIP6":
-        variable_id = 'variable_id'
-        experiment_id = 'experiment_id'
-        source_id = 'source_id'
-        member_id = 'member_id'
-        list1 = ['umo', 'vmo', 'mlotst', 'volcello', 'areacello', 'thetao', 'so']
-        list2 = ['uo', 'vo', 'mlotst', 'volcello', 'areacello', 'thetao', 'so']
-    elif cmip_version == "CMIP5":
-        variable_id = 'variable'
-        experiment_id = 'experiment'
-        source_id = 'model'
-        member_id = 'ensemble'
-        # (Note Removed volcello and areacello because could be in different member: r0i0p0)
-        list1 = ['umo', 'vmo', 'mlotst', 'thetao', 'so']
-        list2 = ['uo', 'vo', 'mlotst', 'thetao', 'so']
-    # Step 1: Filter the dataframe to include only the specified variables
-    filtered_df_1 = df[df[variable_id].isin(list1)]
-    filtered_df_2 = df[df[variable_id].isin(list2)]
-    # Step 2: Group by 'source_id' and 'member_id'
-    grouped_1 = filtered_df_1.groupby([experiment_id, source_id, member_id])
-    grouped_2 = filtered_df_2.groupby([experiment_id, source_id, member_id])
-    # Step 3: Find groups that contain all the variables in each set
-    valid_groups_1 = grouped_1.filter(lambda x: set(list1).issubset(set(x[variable_id])))
-    valid_groups_2 = grouped_2.filter(lambda x: set(list2).issubset(set(x[variable_id])))
-    # Step 4: Get the list of source_id and their member_id for each set
-    result_1 = valid_groups_1[[experiment_id, source_id, member_id]].drop_duplicates().reset_index(drop=True)
-    result_2 = valid_groups_2[[experiment_id, source_id, member_id]].drop_duplicates().reset_index(drop=True)
-    # Step 5: Group by 'source_id' and aggregate member_id into a list for each set
-    final_result_1 = result_1.groupby([experiment_id, source_id])[member_id].apply(list).reset_index()
-    final_result_2 = result_2.groupby([experiment_id, source_id])[member_id].apply(list).reset_index()
-    # Step 6: Merge the results into a single dataframe
-    merged_result = pd.merge(final_result_1, final_result_2, on=[experiment_id, source_id], how='outer', suffixes=('_umo_vmo', '_uo_vo'))
-    return merged_result
-
 # Find ensembles that have all the required data (umo+vmo or uo+vo + all the rest)
-availability_df = summary_variable_availability(cat.df, cmip_version)
+availability_df = summary_variable_availability(searched_cat.df, cmip_version)
+# Resolve the latest version of every variable/member at once (file manifest for the whole sweep)
+manifest = latest_version_manifest(searched_cat.df, cmip_version)
 # grab ensembles to loop over
 availability_df = availability_df[(availability_df.model == model) & (availability_df.experiment == experiment)]
 [ensembles1] = availability_df.ensemble_umo_vmo
@@ -177,17 +86,7 @@ availability_df = availability_df[(availability_df.model == model) & (availabili
 ensembles = list(set(ensembles1) & set(ensembles2))
 
 # sort ensembles that are formatted as "r%di%dp%df%d" where %d is a integer
-import re
-
-def extract_numbers(ensemble):
-    # Extract integers from the string using regex
-    return list(map(int, re.findall(r'\d+', ensemble)))
-
-def sort_ensembles(ensembles):
-    # Sort ensembles using the custom key function
-    return sorted(ensembles, key=extract_numbers)
-
-sorted_ensembles = sort_ensembles(ensembles)
+sorted_ensembles = sort_members(ensembles)
 # print ensembles on one line each
 print("\n".join(sorted_ensembles))
 
@@ -202,11 +101,26 @@ end_time_str = f'Dec{end_time}'
 
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=4)#, threads_per_worker=1, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
+    # Start the cluster, sized from the chunks of umo of the first ensemble
+    # (opened lazily, the 3D variables of all ensembles have the same chunks)
+    inputs = []
+    try:
+        inputs.append(open_manifest_data(manifest,
+            dict(
+                chunks={'time': -1, 'lev':-1}
+            ),
+            xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
+            variable = "umo",
+            ensemble = next(e for e in sorted_ensembles if e != "r0i0p0"),
+            frequency = "mon",
+        ))
+    except Exception:
+        print(f'Error loading {model} umo to size the cluster')
+        print(traceback.format_exc())
+    print("Starting client")
+    client = make_client(*inputs, max_workers=4)
 
     for ensemble in sorted_ensembles:
 
@@ -225,10 +139,11 @@ if __name__ == '__main__':
         # volcello
         try:
             print("Loading volcello data")
-            volcello_datadask = select_latest_data(searched_cat,
+            volcello_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "volcello",
                 ensemble = "r0i0p0", # <- in the CMIP5 ACCESS catalog, the fixed data is in ensemble r0i0p0 (not in any other ensemble)
                 table = "fx", # <- in the CMIP5 ACCESS catalog, the fixed data table is "fx" (not "Ofx")
@@ -236,7 +151,7 @@ if __name__ == '__main__':
             print("\nvolcello_datadask: ", volcello_datadask)
             volcello_file = f'{outputdir}/volcello.nc'
             print("Saving volcello to: ", volcello_file)
-            volcello_datadask.to_netcdf(volcello_file, compute=True)
+            save_output(volcello_datadask, volcello_file, "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {ensemble} volcello')
             print(traceback.format_exc())
@@ -245,10 +160,11 @@ if __name__ == '__main__':
         # areacello
         try:
             print("Loading areacello data")
-            areacello_datadask = select_latest_data(searched_cat,
+            areacello_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "areacello",
                 ensemble = "r0i0p0", # <- in the CMIP5 ACCESS catalog, the fixed data is in ensemble r0i0p0 (not in any other ensemble)
                 table = "fx", # <- in the CMIP5 ACCESS catalog, the fixed data table is "fx" (not "Ofx")
@@ -256,7 +172,7 @@ if __name__ == '__main__':
             print("\nareacello_datadask: ", areacello_datadask)
             areacello_file = f'{outputdir}/areacello.nc'
             print("Saving areacello to: ", areacello_file)
-            areacello_datadask.to_netcdf(areacello_file, compute=True)
+            save_output(areacello_datadask, areacello_file, "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {ensemble} areacello')
             print(traceback.format_exc())
@@ -265,10 +181,11 @@ if __name__ == '__main__':
         # umo
         try:
             print("Loading umo data")
-            umo_datadask = select_latest_data(searched_cat,
+            umo_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "umo",
                 ensemble = ensemble,
                 frequency = "mon",
@@ -280,7 +197,7 @@ if __name__ == '__main__':
             umo = umo_datadask_sel["umo"].weighted(umo_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\numo: ", umo)
             print("Saving umo to: ", f'{outputdir}/umo.nc')
-            umo.to_netcdf(f'{outputdir}/umo.nc', compute=True)
+            save_output(umo, f'{outputdir}/umo.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {ensemble} umo')
             print(traceback.format_exc())
@@ -288,10 +205,11 @@ if __name__ == '__main__':
         # vmo
         try:
             print("Loading vmo data")
-            vmo_datadask = select_latest_data(searched_cat,
+            vmo_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "vmo",
                 ensemble = ensemble,
                 frequency = "mon",
@@ -303,7 +221,7 @@ if __name__ == '__main__':
             vmo = vmo_datadask_sel["vmo"].weighted(vmo_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nvmo: ", vmo)
             print("Saving vmo to: ", f'{outputdir}/vmo.nc')
-            vmo.to_netcdf(f'{outputdir}/vmo.nc', compute=True)
+            save_output(vmo, f'{outputdir}/vmo.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {ensemble} vmo')
             print(traceback.format_exc())
@@ -311,10 +229,11 @@ if __name__ == '__main__':
         # uo
         try:
             print("Loading uo data")
-            uo_datadask = select_latest_data(searched_cat,
+            uo_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "uo",
                 ensemble = ensemble,
                 frequency = "mon",
@@ -326,7 +245,7 @@ if __name__ == '__main__':
             uo = uo_datadask_sel["uo"].weighted(uo_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nuo: ", uo)
             print("Saving uo to: ", f'{outputdir}/uo.nc')
-            uo.to_netcdf(f'{outputdir}/uo.nc', compute=True)
+            save_output(uo, f'{outputdir}/uo.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {ensemble} uo')
             print(traceback.format_exc())
@@ -334,10 +253,11 @@ if __name__ == '__main__':
         # vo
         try:
             print("Loading vo data")
-            vo_datadask = select_latest_data(searched_cat,
+            vo_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "vo",
                 ensemble = ensemble,
                 frequency = "mon",
@@ -349,7 +269,7 @@ if __name__ == '__main__':
             vo = vo_datadask_sel["vo"].weighted(vo_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nvo: ", vo)
             print("Saving vo to: ", f'{outputdir}/vo.nc')
-            vo.to_netcdf(f'{outputdir}/vo.nc', compute=True)
+            save_output(vo, f'{outputdir}/vo.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {ensemble} vo')
             print(traceback.format_exc())
@@ -357,10 +277,11 @@ if __name__ == '__main__':
         # mlotst dataset
         try:
             print("Loading mlotst data")
-            mlotst_datadask = select_latest_data(searched_cat,
+            mlotst_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "mlotst",
                 ensemble = ensemble,
                 frequency = "mon",
@@ -368,13 +289,16 @@ if __name__ == '__main__':
             print("\nmlotst_datadask: ", mlotst_datadask)
             print("Slicing mlotst for the time period")
             mlotst_datadask_sel = mlotst_datadask.sel(time=slice(start_time, end_time))
-            print("Averaging mlotst (mean of the yearly maximum of monthly data)")
-            mlotst_yearlymax = mlotst_datadask_sel.groupby("time.year").max(dim="time")
-            print("\nmlotst_yearlymax: ", mlotst_yearlymax)
-            mlotst = mlotst_yearlymax.mean(dim="year")
+            print("Averaging mlotst (mean of the yearly maximum of monthly data) and maximum in a single pass")
+            mlotst, mlotst_max = yearlymax_reduction(mlotst_datadask_sel["mlotst"])
             print("\nmlotst: ", mlotst)
-            print("Saving mlotst to: ", f'{outputdir}/mlotst.nc')
-            mlotst.to_netcdf(f'{outputdir}/mlotst.nc', compute=True)
+            print("\nmlotst_max: ", mlotst_max)
+            write_outputs(
+                dict(mlotst=mlotst.to_dataset(name="mlotst"), mlotst_max=mlotst_max.to_dataset(name="mlotst")),
+                outputdir,
+                label=f'{model} {ensemble}',
+                profile="matrix-build",
+            )
         except Exception:
             print(f'Error processing {model} {ensemble} mlotst')
             print(traceback.format_exc())
@@ -382,10 +306,11 @@ if __name__ == '__main__':
         # thetao dataset
         try:
             print("Loading thetao data")
-            thetao_datadask = select_latest_data(searched_cat,
+            thetao_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "thetao",
                 ensemble = ensemble,
                 frequency = "mon",
@@ -397,7 +322,7 @@ if __name__ == '__main__':
             thetao = thetao_datadask_sel.weighted(thetao_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nthetao: ", thetao)
             print("Saving thetao to: ", f'{outputdir}/thetao.nc')
-            thetao.to_netcdf(f'{outputdir}/thetao.nc', compute=True)
+            save_output(thetao, f'{outputdir}/thetao.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {ensemble} thetao')
             print(traceback.format_exc())
@@ -405,10 +330,11 @@ if __name__ == '__main__':
         # so dataset
         try:
             print("Loading so data")
-            so_datadask = select_latest_data(searched_cat,
+            so_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "so",
                 ensemble = ensemble,
                 frequency = "mon",
@@ -420,7 +346,7 @@ if __name__ == '__main__':
             so = so_datadask_sel.weighted(so_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nso: ", so)
             print("Saving so to: ", f'{outputdir}/so.nc')
-            so.to_netcdf(f'{outputdir}/so.nc', compute=True)
+            save_output(so, f'{outputdir}/so.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {ensemble} so')
             print(traceback.format_exc())
@@ -428,10 +354,11 @@ if __name__ == '__main__':
         # agessc dataset
         try:
             print("Loading agessc data")
-            agessc_datadask = select_latest_data(searched_cat,
+            agessc_datadask = open_manifest_data(manifest,
                 dict(
                     chunks={'time': -1, 'lev':-1}
                 ),
+                xmip_preprocessing = False, # <- xmip does not work for CMIP5 data ATM
                 variable = "agessc",
                 ensemble = ensemble,
                 frequency = "mon",
@@ -443,7 +370,7 @@ if __name__ == '__main__':
             agessc = agessc_datadask_sel["agessc"].weighted(agessc_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nagessc: ", agessc)
             print("Saving agessc to: ", f'{outputdir}/agessc.nc')
-            agessc.to_netcdf(f'{outputdir}/agessc.nc', compute=True)
+            save_output(agessc, f'{outputdir}/agessc.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {ensemble} agessc')
             print(traceback.format_exc())
@@ -454,4 +381,3 @@ if __name__ == '__main__':
 
 
 
-
@@ -1,52 +1,28 @@
 
-# import sys to access script arguments (experiment, ensemble, first_year, last_year)
-import sys
-
 # Ignore warnings
 from os import environ
 environ["PYTHONWARNINGS"] = "ignore"
 PROJECT = environ["PROJECT"]
 
-# Import makedirs to create directories where I write new files
-from os import makedirs, listdir
-
-# Load dask
-from dask.distributed import Client
-
-# Load intake and cosima cookbook
-import intake
+# Import makedirs/rmdir to create (and remove) directories where I write new files
+from os import makedirs, rmdir
 
 # Load xarray for N-dimensional arrays
 import xarray as xr
 
-# Load datetime to deal with time formats
-import datetime
-
 # Load traceback to print exceptions
 import traceback
 
-# Load pandas for data manipulation
-import pandas as pd
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.cluster import make_client
+from tmip.forcing import YEAR_CHUNKS, monthly_speed_squared
+from tmip.averaging import write_tasks
+from tmip.output import save_output, output_exists, open_outputs, remove_output
 
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def select_data(cat, xarray_open_kwargs, **kwargs):
-    selectedcat = cat.search(**kwargs)
-    print("\nselectedcat: ", selectedcat)
-    xarray_combine_by_coords_kwargs=dict(
-        compat="override",
-        data_vars="minimal",
-        coords="minimal"
-    )
-    datadask = selectedcat.to_dask(
-        xarray_open_kwargs=xarray_open_kwargs,
-        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
-        parallel=True,
-    )
-    return datadask
-
 # directory to save the data to (as NetCDF)
 outputdir = f'/scratch/{PROJECT}/TMIP/data/JRA55-do-1p4'
 print("Creating directory: ", outputdir)
@@ -58,59 +34,82 @@ vasinputdir = f'{inputdir}/vas/gr/v20190429'
 years = range(1958, 2018 + 1)
 
 
-# keyword arguments to open_mfdataset
-kwargs = dict(
-    # chunks={'time':-1, 'st_ocean':-1},
-    concat_dim="time",
-    compat='override',
-    preprocess=None,
-    engine='netcdf4',
-    data_vars='minimal',
-    coords='minimal',
-    combine='nested',
-    parallel=True,
-    join='outer',
-    attrs_file=None,
-    combine_attrs='override',
-)
+# Years to reduce at the same time (bounded number of files being read/written)
+max_in_flight = 8
+
+# Per-year monthly means (intermediate files, kept until the concatenated output is saved
+# so that a restarted job skips done years, and removed after)
+yeardir = f'{outputdir}/years'
+
+def year_timestr(year):
+    """
+    return the time range string of the files of `year`
+    """
+    return f'{year:04d}01010000-{year:04d}12312100'
+
+def year_inputs(year):
+    """
+    return the lazily opened (uas, vas) of `year`
+    """
+    timestr = year_timestr(year)
+    uaspath = f'{uasinputdir}/uas_input4MIPs_atmosphericState_OMIP_MRI-JRA55-do-1-4-0_gr_{timestr}.nc'
+    vaspath = f'{vasinputdir}/vas_input4MIPs_atmosphericState_OMIP_MRI-JRA55-do-1-4-0_gr_{timestr}.nc'
+    uas = xr.open_dataset(uaspath, chunks=YEAR_CHUNKS)
+    vas = xr.open_dataset(vaspath, chunks=YEAR_CHUNKS)
+    return uas.uas, vas.vas
+
+def year_task(year):
+    """
+    return the (path, build) task of the monthly means of uas² + vas² of `year`
+    """
+    def build():
+        print(f'Loading uas and vas data of {year}')
+        uas, vas = year_inputs(year)
+        # monthly means of uas² + vas² (squared sum and monthly mean fused in one kernel)
+        return monthly_speed_squared(uas, vas).to_dataset()
+    return f'{yeardir}/u2_{year_timestr(year)}.nc', build
+
+# Single time-concatenated, compressed output
+u2path = f'{outputdir}/u2_{years[0]:04d}01-{years[-1]:04d}12.nc'
 
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=48, threads_per_worker=1) #, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
-
-    for year in years
-        print(f'Processing year: {year}')
-        timestr = f'{year:04d}01010000-{year:04d}12312100'
-
-        uaspath = f'{uasinputdir}/uas_input4MIPs_atmosphericState_OMIP_MRI-JRA55-do-1-4-0_gr_{timestr}.nc'
-        vaspath = f'{vasinputdir}/vas_input4MIPs_atmosphericState_OMIP_MRI-JRA55-do-1-4-0_gr_{timestr}.nc'
-
-    # monthly means of uas² + vas²
-        try:
-            print("Loading uas data")
-            uas = xr.open_dataset(uaspath, **kwargs)
-            print("\nuas: ", uas)
-            print("Loading vas data")
-            vas = xr.open_dataset(vaspath, **kwargs)
-            print("\nvas: ", vas)
-            print("Performing u² = uas² + vas² (lazily?)")
-            u2 = uas.uas**2 + vas.vas**2 # should work (uas + vas colocated)
-            print("\nu2: ", u2)
-            print("Averaging u2 monthly")
-            u2_month = u2.resample(time="1M").mean(keep_attrs=True)
-            print("\nu2_month: ", u2_month)
-            print("Saving u2 to: ", f'{outputdir}/u2_{timestr}.nc')
-            u2_month.to_netcdf(f'{outputdir}/u2_{timestr}.nc', compute=True)
-        except Exception:
-            print(f'Error processing uas and vas data')
-            print(traceback.format_exc())
-
-    client.close()
-
-
-
-
+    if output_exists(u2path):
+        print("Already saved: ", u2path)
+    else:
+        # Start the cluster, sized from the chunks of a year of uas and vas
+        # (opened lazily, all years have the same chunks)
+        print("Starting client")
+        client = make_client(*year_inputs(years[0]), max_workers=48)
+
+        print("Creating directory: ", yeardir)
+        makedirs(yeardir, exist_ok=True)
+
+        # Submit every year at once (with at most `max_in_flight` years being written)
+        tasks = [year_task(year) for year in years]
+        yearpaths = [path for path, _ in tasks]
+        todo = [(path, build) for path, build in tasks if not output_exists(path)]
+        print(f'Reducing {len(todo)} years ({len(tasks) - len(todo)} already done)')
+        write_tasks(client, todo, max_in_flight=max_in_flight, profile="derived")
+
+        # Concatenate all years, then remove the per-year files
+        missing = [path for path in yearpaths if not output_exists(path)]
+        if missing:
+            print(f'Not concatenating: {len(missing)} years are missing, e.g., {missing[0]}')
+        else:
+            try:
+                u2 = open_outputs(yearpaths, chunks={'time':-1})
+                print("\nu2: ", u2)
+                print("Saving u2 to: ", u2path)
+                save_output(u2, u2path, "derived", compute=True)
+                print("Removing per-year files from: ", yeardir)
+                for path in yearpaths:
+                    remove_output(path)
+                rmdir(yeardir)
+            except Exception:
+                print('Error concatenating u2 data')
+                print(traceback.format_exc())
+
+        client.close()
@@ -27,15 +27,9 @@ print("Time window: ", year_start, " to ", year_start + num_years - 1)
 import os
 os.environ["PYTHONWARNINGS"] = "ignore"
 
-# Load dask
-from dask.distributed import Client
-
 # import glob for searching directories
 from glob import glob
 
-# Load xarray for N-dimensional arrays
-import xarray as xr
-
 # Load traceback to print exceptions
 import traceback
 
@@ -43,59 +37,30 @@ import traceback
 # from xmip.preprocessing import combined_preprocessing
 
 
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.timewindow import time_window_strings
+from tmip.io import open_my_dataset
+from tmip.output import save_output
+from tmip.cluster import make_client
+from tmip.layout import SCRATCH_DATADIR, GDATA_DATADIR, OutputKey, output_dir, output_path, window_string, CMIP6_member, CSIRO_member
+
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def time_window_strings(year_start, num_years):
-    """
-    return strings for start_time and end_time
-    """
-    # start_time is first second of year_start
-    start_time = f'{year_start}'
-    # end_time is last second of last_year
-    end_time = f'{year_start + num_years - 1}'
-    # Return the weighted average
-    return start_time, end_time
-
-def CMIP6_member(member):
-    return f'r{member}i1p1f1'
-
-def CSIRO_experiment(experiment):
-    if experiment == 'historical':
-        return 'HI'
-    else:
-        return 'SSP-370'
-
-def CSIRO_member(experiment, member):
-    return f'{CSIRO_experiment(experiment)}-{member+4:02d}' # note the +4!
-
-def open_my_dataset(paths):
-    ds = xr.open_mfdataset(
-        paths,
-        chunks={'time':-1, 'st_ocean':-1},
-        concat_dim="time",
-        compat='override',
-        preprocess=None,
-        engine='netcdf4',
-        data_vars='minimal',
-        coords='minimal',
-        combine='nested',
-        parallel=True,
-        join='outer',
-        attrs_file=None,
-        combine_attrs='override',
-    )
-    return ds
+# (CMIP6_member/CSIRO_member labels, e.g., r1i1p1f1 is HI-05, are in tmip.layout)
+def archivepathfun(member, variable, decade):
+    return output_path(OutputKey("archive", model, experiment, CSIRO_member(experiment, member), variable=variable, decade=decade), gdatadatadir)
 
 # Create directory on scratch to save the data
-scratchdatadir = '/scratch/xv83/TMIP/data'
-gdatadatadir = '/g/data/xv83/TMIP/data'
+scratchdatadir = SCRATCH_DATADIR
+gdatadatadir = GDATA_DATADIR
 
 # Depends on time window
 start_time, end_time = time_window_strings(year_start, num_years)
 start_time_str = f'Jan{start_time}'
 end_time_str = f'Dec{end_time}'
+window = window_string(year_start, num_years)
 
 # decades for which files to read (saved for each decade)
 decade_start = year_start - year_start % 10
@@ -106,11 +71,18 @@ decades = range(decade_start, year_start + num_years, 10)
 members = [5, 6, 7, 8]
 
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=44, threads_per_worker=1) #, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
+    # Start the cluster, sized from the chunks of the archived tx_trans_gm of the first member
+    # (opened lazily, all members and variables have the same chunks)
+    inputs = []
+    try:
+        inputs.append(open_my_dataset([archivepathfun(members[0], "tx_trans_gm", decade) for decade in decades]))
+    except Exception:
+        print(f'Error loading {model} tx_trans_gm to size the cluster')
+        print(traceback.format_exc())
+    print("Starting client")
+    client = make_client(*inputs, max_workers=44)
 
     for member in members:
 
@@ -118,15 +90,15 @@ if __name__ == '__main__':
         print(f"\nProcessing {CSIRO_member(experiment, member)} as {CMIP6_member(member)}")
 
         # directory to save the data to (as NetCDF)
-        inputdir = f'{gdatadatadir}/{model}/{experiment}/{CSIRO_member(experiment, member)}'
-        outputdir = f'{scratchdatadir}/{model}/{experiment}/{CMIP6_member(member)}/{start_time_str}-{end_time_str}'
+        inputdir = output_dir(OutputKey("archive", model, experiment, CSIRO_member(experiment, member)), gdatadatadir)
+        outputdir = output_dir(OutputKey("average", model, experiment, CMIP6_member(member), window), scratchdatadir)
         print("Creating directory: ", outputdir)
         os.makedirs(outputdir, exist_ok=True)
         print("  averaging data from: ", inputdir)
         print("  to be saved in: ", outputdir)
 
         # tx_trans_gm
-        paths = [f'{inputdir}/month_tx_trans_gm_{decade}s.nc' for decade in decades]
+        paths = [archivepathfun(member, "tx_trans_gm", decade) for decade in decades]
         try:
             print("    Loading tx_trans_gm")
             tx_trans_gm_ds = open_my_dataset(paths)
@@ -136,13 +108,13 @@ if __name__ == '__main__':
             tx_trans_gm = tx_trans_gm_sel["tx_trans_gm"].weighted(tx_trans_gm_sel.time.dt.days_in_month).mean(dim="time")
             print("\ntx_trans_gm: ", tx_trans_gm)
             print("      saving to: ", f'{outputdir}/tx_trans_gm.nc')
-            tx_trans_gm.to_netcdf(f'{outputdir}/tx_trans_gm.nc', compute=True)
+            save_output(tx_trans_gm, f'{outputdir}/tx_trans_gm.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {CSIRO_member(experiment, member)}/{CMIP6_member(member)} tx_trans_gm')
             print(traceback.format_exc())
 
         # ty_trans_gm
-        paths = [f'{inputdir}/month_ty_trans_gm_{decade}s.nc' for decade in decades]
+        paths = [archivepathfun(member, "ty_trans_gm", decade) for decade in decades]
         try:
             print("    Loading ty_trans_gm")
             ty_trans_gm_ds = open_my_dataset(paths)
@@ -152,13 +124,13 @@ if __name__ == '__main__':
             ty_trans_gm = ty_trans_gm_sel["ty_trans_gm"].weighted(ty_trans_gm_sel.time.dt.days_in_month).mean(dim="time")
             print("\nty_trans_gm: ", ty_trans_gm)
             print("      saving to: ", f'{outputdir}/ty_trans_gm.nc')
-            ty_trans_gm.to_netcdf(f'{outputdir}/ty_trans_gm.nc', compute=True)
+            save_output(ty_trans_gm, f'{outputdir}/ty_trans_gm.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {CSIRO_member(experiment, member)}/{CMIP6_member(member)} ty_trans_gm')
             print(traceback.format_exc())
 
         # tx_trans_submeso
-        paths = [f'{inputdir}/month_tx_trans_submeso_{decade}s.nc' for decade in decades]
+        paths = [archivepathfun(member, "tx_trans_submeso", decade) for decade in decades]
         try:
             print("    Loading tx_trans_submeso")
             tx_trans_submeso_ds = open_my_dataset(paths)
@@ -168,13 +140,13 @@ if __name__ == '__main__':
             tx_trans_submeso = tx_trans_submeso_sel["tx_trans_submeso"].weighted(tx_trans_submeso_sel.time.dt.days_in_month).mean(dim="time")
             print("\ntx_trans_submeso: ", tx_trans_submeso)
             print("      saving to: ", f'{outputdir}/tx_trans_submeso.nc')
-            tx_trans_submeso.to_netcdf(f'{outputdir}/tx_trans_submeso.nc', compute=True)
+            save_output(tx_trans_submeso, f'{outputdir}/tx_trans_submeso.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {CSIRO_member(experiment, member)}/{CMIP6_member(member)} tx_trans_submeso')
             print(traceback.format_exc())
 
         # ty_trans_submeso
-        paths = [f'{inputdir}/month_ty_trans_submeso_{decade}s.nc' for decade in decades]
+        paths = [archivepathfun(member, "ty_trans_submeso", decade) for decade in decades]
         try:
             print("    Loading ty_trans_submeso")
             ty_trans_submeso_ds = open_my_dataset(paths)
@@ -184,7 +156,7 @@ if __name__ == '__main__':
             ty_trans_submeso = ty_trans_submeso_sel["ty_trans_submeso"].weighted(ty_trans_submeso_sel.time.dt.days_in_month).mean(dim="time")
             print("\nty_trans_submeso: ", ty_trans_submeso)
             print("      saving to: ", f'{outputdir}/ty_trans_submeso.nc')
-            ty_trans_submeso.to_netcdf(f'{outputdir}/ty_trans_submeso.nc', compute=True)
+            save_output(ty_trans_submeso, f'{outputdir}/ty_trans_submeso.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {CSIRO_member(experiment, member)}/{CMIP6_member(member)} ty_trans_submeso')
             print(traceback.format_exc())
@@ -193,5 +165,3 @@ if __name__ == '__main__':
 
 
 
-
-
@@ -47,9 +47,6 @@ environ["PYTHONWARNINGS"] = "ignore"
 # Import makedirs to create directories where I write new files
 from os import makedirs
 
-# Load dask
-from dask.distributed import Client
-
 # Load intake and cosima cookbook
 import intake
 
@@ -59,9 +56,11 @@ import xarray as xr
 # Load datetime to deal with time formats
 import datetime
 
-# Load xmip for preprocessing (trying to get consistent metadata for making matrices down the road)
-from xmip.preprocessing import combined_preprocessing
-
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalog import select_latest_data, sort_members
+from tmip.averaging import yearlymax_reduction
+from tmip.output import save_output
+from tmip.cluster import make_client
 
 # 2. Define some functions
 # (to avoid too much boilerplate code)
@@ -78,40 +77,6 @@ def time_window_strings(year_end, num_years, time_type = datetime.datetime):
     # Return the weighted average
     return start_time, end_time
 
-def find_latest_version(cat):
-    """
-    find latest version of selected data
-    """
-    sorted_versions = cat.df.version.to_list()
-    sorted_versions.sort()
-    latest_version = sorted_versions[-1]
-    return latest_version
-
-def select_latest_cat(cat, **kwargs):
-    """
-    search latest version of selected data
-    """
-    selectedcat = cat.search(**kwargs)
-    latestselectedcat = selectedcat.search(version=find_latest_version(selectedcat))
-    return latestselectedcat
-
-def select_latest_data(cat, xarray_open_kwargs, **kwargs):
-    latestselectedcat = select_latest_cat(cat, **kwargs)
-    xarray_combine_by_coords_kwargs=dict(
-        compat="override",
-        data_vars="minimal",
-        coords="minimal"
-    )
-    datadask = latestselectedcat.to_dask(
-        xarray_open_kwargs=xarray_open_kwargs,
-        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
-        parallel=True,
-        preprocess=combined_preprocessing,
-    )
-    return datadask
-
-
-
 # 3. Load catalog
 
 cat_str = "/g/data/dk92/catalog/v2/esm/cmip6-fs38/catalog.json" # <- this is the catalog for ACCESS CMIP6 output at NCI
@@ -128,16 +93,6 @@ searched_cat = cat.search(
 
 members = searched_cat.df.member_id.unique()
 # sort members that are formatted as "r%di%dp%df%d" where %d is a integer
-import re
-
-def extract_numbers(member):
-    # Extract integers from the string using regex
-    return list(map(int, re.findall(r'\d+', member)))
-
-def sort_members(members):
-    # Sort members using the custom key function
-    return sorted(members, key=extract_numbers)
-
 # print members on one line each
 sorted_members = sort_members(members)
 print("\n".join(sorted_members))
@@ -149,11 +104,20 @@ datadir = '/scratch/xv83/TMIP/data'
 
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=4)#, threads_per_worker=1, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
+    # Start the cluster, sized from the chunks of umo of the first member
+    # (opened lazily, the 3D variables of all members have the same chunks)
+    umo_sample = select_latest_data(searched_cat,
+        dict(
+            chunks={'i': 60, 'j': 60, 'time': -1, 'lev':50}
+        ),
+        variable_id = "umo",
+        member_id = sorted_members[0],
+        frequency = "mon",
+    )
+    print("Starting client")
+    client = make_client(umo_sample, max_workers=4)
 
     for member in sorted_members:
 
@@ -256,8 +220,8 @@ if __name__ == '__main__':
 
 
         # Save the fixed data to NetCDF
-        volcello_datadask.to_netcdf(f'{outputdir}/volcello.nc', compute=True)
-        areacello_datadask.to_netcdf(f'{outputdir}/areacello.nc', compute=True)
+        save_output(volcello_datadask, f'{outputdir}/volcello.nc', "matrix-build", compute=True)
+        save_output(areacello_datadask, f'{outputdir}/areacello.nc', "matrix-build", compute=True)
 
 
         # Slice umo dataset for the time period
@@ -280,24 +244,21 @@ if __name__ == '__main__':
 
         # Slice mlotst dataset for the time period
         mlotst_datadask_sel = mlotst_datadask.sel(time=slice(start_time, end_time))
-        # Take the time mean of the yearly maximum of mlotst
-        mlotst_yearlymax = mlotst_datadask_sel.groupby("time.year").max(dim="time")
-        # print("\nmlotst_yearlymax: ", mlotst_yearlymax)
-
-        mlotst = mlotst_yearlymax.mean(dim="year")
+        # Take the time mean of the yearly maximum of mlotst (single streaming pass)
+        mlotst, _ = yearlymax_reduction(mlotst_datadask_sel["mlotst"])
+        mlotst = mlotst.to_dataset(name="mlotst")
         # print("\nmlotst: ", mlotst)
 
 
         # Save the averaged data to NetCDF
         print("Saving averaged data to NetCDF")
-        umo.to_netcdf(f'{outputdir}/umo.nc', compute=True)
-        vmo.to_netcdf(f'{outputdir}/vmo.nc', compute=True)
-        agessc.to_netcdf(f'{outputdir}/agessc.nc', compute=True)
-        mlotst.to_netcdf(f'{outputdir}/mlotst.nc', compute=True)
+        save_output(umo, f'{outputdir}/umo.nc', "matrix-build", compute=True)
+        save_output(vmo, f'{outputdir}/vmo.nc', "matrix-build", compute=True)
+        save_output(agessc, f'{outputdir}/agessc.nc', "matrix-build", compute=True)
+        save_output(mlotst, f'{outputdir}/mlotst.nc', "matrix-build", compute=True)
 
 
     client.close()
 
 
 
-
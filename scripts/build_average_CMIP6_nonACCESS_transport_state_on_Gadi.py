@@ -59,86 +59,32 @@ environ["PYTHONWARNINGS"] = "ignore"
 # Import makedirs to create directories where I write new files
 from os import makedirs
 
-# Load dask
-from dask.distributed import Client
-
-# Load intake and cosima cookbook
-import intake
-
 # Load xarray for N-dimensional arrays
 import xarray as xr
 
 # Load datetime to deal with time formats
 import datetime
 
-# Load xmip for preprocessing (trying to get consistent metadata for making matrices down the road)
-from xmip.preprocessing import combined_preprocessing
-
 # Load traceback to print exceptions
 import traceback
 
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalogcache import cached_search
+from tmip.timewindow import time_window_strings
+from tmip.catalog import select_latest_data, sort_members
+from tmip.averaging import yearlymax_reduction, write_outputs
+from tmip.output import save_output
+from tmip.cluster import make_client
+
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def time_window_strings(year_start, num_years):
-    """
-    return strings for start_time and end_time
-    """
-    # start_time is first second of year_start
-    start_time = f'{year_start}'
-    # end_time is last second of last_year
-    end_time = f'{year_start + num_years - 1}'
-    # Return the weighted average
-    return start_time, end_time
-
-def find_latest_version(cat):
-    """
-    find latest version of selected data
-    """
-    sorted_versions = cat.df.version.to_list()
-    sorted_versions.sort()
-    latest_version = sorted_versions[-1]
-    return latest_version
-
-def select_latest_cat(cat, **kwargs):
-    """
-    search latest version of selected data
-    """
-    selectedcat = cat.search(**kwargs)
-    # if dataframe is empty, error
-    if selectedcat.df.empty:
-        raise ValueError(f"No data found for {kwargs}")
-
-    latestselectedcat = selectedcat.search(version=find_latest_version(selectedcat))
-    return latestselectedcat
-
-def select_latest_data(cat, xarray_open_kwargs, **kwargs):
-    latestselectedcat = select_latest_cat(cat, **kwargs)
-    print("\nlatestselectedcat: ", latestselectedcat)
-    xarray_combine_by_coords_kwargs=dict(
-        compat="override",
-        data_vars="minimal",
-        coords="minimal"
-    )
-    datadask = latestselectedcat.to_dask(
-        xarray_open_kwargs=xarray_open_kwargs,
-        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
-        parallel=True,
-        preprocess=combined_preprocessing,
-    )
-    return datadask
-
-
-
 # 3. Load catalog
 
-catalogs = intake.cat.access_nri
-cat = catalogs["cmip6_oi10"]
-print(cat)
-
 # Only keep the required data
-searched_cat = cat.search(
+# (the search result is cached on disk and reused by all jobs, see tmip/catalogcache.py)
+searched_cat = cached_search("cmip6_oi10",
     source_id = model,
     experiment_id = experiment,
     # member_id = ensemble,
@@ -151,16 +97,6 @@ print(searched_cat)
 members = searched_cat.df.member_id.unique()
 
 # sort members that are formatted as "r%di%dp%df%d" where %d is a integer
-import re
-
-def extract_numbers(member):
-    # Extract integers from the string using regex
-    return list(map(int, re.findall(r'\d+', member)))
-
-def sort_members(members):
-    # Sort members using the custom key function
-    return sorted(members, key=extract_numbers)
-
 sorted_members = sort_members(members)
 # print members on one line each
 print("\n".join(sorted_members))
@@ -176,11 +112,25 @@ end_time_str = f'Dec{end_time}'
 
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=4)#, threads_per_worker=1, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
+    # Start the cluster, sized from the chunks of umo of the first member
+    # (opened lazily, the 3D variables of all members have the same chunks)
+    inputs = []
+    try:
+        inputs.append(select_latest_data(searched_cat,
+            dict(
+                chunks={'time': -1, 'lev':-1}
+            ),
+            variable_id = "umo",
+            member_id = sorted_members[0],
+            frequency = "mon",
+        ))
+    except Exception:
+        print(f'Error loading {model} umo to size the cluster')
+        print(traceback.format_exc())
+    print("Starting client")
+    client = make_client(*inputs, max_workers=4)
 
     for member in sorted_members:
 
@@ -205,7 +155,7 @@ if __name__ == '__main__':
             print("\nvolcello_datadask: ", volcello_datadask)
             volcello_file = f'{outputdir}/volcello.nc'
             print("Saving volcello to: ", volcello_file)
-            volcello_datadask.to_netcdf(volcello_file, compute=True)
+            save_output(volcello_datadask, volcello_file, "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {member} volcello')
             print(traceback.format_exc())
@@ -225,7 +175,7 @@ if __name__ == '__main__':
             print("\nareacello_datadask: ", areacello_datadask)
             areacello_file = f'{outputdir}/areacello.nc'
             print("Saving areacello to: ", areacello_file)
-            areacello_datadask.to_netcdf(areacello_file, compute=True)
+            save_output(areacello_datadask, areacello_file, "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {member} areacello')
             print(traceback.format_exc())
@@ -249,7 +199,7 @@ if __name__ == '__main__':
             umo = umo_datadask_sel["umo"].weighted(umo_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\numo: ", umo)
             print("Saving umo to: ", f'{outputdir}/umo.nc')
-            umo.to_netcdf(f'{outputdir}/umo.nc', compute=True)
+            save_output(umo, f'{outputdir}/umo.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {member} umo')
             print(traceback.format_exc())
@@ -272,7 +222,7 @@ if __name__ == '__main__':
             vmo = vmo_datadask_sel["vmo"].weighted(vmo_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nvmo: ", vmo)
             print("Saving vmo to: ", f'{outputdir}/vmo.nc')
-            vmo.to_netcdf(f'{outputdir}/vmo.nc', compute=True)
+            save_output(vmo, f'{outputdir}/vmo.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {member} vmo')
             print(traceback.format_exc())
@@ -295,7 +245,7 @@ if __name__ == '__main__':
             uo = uo_datadask_sel["uo"].weighted(uo_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nuo: ", uo)
             print("Saving uo to: ", f'{outputdir}/uo.nc')
-            uo.to_netcdf(f'{outputdir}/uo.nc', compute=True)
+            save_output(uo, f'{outputdir}/uo.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {member} uo')
             print(traceback.format_exc())
@@ -318,7 +268,7 @@ if __name__ == '__main__':
             vo = vo_datadask_sel["vo"].weighted(vo_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nvo: ", vo)
             print("Saving vo to: ", f'{outputdir}/vo.nc')
-            vo.to_netcdf(f'{outputdir}/vo.nc', compute=True)
+            save_output(vo, f'{outputdir}/vo.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {member} vo')
             print(traceback.format_exc())
@@ -337,13 +287,16 @@ if __name__ == '__main__':
             print("\nmlotst_datadask: ", mlotst_datadask)
             print("Slicing mlotst for the time period")
             mlotst_datadask_sel = mlotst_datadask.sel(time=slice(start_time, end_time))
-            print("Averaging mlotst (mean of the yearly maximum of monthly data)")
-            mlotst_yearlymax = mlotst_datadask_sel.groupby("time.year").max(dim="time")
-            print("\nmlotst_yearlymax: ", mlotst_yearlymax)
-            mlotst = mlotst_yearlymax.mean(dim="year")
+            print("Averaging mlotst (mean of the yearly maximum of monthly data) and maximum in a single pass")
+            mlotst, mlotst_max = yearlymax_reduction(mlotst_datadask_sel["mlotst"])
             print("\nmlotst: ", mlotst)
-            print("Saving mlotst to: ", f'{outputdir}/mlotst.nc')
-            mlotst.to_netcdf(f'{outputdir}/mlotst.nc', compute=True)
+            print("\nmlotst_max: ", mlotst_max)
+            write_outputs(
+                dict(mlotst=mlotst.to_dataset(name="mlotst"), mlotst_max=mlotst_max.to_dataset(name="mlotst")),
+                outputdir,
+                label=f'{model} {member}',
+                profile="matrix-build",
+            )
         except Exception:
             print(f'Error processing {model} {member} mlotst')
             print(traceback.format_exc())
@@ -367,7 +320,7 @@ if __name__ == '__main__':
             agessc = agessc_datadask_sel["agessc"].weighted(agessc_datadask_sel.time.dt.days_in_month).mean(dim="time")
             print("\nagessc: ", agessc)
             print("Saving agessc to: ", f'{outputdir}/agessc.nc')
-            agessc.to_netcdf(f'{outputdir}/agessc.nc', compute=True)
+            save_output(agessc, f'{outputdir}/agessc.nc', "matrix-build", compute=True)
         except Exception:
             print(f'Error processing {model} {member} agessc')
             print(traceback.format_exc())
@@ -378,4 +331,3 @@ if __name__ == '__main__':
 
 
 
-
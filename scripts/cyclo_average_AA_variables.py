@@ -16,90 +16,23 @@ lumpby="month"
 import os
 os.environ["PYTHONWARNINGS"] = "ignore"
 
-# Load dask
-from dask.distributed import Client
-
-# Load xarray for N-dimensional arrays
-import xarray as xr
-
 # Load datetime to deal with time formats
 import datetime
 
 # Load traceback to print exceptions
 import traceback
 
-# Import numpy
-import numpy as np
-
-# Load pandas for data manipulation
-import pandas as pd
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.io import open_my_dataset
+from tmip.climatology import climatology
+from tmip.timewindow import time_window_strings
+from tmip.output import save_output
+from tmip.cluster import make_client
 
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
-def open_my_dataset(paths):
-    ds = xr.open_mfdataset(
-        paths,
-        chunks={'time':-1, 'st_ocean':-1},
-        concat_dim="time",
-        compat='override',
-        preprocess=None,
-        engine='netcdf4',
-        data_vars='minimal',
-        coords='minimal',
-        combine='nested',
-        parallel=True,
-        join='outer',
-        attrs_file=None,
-        combine_attrs='override',
-    )
-    return ds
-
-def season_climatology(ds):
-    # Make a DataArray with the number of days in each month, size = len(time)
-    month_length = ds.time.dt.days_in_month
-    # Calculate the weights by grouping by 'time.season'
-    weights = month_length.groupby("time.season") / month_length.groupby("time.season").sum()
-    # Test that the sum of the weights for each season is 1.0
-    np.testing.assert_allclose(weights.groupby("time.season").sum().values, np.ones(4))
-    # Calculate the weighted average
-    return (ds * weights).groupby("time.season").sum(dim="time")
-
-def month_climatology(ds):
-    # Make a DataArray with the number of days in each month, size = len(time)
-    month_length = ds.time.dt.days_in_month
-    # Calculate the weights by grouping by 'time.season'
-    weights = month_length.groupby("time.month") / month_length.groupby("time.month").sum()
-    # Test that the sum of the weights for each month is 1.0
-    np.testing.assert_allclose(weights.groupby("time.month").sum().values, np.ones(12))
-    # Calculate the weighted average
-    ds_out = (ds * weights).groupby("time.month").sum(dim="time")
-    # Keep track of mean number of days per month
-    mean_days_in_month = month_length.groupby("time.month").mean()
-    # And assign it to new coordinate
-    ds_out = ds_out.assign_coords(mean_days_in_month=('month', mean_days_in_month.data))
-    return ds_out
-
-def climatology(ds, lumpby):
-    if lumpby == "month":
-        return month_climatology(ds)
-    elif lumpby == "season":
-        return season_climatology(ds)
-    else:
-        raise ValueError(f"lumpby has to be month or season")
-
-def time_window_strings(year_start, num_years):
-    """
-    return strings for start_time and end_time
-    """
-    # start_time is first second of year_start
-    start_time = f'{year_start}'
-    # end_time is last second of last_year
-    end_time = f'{year_start + num_years - 1}'
-    # Return the weighted average
-    return start_time, end_time
-
 # Create directory on scratch to save the data
 scratchdatadir = '/scratch/xv83/TMIP/data'
 AAdatadir = '/scratch/xv83/bp3051/access-esm/archive/andersonacceleration_test-n10-5415f621/'
@@ -115,11 +48,8 @@ simyears = range(10) # AA cycles of 10 years
 
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == '__main__':
-    client = Client(n_workers=44, threads_per_worker=1)#, memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
 
     # print ensemble/member
     print(f"\nProcessing AA output")
@@ -224,19 +154,32 @@ if __name__ == '__main__':
     #     print(f'Error processing AA ty_trans_submeso')
     #     print(traceback.format_exc())
 
+    # Lazy inputs, to size the cluster from their chunks
+    inputs = []
     # mlotst dataset
     paths = [f'{AAdatadir}/output00{simyear}/ocean/ocean-2d-mld-1monthly-mean-ym_185{simyear}_01.nc' for simyear in simyears]
     try:
         print("Loading mlotst data")
         mlotst_ds = open_my_dataset(paths)
         print("\nmlotst_ds: ", mlotst_ds)
+        inputs.append(mlotst_ds)
+    except Exception:
+        print(f'Error loading {model} mlotst')
+        print(traceback.format_exc())
+
+    # Start the cluster, sized from the chunks of the inputs
+    # (they are only opened lazily above, nothing is computed before this)
+    print("Starting client")
+    client = make_client(*inputs, max_workers=44)
+
+    try:
         print("Slicing mlotst for the time period")
         mlotst_ds_sel = mlotst_ds.sel(time=slice(start_time, end_time))
         print(f"Averaging mlotst over each {lumpby}")
         mlotst = climatology(mlotst_ds_sel["mld"], lumpby)
         print("\nmlotst: ", mlotst)
         print("Saving mlotst to: ", f'{outputdir}/mlotst.nc')
-        mlotst.to_dataset(name='mlotst').to_netcdf(f'{outputdir}/mlotst.nc', compute=True)
+        save_output(mlotst.to_dataset(name='mlotst'), f'{outputdir}/mlotst.nc', "matrix-build", compute=True)
     except Exception:
         print(f'Error processing {model} {member} mlotst')
         print(traceback.format_exc())
@@ -245,4 +188,3 @@ if __name__ == '__main__':
 
 
 
-
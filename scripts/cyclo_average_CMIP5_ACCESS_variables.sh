@@ -32,9 +32,10 @@ year_start=1990
 num_years=10
 # lumpby=month
 lumpby=season
+max_writes=8 # number of member x variable climatologies written concurrently (1 = one at a time)
 
 echo "Running transport-state script"
-python3 scripts/cyclo_average_CMIP5_ACCESS_variables.py $model $experiment $ensemble $year_start $num_years $lumpby \
+python3 scripts/cyclo_average_CMIP5_ACCESS_variables.py $model $experiment $ensemble $year_start $num_years $lumpby $max_writes \
 &> output/cyclo.$lumpby.$experiment.$model.allensembles.$year_start.$num_years.$PBS_JOBID.out
 
 
@@ -37,9 +37,10 @@ num_years=10
 lumpby=month
 # lumpby=season
 ensemble=r1i1p1f1 # <- note that this is not used in the script
+max_writes=8 # number of member x variable climatologies written concurrently (1 = one at a time)
 
 echo "Running transport-state script"
-python3 scripts/cyclo_average_CMIP6_ACCESS_variables.py $model $experiment $ensemble $year_start $num_years $lumpby \
+python3 scripts/cyclo_average_CMIP6_ACCESS_variables.py $model $experiment $ensemble $year_start $num_years $lumpby $max_writes \
 &> output/cyclo_average_CMIP6_ACCESS_variables.$model.$experiment.$year_start.$num_years.$PBS_JOBID.out
 
 
@@ -0,0 +1,84 @@
+
+
+# import sys to access script arguments (experiment, ensemble, first_year, last_year)
+import sys
+
+# For interactive use only
+model = "ACCESS-ESM1-5"
+experiment = "historical"
+year_start = 1990
+num_years = 10
+lumpby = "month"
+diagnostic = "age"
+
+
+# Model etc. defined from script input
+model = sys.argv[1]
+print("Model: ", model, " (type: ", type(model), ")")
+experiment = sys.argv[2]
+print("Experiment: ", experiment, " (type: ", type(experiment), ")")
+year_start = int(sys.argv[3])
+num_years = int(sys.argv[4])
+print("Time window: ", year_start, " to ", year_start + num_years - 1)
+lumpby = sys.argv[5] # "month" or "season"
+print("Lumping by", lumpby)
+diagnostic = sys.argv[6] # "age" or "reemergence"
+print("Diagnostic: ", diagnostic)
+
+# Member outputs (file name) and data variable of each diagnostic
+DIAGNOSTICS = dict(
+    age=("ideal_mean_age", "age"),
+    reemergence=("reemergence_time", "adjointage"),
+)
+variable, data_variable = DIAGNOSTICS[diagnostic]
+
+# 1. Load packages
+
+# Import os for makedirs/isfile/environ
+import os
+os.environ["PYTHONWARNINGS"] = "ignore"
+
+# # Load xmip for preprocessing (trying to get consistent metadata for making matrices down the road)
+# from xmip.preprocessing import combined_preprocessing
+
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.cluster import make_client
+from tmip.layout import SCRATCH_DATADIR, OutputKey, output_dir, window_string
+from tmip.ensemble import index_ensemble_outputs, open_ensemble, ensemble_timemean_diagnostics
+
+
+# Create directory on scratch to save the data
+scratchdatadir = SCRATCH_DATADIR
+
+# Depends on time window
+window = window_string(year_start, num_years)
+
+# Index every member output of the experiment (single walk of the output tree)
+ensemble_index = index_ensemble_outputs(model, experiment, scratchdatadir)
+
+
+outputdir = output_dir(OutputKey("ensemble", model, experiment, window=window, lumpby=lumpby), scratchdatadir)
+print("Creating directory: ", outputdir)
+os.makedirs(outputdir, exist_ok=True)
+print("  to be saved in: ", outputdir)
+
+# This `if` statement is required in scripts (not required in Jupyter)
+if __name__ == '__main__':
+    chunks = {'Ti':-1, 'lev':-1} # TODO these dim names likely won't work for my Gammas
+
+    # Start the cluster, sized from the chunks of the member outputs
+    # (the whole ensemble is only opened lazily here, nothing is computed before this)
+    print("Starting client")
+    client = make_client(open_ensemble(ensemble_index, variable, window, lumpby, chunks=chunks)[data_variable], max_workers=40)
+
+    # Ensemble mean/std/max/min, all-member time mean, and quantiles of the time mean of the diagnostic
+    ensemble_timemean_diagnostics(ensemble_index, variable, data_variable, window, lumpby, outputdir,
+        timedim = "Ti",
+        chunks = chunks,
+        label = model,
+    )
+
+
+
+    client.close()
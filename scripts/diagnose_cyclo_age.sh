@@ -34,7 +34,7 @@ lumpby=month
 
 
 echo "Running transport-state script"
-python3 scripts/diagnose_cyclo_age.py $model $experiment $year_start $num_years $lumpby \
+python3 scripts/diagnose_cyclo.py $model $experiment $year_start $num_years $lumpby age \
 &> output/cyclo.diagnose_cyclo_age.$PBS_JOBID.$model.$experiment.$year_start.$num_years.out
 
 
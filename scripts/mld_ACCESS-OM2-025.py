@@ -16,9 +16,6 @@ PROJECT = environ["PROJECT"]
 # Import makedirs to create directories where I write new files
 from os import makedirs
 
-# Load dask
-from dask.distributed import Client
-
 # Load intake and cosima cookbook
 import intake
 
@@ -34,41 +31,16 @@ import traceback
 # Load pandas for data manipulation
 import pandas as pd
 
-# Import numpy
-import numpy as np
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalog import select_data
+from tmip.output import save_output
+from tmip.cluster import make_client
 
 # 2. Define some functions
 # (to avoid too much boilerplate code)
 print("Defining functions")
 
 
-def select_data(cat, xarray_open_kwargs, **kwargs):
-    selectedcat = cat.search(**kwargs)
-    print("\nselectedcat: ", selectedcat)
-    xarray_combine_by_coords_kwargs = dict(
-        compat="override", data_vars="minimal", coords="minimal"
-    )
-    datadask = selectedcat.to_dask(
-        xarray_open_kwargs=xarray_open_kwargs,
-        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
-        parallel=True,
-    )
-    return datadask
-
-
-def yearlymeans(ds):
-    # Make a DataArray with the number of days in each month, size = len(time)
-    month_length = ds.time.dt.days_in_month
-    # Calculate the weights by grouping by 'time.year'
-    weights = (
-        month_length.groupby("time.year") / month_length.groupby("time.year").sum()
-    )
-    # Test that the sum of the weights for each year is 1.0
-    np.testing.assert_allclose(weights.groupby("time.year").sum().values, 1.0)
-    # Calculate the weighted average
-    return (ds * weights).groupby("time.year").sum(dim="time")
-
-
 # 3. Load catalog
 
 catalogs = intake.cat.access_nri
@@ -87,19 +59,17 @@ datadir = f"/scratch/{PROJECT}/TMIP/data"
 
 # 4. Load data, preprocess it, and save it to NetCDF
 
-print("Starting client")
-
 # This `if` statement is required in scripts (not required in Jupyter)
 if __name__ == "__main__":
-    client = Client(
-        n_workers=48, threads_per_worker=1
-    )  # , memory_limit='16GB') # Note: with 1thread/worker cannot plot thetao. Maybe I need to understand why?
 
     # directory to save the data to (as NetCDF)
     outputdir = f"{datadir}/{model}/{subcatalog}"
     print("Creating directory: ", outputdir)
     makedirs(outputdir, exist_ok=True)
 
+    # Lazy inputs, to size the cluster from their chunks
+    inputs = []
+
     # mld
     try:
         print("Loading mld data")
@@ -110,10 +80,24 @@ if __name__ == "__main__":
             frequency="1mon",
         )
         print("\nmld_datadask: ", mld_datadask)
+        inputs.append(mld_datadask.mld)
+    except Exception:
+        print(f"Error loading {model} mld")
+        print(traceback.format_exc())
+
+    # Start the cluster, sized from the chunks of mld
+    # (it is only opened lazily above, nothing is computed before this)
+    print("Starting client")
+    client = make_client(*inputs, max_workers=48)
+
+    try:
         print("Saving mld to: ", f"{outputdir}/mld.nc")
-        mld_datadask.mld.to_netcdf(
+        # (whole time series per chunk, matching the read chunks)
+        save_output(
+            mld_datadask.mld,
             f"{outputdir}/mld.nc",
-            encoding={"mld": {"chunksizes": [len(mld_datadask.mld.time), 216, 240]}},
+            "matrix-build",
+            chunks={"time": -1, "yt_ocean": 216, "xt_ocean": 240},
         )
     except Exception:
         print(f"Error processing {model} mld")
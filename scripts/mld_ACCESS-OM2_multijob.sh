@@ -1,9 +1,14 @@
-for OM2run in 1deg_jra55_iaf_omip2_cycle{1..6}; do
-    # change placeholders in script, submit, and clean up
-    sed "s/OM2run_placeholder/$OM2run/g" scripts/mld_ACCESS-OM2-1.sh > tmp.sh
-    qsub tmp.sh
-    rm tmp.sh
-done
+# Submit all the runs listed in scripts/sweeps/mld_ACCESS-OM2.toml
+# (small runs are packed into shared jobs sized from their inputs, see scripts/sweep.py)
+# Use `dryrun` as an argument (forwarded to scripts/sweep.py) to only print the job scripts.
+python3 scripts/sweep.py scripts/sweeps/mld_ACCESS-OM2.toml "$@"
+
+# for OM2run in 1deg_jra55_iaf_omip2_cycle{1..6}; do
+#     # change placeholders in script, submit, and clean up
+#     sed "s/OM2run_placeholder/$OM2run/g" scripts/mld_ACCESS-OM2-1.sh > tmp.sh
+#     qsub tmp.sh
+#     rm tmp.sh
+# done
 
 # for OM2run in 025deg_jra55_iaf_omip2_cycle{1..6}; do
 #     # change placeholders in script, submit, and clean up
@@ -0,0 +1,26 @@
+# Submit a declarative sweep of script runs (see scripts/tmip/sweep.py and scripts/sweeps/)
+#
+# Usage (from the notebooks directory):
+#   python3 scripts/sweep.py scripts/sweeps/MOC_ACCESS-OM2.toml          # submit with qsub
+#   python3 scripts/sweep.py scripts/sweeps/MOC_ACCESS-OM2.toml dryrun   # only print the job scripts
+#   python3 scripts/sweep.py scripts/sweeps/MOC_ACCESS-OM2.toml local    # run as local processes (off-cluster)
+#
+# Replaces the `sed "s/OM2run_placeholder/..."` + `qsub` loops of the *_multijob.sh scripts:
+# small runs are packed into shared jobs and each job is sized from its inputs.
+
+# import sys to access script arguments (sweep file, backend)
+import sys
+
+sweepfile = sys.argv[1]
+backend = sys.argv[2] if len(sys.argv) > 2 else "pbs"
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.sweep import load_sweep, plan_jobs, submit_jobs
+
+settings, sweeps = load_sweep(sweepfile)
+if backend == "local":
+    # run from the current directory when testing off-cluster
+    settings["workdir"] = "."
+jobs = plan_jobs(settings, sweeps)
+print(f"{sum(len(job['runs']) for job in jobs)} runs packed into {len(jobs)} jobs")
+submit_jobs(jobs, settings, backend="pbs" if backend == "dryrun" else backend, dry_run=backend == "dryrun")
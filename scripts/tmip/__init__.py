@@ -0,0 +1,6 @@
+"""
+Shared helpers for the TMIP preprocessing scripts.
+
+The scripts under `scripts/` are run as `python3 scripts/<name>.py` from the
+notebooks directory, so this package is importable from them as `tmip`.
+"""
@@ -0,0 +1,257 @@
+"""
+Single-pass time averaging of many variables over one time window.
+
+Instead of one open -> slice -> average -> `to_netcdf` block per variable
+(one dask graph each), `build_averages` assembles the lazy reductions of every
+requested variable first, sharing the days-in-month weights between variables
+that have the same time axis, and `write_outputs` then writes all of them with a
+single `dask.compute` call. For sweeps over many members, `write_tasks` instead
+submits each output as a future on the dask client, with a bounded number of
+concurrent writes.
+
+The mixed-layer depth reductions (mean of the yearly maximum and overall
+maximum) come from a single streaming pass over the data (`yearlymax_reduction`).
+"""
+
+# Load traceback to print exceptions
+import traceback
+
+# Import numpy
+import numpy as np
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.output import save_output, finalize_output, output_backend, consolidate_netcdf, consolidate
+from tmip.ledger import record_status
+
+# Reducers available for each variable:
+# - "mean":      days-in-month weighted time mean -> `{variable}`
+# - "yearlymax": mean of the yearly maximum -> `{variable}`
+#                and maximum over the whole window -> `{variable}_max`
+#                (used for the mixed-layer depth `mlotst`/`mld`)
+# - "fixed":     no time dimension, saved as opened (e.g., `volcello`, `areacello`)
+REDUCERS = ("mean", "yearlymax", "fixed")
+
+
+def shared_days_in_month(time, cache):
+    """
+    return days-in-month weights for `time`, reusing cached ones when the time axis is the same
+    """
+    index = time.to_index()
+    for cached_index, weights in cache:
+        if cached_index.equals(index):
+            return weights
+    weights = time.dt.days_in_month
+    cache.append((index, weights))
+    return weights
+
+
+def _yearlymax_partial(x, index):
+    """
+    return the partial sums of the yearly maxima of block `x` (time last), their count, and the running maximum
+
+    `index` is the year index of each time of the block (whole years only).
+    Years are reduced one at a time, and only running sums/maxima are kept.
+    NaNs are skipped like xarray's `max`/`mean`; the running maximum is -inf
+    where there is no data yet (so that partials merge with `max`).
+    Returns a (3, ..., 1) array to be merged with the partials of the other blocks.
+    """
+    total = np.zeros(x.shape[:-1])
+    count = np.zeros(x.shape[:-1])
+    overall = np.full(x.shape[:-1], -np.inf)
+    for year in np.unique(index):
+        yearmax = np.fmax.reduce(x[..., index == year], axis=-1)
+        valid = ~np.isnan(yearmax)
+        total += np.where(valid, yearmax, 0)
+        count += valid
+        overall = np.where(valid, np.maximum(overall, yearmax), overall)
+    return np.stack([total, count, overall])[..., None]
+
+
+def yearlymax_reduction(da, years_per_chunk=1):
+    """
+    return the mean of the yearly maximum and the maximum over time of `da`, from a single pass
+
+    Time is chunked by whole years (`years_per_chunk` per chunk), each chunk is
+    reduced to partial sums of its yearly maxima, their count, and its maximum
+    (see `_yearlymax_partial`), and the partials are tree-reduced, so that only
+    `years_per_chunk` years of each spatial block are in memory at a time.
+    Both lazy results share the same dask tasks, so computing them together
+    (e.g., with `write_outputs`) reads each year of `da` only once.
+    """
+    import dask.array
+    _, index = np.unique(da.time.dt.year.values, return_inverse=True)
+    if np.any(np.diff(index) < 0):
+        raise ValueError("yearlymax_reduction requires a sorted time axis")
+    dtype = np.result_type(da.dtype, np.float32)
+    da = da.transpose(..., "time")
+    # chunk time by whole years
+    months_per_year = np.bincount(index)
+    year_chunks = tuple(
+        int(months_per_year[i:i + years_per_chunk].sum()) for i in range(0, months_per_year.size, years_per_chunk)
+    )
+    data = dask.array.asarray(da.data).rechunk({da.ndim - 1: year_chunks})
+    index = dask.array.from_array(index, chunks=(year_chunks,))
+    partials = dask.array.map_blocks(
+        _yearlymax_partial,
+        data,
+        index,
+        new_axis=0,
+        chunks=((3,),) + data.chunks[:-1] + ((1,) * len(year_chunks),),
+        dtype=np.float64,
+    )
+    # merge the partials of all years (tree reductions)
+    total = partials[0].sum(axis=-1)
+    count = partials[1].sum(axis=-1)
+    overall = partials[2].max(axis=-1)
+    mean = dask.array.where(count > 0, total / dask.array.maximum(count, 1), np.nan)
+    overall = dask.array.where(count > 0, overall, np.nan)
+    template = da.isel(time=0, drop=True)
+    yearlymax_mean = template.copy(data=mean.astype(dtype))
+    overall_max = template.copy(data=overall.astype(dtype))
+    return yearlymax_mean, overall_max
+
+
+def build_averages(open_variable, variables, start_time, end_time, reducers=None, label=""):
+    """
+    build lazy time averages of `variables` over one time window
+
+    `open_variable(variable)` must return the lazily opened dataset containing
+    `variable` (e.g., via `select_latest_data`), and `reducers` maps variable
+    names to one of `REDUCERS` (default is "mean").
+    Nothing is computed here: returns a dict of output name -> lazy dataset.
+    Variables that fail to open/reduce are reported and skipped.
+    """
+    reducers = {} if reducers is None else reducers
+    weights_cache = []
+    outputs = {}
+    for variable in variables:
+        reducer = reducers.get(variable, "mean")
+        if reducer not in REDUCERS:
+            raise ValueError(f"reducer for {variable} has to be one of {REDUCERS}, got {reducer}")
+        try:
+            print(f"Loading {variable} data")
+            datadask = open_variable(variable)
+            print(f"\n{variable}_datadask: ", datadask)
+            if reducer == "fixed":
+                outputs[variable] = datadask
+                continue
+            print(f"Slicing {variable} for the time period")
+            da = datadask[variable].sel(time=slice(start_time, end_time))
+            if reducer == "mean":
+                print(f"Averaging {variable}")
+                weights = shared_days_in_month(da.time, weights_cache)
+                outputs[variable] = da.weighted(weights).mean(dim="time").to_dataset(name=variable)
+            elif reducer == "yearlymax":
+                print(f"Averaging {variable} (mean of the yearly maximum of monthly data)")
+                yearlymax_mean, overall_max = yearlymax_reduction(da)
+                outputs[variable] = yearlymax_mean.to_dataset(name=variable)
+                outputs[f'{variable}_max'] = overall_max.to_dataset(name=variable)
+        except Exception:
+            print(f'Error processing {label} {variable}')
+            print(traceback.format_exc())
+    return outputs
+
+
+def _finalize(paths, profile):
+    """
+    rename the complete outputs `paths` and consolidate their Zarr stores to NetCDF if requested
+    """
+    for path in paths:
+        finalize_output(path)
+        if output_backend() == "zarr" and consolidate_netcdf():
+            consolidate(path, profile)
+
+
+def write_outputs(outputs, outputdir, label="", profile=None, ledger=None):
+    """
+    write every output to `{outputdir}/{name}.nc` in a single `dask.compute` call
+
+    With `profile` (see `tmip.encoding`), files are written with its encoding,
+    and with the output backend of `tmip.output` (NetCDF by default).
+    With a `ledger` (see `tmip.ledger`), the status of every output is recorded.
+
+    If the combined computation fails, each output is retried on its own so that
+    one bad variable does not prevent the others from being saved.
+    Returns the list of output names that were written.
+    """
+    import dask
+    names = list(outputs)
+    paths = [f'{outputdir}/{name}.nc' for name in names]
+    for name, path in zip(names, paths):
+        print(f"Saving {name} to: ", path)
+    try:
+        writes = [save_output(outputs[name], path, profile, compute=False) for name, path in zip(names, paths)]
+        dask.compute(*writes)
+        _finalize(paths, profile)
+        for path in paths:
+            record_status(ledger, path, "done")
+        return names
+    except Exception:
+        print(f'Error writing {label} outputs together, retrying one at a time')
+        print(traceback.format_exc())
+    written = []
+    for name, path in zip(names, paths):
+        try:
+            save_output(outputs[name], path, profile, compute=True)
+            record_status(ledger, path, "done")
+            written.append(name)
+        except Exception:
+            print(f'Error processing {label} {name}')
+            print(traceback.format_exc())
+            record_status(ledger, path, "failed")
+    return written
+
+
+def write_tasks(client, tasks, max_in_flight=1, profile=None, ledger=None):
+    """
+    compute and write many outputs as futures on `client`, with at most `max_in_flight` writes at a time
+
+    `tasks` is an iterable of `(path, build)` pairs where `build()` returns the
+    lazy dataset to save to `path`. Tasks are only built when a slot is free,
+    so that e.g. a sweep over all members x variables keeps every worker busy
+    without opening everything upfront. `max_in_flight=1` writes one at a time.
+    With `profile` (see `tmip.encoding`), files are written with its encoding.
+    With a `ledger` (see `tmip.ledger`), the status of every path is recorded
+    (tasks that are already built should be filtered out by the caller).
+    Returns the list of paths that were written.
+    """
+    from distributed import as_completed
+    tasks = iter(tasks)
+    futures = {}
+
+    def submit_next():
+        # build and submit the next task that builds without error
+        for path, build in tasks:
+            try:
+                ds = build()
+                print("Submitting: ", path)
+                future = client.compute(save_output(ds, path, profile, compute=False))
+                futures[future] = path
+                return future
+            except Exception:
+                print(f'Error building {path}')
+                print(traceback.format_exc())
+                record_status(ledger, path, "failed")
+        return None
+
+    for _ in range(max_in_flight):
+        if submit_next() is None:
+            break
+    written = []
+    completed = as_completed(list(futures))
+    for future in completed:
+        path = futures.pop(future)
+        try:
+            future.result()
+            _finalize([path], profile)
+            print("Saved: ", path)
+            record_status(ledger, path, "done")
+            written.append(path)
+        except Exception:
+            print(f'Error writing {path}')
+            print(traceback.format_exc())
+            record_status(ledger, path, "failed")
+        next_future = submit_next()
+        if next_future is not None:
+            completed.add(next_future)
+    return written
@@ -0,0 +1,302 @@
+"""
+Helpers to search intake-esm catalogs and open the selected data.
+
+`intake` catalogs are passed in by the scripts, and `xmip` is only imported
+when its preprocessing is actually requested.
+"""
+
+# Load re to sort member labels
+import re
+
+# Load pandas for data manipulation
+import pandas as pd
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.chunks import resolve_chunks
+
+# Combine options used for every catalog open
+xarray_combine_by_coords_kwargs = dict(
+    compat="override",
+    data_vars="minimal",
+    coords="minimal"
+)
+
+
+# Catalog column names for each CMIP version
+CMIP_COLUMNS = dict(
+    CMIP6=dict(
+        variable_id='variable_id',
+        experiment_id='experiment_id',
+        source_id='source_id',
+        member_id='member_id',
+        table_id='table_id',
+    ),
+    CMIP5=dict(
+        variable_id='variable',
+        experiment_id='experiment',
+        source_id='model',
+        member_id='ensemble',
+        table_id='table',
+    ),
+)
+
+# Variables required to build transport matrices for each CMIP version
+# (either with mass transports umo+vmo or with velocities uo+vo)
+CMIP_REQUIRED_VARIABLES = dict(
+    CMIP6=dict(
+        umo_vmo=['umo', 'vmo', 'mlotst', 'volcello', 'areacello', 'thetao', 'so'],
+        uo_vo=['uo', 'vo', 'mlotst', 'volcello', 'areacello', 'thetao', 'so'],
+    ),
+    # (Note Removed volcello and areacello because could be in different member: r0i0p0)
+    CMIP5=dict(
+        umo_vmo=['umo', 'vmo', 'mlotst', 'thetao', 'so'],
+        uo_vo=['uo', 'vo', 'mlotst', 'thetao', 'so'],
+    ),
+)
+
+
+def find_latest_version(cat):
+    """
+    find latest version of selected data
+    """
+    return cat.df.version.max()
+
+
+def select_latest_cat(cat, **kwargs):
+    """
+    search latest version of selected data
+    """
+    selectedcat = cat.search(**kwargs)
+    # if dataframe is empty, error
+    if selectedcat.df.empty:
+        raise ValueError(f"No data found for {kwargs}")
+
+    latestselectedcat = selectedcat.search(version=find_latest_version(selectedcat))
+    return latestselectedcat
+
+
+def _selected_variable(kwargs):
+    """
+    return the variable selected by the search `kwargs` (`variable` or `variable_id`, or CMIP5's `variable`)
+    """
+    return kwargs.get("variable_id", kwargs.get("variable"))
+
+
+def select_latest_data(cat, xarray_open_kwargs, xmip_preprocessing=True, **kwargs):
+    """
+    open latest version of selected data as a lazy dataset
+
+    `xmip_preprocessing=False` skips xmip's `combined_preprocessing`
+    (xmip does not work for CMIP5 data ATM).
+    `chunks="auto-for:<op>"` in `xarray_open_kwargs` uses chunks advised
+    from the storage chunks of the files for reduction `op` (see `tmip.chunks`).
+    """
+    latestselectedcat = select_latest_cat(cat, **kwargs)
+    print("\nlatestselectedcat: ", latestselectedcat)
+    xarray_open_kwargs = resolve_chunks(xarray_open_kwargs, latestselectedcat.df, _selected_variable(kwargs))
+    if xmip_preprocessing:
+        from xmip.preprocessing import combined_preprocessing
+        preprocess = combined_preprocessing
+    else:
+        preprocess = None
+    datadask = latestselectedcat.to_dask(
+        xarray_open_kwargs=xarray_open_kwargs,
+        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
+        parallel=True,
+        preprocess=preprocess,
+    )
+    return datadask
+
+
+def latest_version_manifest(df, cmip_version):
+    """
+    keep only the latest version of every (source, experiment, member, variable, table) in `df`
+
+    The latest versions of all groups are resolved at once with a grouped
+    `transform("max")`, so the returned dataframe is a ready-to-open file
+    manifest for a whole sweep (see `open_manifest_data`).
+    """
+    columns = CMIP_COLUMNS[cmip_version]
+    keys = [columns[k] for k in ('source_id', 'experiment_id', 'member_id', 'variable_id', 'table_id')]
+    latest_version = df.groupby(keys, dropna=False).version.transform("max")
+    return df[df.version == latest_version].reset_index(drop=True)
+
+
+def select_manifest(manifest, **kwargs):
+    """
+    select the rows of `manifest` matching `kwargs` (column=value or column=[values])
+    """
+    mask = pd.Series(True, index=manifest.index)
+    for column, value in kwargs.items():
+        if isinstance(value, (list, tuple, set)):
+            mask &= manifest[column].isin(value)
+        else:
+            mask &= manifest[column] == value
+    return manifest[mask]
+
+
+def open_manifest_data(manifest, xarray_open_kwargs, xmip_preprocessing=True, **kwargs):
+    """
+    open the files of `manifest` matching `kwargs` as a lazy dataset
+
+    Drop-in replacement for `select_latest_data` when `manifest` comes from
+    `latest_version_manifest`: no catalog search is needed.
+    """
+    import xarray as xr
+    selected = select_manifest(manifest, **kwargs)
+    # if dataframe is empty, error
+    if selected.empty:
+        raise ValueError(f"No data found for {kwargs}")
+    xarray_open_kwargs = resolve_chunks(xarray_open_kwargs, selected, _selected_variable(kwargs))
+    print("\nselected files: ", len(selected))
+    if xmip_preprocessing:
+        from xmip.preprocessing import combined_preprocessing
+        preprocess = combined_preprocessing
+    else:
+        preprocess = None
+    datadask = xr.open_mfdataset(
+        sorted(selected.path),
+        combine="by_coords",
+        parallel=True,
+        preprocess=preprocess,
+        **xarray_combine_by_coords_kwargs,
+        **xarray_open_kwargs,
+    )
+    return datadask
+
+
+def select_data(cat, xarray_open_kwargs, **kwargs):
+    """
+    open selected data (all versions/files) as a lazy dataset
+
+    `chunks="auto-for:<op>"` in `xarray_open_kwargs` uses chunks advised
+    from the storage chunks of the files for reduction `op` (see `tmip.chunks`).
+    """
+    selectedcat = cat.search(**kwargs)
+    print("\nselectedcat: ", selectedcat)
+    xarray_open_kwargs = resolve_chunks(xarray_open_kwargs, selectedcat.df, _selected_variable(kwargs))
+    datadask = selectedcat.to_dask(
+        xarray_open_kwargs=xarray_open_kwargs,
+        xarray_combine_by_coords_kwargs=xarray_combine_by_coords_kwargs,
+        parallel=True,
+    )
+    return datadask
+
+
+def _catalog_variables(df, column):
+    """
+    return the set of variable names in `column` of catalog dataframe `df` (a name or a list of names per row)
+    """
+    names = set()
+    for v in df[column]:
+        names.update(v if isinstance(v, (list, tuple)) else [v])
+    return names
+
+
+def select_variables(cat, xarray_open_kwargs, variables, column="variable", allow_missing=False, **kwargs):
+    """
+    open `variables` as a single lazy dataset, opening each of their files once
+
+    In raw ACCESS-OM2 output, variables like `tx_trans`, `ty_trans`, and `mld`
+    are in the same files (e.g., `ocean_month.nc`), so opening them with one
+    `select_data` per variable opens (and parses the metadata of) every file
+    once per variable. Here, the catalog rows are grouped by `path` and each
+    file is opened once, keeping only the requested `variables` it has.
+    `column` is the catalog column of the variable names, and the variables
+    should share the same time axis (e.g., select a single `frequency`).
+    With `allow_missing=True`, the variables that are not found are reported
+    and the others are opened (so that a run without, e.g., `tx_trans_gm`
+    still produces its other outputs); otherwise they raise a `ValueError`.
+    """
+    import xarray as xr
+    selectedcat = cat.search(**{column: variables}, **kwargs)
+    print("\nselectedcat: ", selectedcat)
+    df = selectedcat.df
+    # if dataframe is empty, error
+    if df.empty:
+        raise ValueError(f"No data found for {variables} and {kwargs}")
+    found = _catalog_variables(df, column)
+    missing = [v for v in variables if v not in found]
+    if missing:
+        if not allow_missing:
+            raise ValueError(f"No data found for {missing} and {kwargs}")
+        print(f"No data found for {missing} and {kwargs}, opening the others")
+        variables = [v for v in variables if v in found]
+    paths = sorted(df.path.unique())
+    print(f"Opening {len(paths)} files once for {variables}")
+    xarray_open_kwargs = resolve_chunks(xarray_open_kwargs, df, variables, column)
+
+    def keep_variables(ds):
+        return ds[[v for v in variables if v in ds.data_vars]]
+
+    datadask = xr.open_mfdataset(
+        paths,
+        combine="by_coords",
+        parallel=True,
+        preprocess=keep_variables,
+        **xarray_combine_by_coords_kwargs,
+        **xarray_open_kwargs,
+    )
+    missing = [v for v in variables if v not in datadask.data_vars]
+    if missing:
+        if not allow_missing or len(missing) == len(variables):
+            raise ValueError(f"No data found for {missing} in {len(paths)} files")
+        print(f"No data found for {missing} in {len(paths)} files")
+    return datadask
+
+
+def availability_matrix(df, cmip_version):
+    """
+    boolean availability of each variable (columns) for each (experiment, source, member) (rows)
+
+    Built with a single crosstab over the catalog dataframe `df`, so that
+    queries over many variables are vectorized (see `members_with_variables`).
+    """
+    if cmip_version not in CMIP_COLUMNS:
+        raise ValueError(f"cmip_version has to be one of {list(CMIP_COLUMNS)}, got {cmip_version}")
+    columns = CMIP_COLUMNS[cmip_version]
+    index = [columns['experiment_id'], columns['source_id'], columns['member_id']]
+    return pd.crosstab([df[c] for c in index], df[columns['variable_id']]).gt(0)
+
+
+def members_with_variables(matrix, variables):
+    """
+    boolean mask of the rows of the availability `matrix` that have all `variables`
+    """
+    return matrix.reindex(columns=list(variables), fill_value=False).all(axis=1)
+
+
+def summary_variable_availability(df, cmip_version):
+    """
+    find members that have all the required data (umo+vmo or uo+vo + all the rest)
+
+    Returns one row per (experiment, source) with the list of valid members
+    in columns `{member_id}_umo_vmo` and `{member_id}_uo_vo`.
+    """
+    matrix = availability_matrix(df, cmip_version)
+    columns = CMIP_COLUMNS[cmip_version]
+    experiment_id = columns['experiment_id']
+    source_id = columns['source_id']
+    member_id = columns['member_id']
+    results = []
+    for variables in CMIP_REQUIRED_VARIABLES[cmip_version].values():
+        valid = matrix.index[members_with_variables(matrix, variables).to_numpy()].to_frame(index=False)
+        # Group by (experiment, source) and aggregate member_id into a list
+        results.append(valid.groupby([experiment_id, source_id])[member_id].agg(list).reset_index())
+    # Merge the results into a single dataframe
+    merged_result = pd.merge(*results, on=[experiment_id, source_id], how='outer', suffixes=('_umo_vmo', '_uo_vo'))
+    return merged_result
+
+
+def extract_numbers(member):
+    """
+    extract the integers of a member label (e.g., "r10i1p1f1" -> [10, 1, 1, 1])
+    """
+    return list(map(int, re.findall(r'\d+', member)))
+
+
+def sort_members(members):
+    """
+    sort members that are formatted as "r%di%dp%df%d" where %d is a integer
+    """
+    return sorted(members, key=extract_numbers)
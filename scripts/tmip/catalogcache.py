@@ -0,0 +1,143 @@
+"""
+Persistent on-disk cache of intake-esm catalog searches.
+
+Loading e.g. `intake.cat.access_nri["cmip6_fs38"]` parses the whole catalog CSV,
+which every PBS job of a sweep would otherwise do again. `cached_search` stores
+the rows matching a search as a Parquet file keyed by catalog name, catalog
+modification times and the query, and rebuilds a small `esm_datastore` from it.
+The cache is invalidated automatically when the catalog files change.
+
+The cache directory is `$TMIP_CACHE_DIR/catalog` (default `~/.cache/tmip/catalog`).
+"""
+
+# Import os for makedirs/path/environ
+import os
+
+# Load json/hashlib to build the cache keys
+import json
+import hashlib
+
+# Load pandas for data manipulation
+import pandas as pd
+
+
+def cache_root():
+    """
+    return the root directory of the TMIP caches (`$TMIP_CACHE_DIR`, default `~/.cache/tmip`)
+    """
+    return os.environ.get("TMIP_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tmip"))
+
+
+def cache_dir():
+    """
+    return the directory where catalog searches are cached
+    """
+    return os.path.join(cache_root(), "catalog")
+
+
+def find_catalog_args(name):
+    """
+    return the `intake.open_esm_datastore` arguments of catalog `name` in the ACCESS-NRI catalog
+
+    These are the JSON file (`obj`) and the options it has to be opened with
+    (e.g., `columns_with_iterables` and `read_csv_kwargs`).
+    Only the (small) dataframe catalog is read, not the datastore itself.
+    """
+    import intake
+    import yaml
+    catalogs = intake.cat.access_nri
+    df = catalogs.df
+    rows = df[df[getattr(catalogs, "name_column", "name")] == name]
+    if rows.empty:
+        raise ValueError(f"No catalog named {name} in intake.cat.access_nri")
+    source = yaml.safe_load(rows.iloc[0][getattr(catalogs, "yaml_column", "yaml")])
+    return dict(source["sources"][name]["args"])
+
+
+def read_esmcat(catalog_file):
+    """
+    return the intake-esm catalog description (JSON) and the path to its CSV
+    """
+    with open(catalog_file) as f:
+        esmcat = json.load(f)
+    csv_file = esmcat.get("catalog_file")
+    if csv_file is not None and not os.path.isabs(csv_file):
+        csv_file = os.path.join(os.path.dirname(catalog_file), csv_file)
+    return esmcat, csv_file
+
+
+def cache_key(name, catalog_file, csv_file, query, args=None):
+    """
+    return a key for the search `query` of catalog `name` (opened with `args`) at its current version
+    """
+    mtimes = [os.path.getmtime(f) for f in (catalog_file, csv_file) if f is not None]
+    payload = json.dumps(dict(name=name, mtimes=mtimes, query=query, args=args), sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def _write_parquet(df, path):
+    """
+    write `df` to `path` atomically (concurrent jobs may write the same entry)
+    """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def datastore_from_df(esmcat, df, columns_with_iterables=None):
+    """
+    rebuild an intake-esm datastore from a catalog description and its (cached) rows
+    """
+    import intake
+    esmcat = {k: v for k, v in esmcat.items() if k not in ("catalog_file", "catalog_dict")}
+    # Parquet returns iterables as arrays, intake-esm expects tuples
+    columns = list(columns_with_iterables or [])
+    columns += [c for c in _columns_with_iterables(df) if c not in columns]
+    for column in columns:
+        df[column] = df[column].map(tuple)
+    kwargs = {} if columns_with_iterables is None else dict(columns_with_iterables=columns_with_iterables)
+    return intake.open_esm_datastore(dict(esmcat=esmcat, df=df), **kwargs)
+
+
+def _columns_with_iterables(df):
+    """
+    return the columns of `df` that hold iterables (e.g., lists of variables)
+    """
+    if df.empty:
+        return []
+    first = df.iloc[0]
+    return [c for c in df.columns if hasattr(first[c], "__len__") and not isinstance(first[c], (str, bytes))]
+
+
+def cached_search(name, catalog_file=None, **query):
+    """
+    search catalog `name` with `query`, answering from the on-disk cache when possible
+
+    `catalog_file` is the intake-esm JSON of the catalog (looked up in the
+    ACCESS-NRI catalog, with the options it is opened with, if not given).
+    Returns an `esm_datastore` of the matching rows, usable like the result
+    of `cat.search(**query)`.
+    """
+    if catalog_file is None:
+        args = find_catalog_args(name)
+    else:
+        args = dict(obj=catalog_file)
+    catalog_file = args["obj"]
+    esmcat, csv_file = read_esmcat(catalog_file)
+    key = cache_key(name, catalog_file, csv_file, query, args)
+    path = os.path.join(cache_dir(), f'{name}-{key}.parquet')
+    if os.path.isfile(path):
+        print(f"Loading cached {name} search from: ", path)
+        df = pd.read_parquet(path)
+    else:
+        import intake
+        print(f"Searching {name} (not cached yet)")
+        df = intake.open_esm_datastore(**args).search(**query).df
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+            _write_parquet(df, path)
+            print(f"Cached {name} search to: ", path)
+        except (ImportError, OSError) as e:
+            # e.g., no pyarrow or read-only home: still return the search result
+            print(f"Could not cache {name} search: {e}")
+    return datastore_from_df(esmcat, df, args.get("columns_with_iterables"))
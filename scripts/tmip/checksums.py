@@ -0,0 +1,137 @@
+"""
+Per-chunk content hashes of archived files, for cheap archive verification.
+
+`write_with_manifest` saves a variable to NetCDF and, in the same dask pass,
+hashes every chunk of it into a sidecar JSON manifest (`{path}.chunks.json`).
+`verify_archives` later re-hashes the source chunks in parallel on the dask
+cluster and compares them to the manifests, so the archived copies do not
+need to be read again. It returns machine-readable pass/fail reports.
+"""
+
+# Import os for path/makedirs
+import os
+
+# Load json/hashlib for the manifests and digests
+import json
+import hashlib
+
+# Import numpy
+import numpy as np
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.output import partial_path, finalize_output
+
+# Hash algorithm (from hashlib) used for new manifests
+ALGORITHM = "blake2b"
+
+
+def manifest_path(path):
+    """
+    return the path of the chunk manifest of archived file `path`
+    """
+    return f'{path}.chunks.json'
+
+
+def _block_digest(block, algorithm):
+    """
+    return the hex digest of the values (and dtype and shape) of one chunk
+    """
+    block = np.ascontiguousarray(block)
+    h = hashlib.new(algorithm)
+    h.update(f'{block.dtype.str}{block.shape}'.encode())
+    h.update(block.tobytes())
+    return h.hexdigest()
+
+
+def chunk_digests(da, algorithm=ALGORITHM):
+    """
+    return a dict of chunk index (e.g., "0.1.0.0") -> lazy digest of each dask chunk of `da`
+    """
+    import dask
+    blocks = da.data.to_delayed()
+    return {
+        ".".join(map(str, index)): dask.delayed(_block_digest, pure=True)(blocks[index], algorithm)
+        for index in np.ndindex(blocks.shape)
+    }
+
+
+def _write_json(obj, path):
+    """
+    write `obj` to `path` atomically
+    """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, "w") as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp, path)
+
+
+def write_with_manifest(da, path, algorithm=ALGORITHM, profile=None, **to_netcdf_kwargs):
+    """
+    write `da` to `path` and the digests of its chunks to `manifest_path(path)` in a single pass
+
+    `da` is chunked as a whole if it is not a dask array already.
+    With `profile` (see `tmip.encoding`), the file is written with its encoding
+    (use a lossless profile, e.g., "archive", since digests are of the source values).
+    The file is written to `partial_path(path)` and only renamed to `path`
+    once its manifest is written, so that an archive at `path` always has one.
+    """
+    import dask
+    if da.chunks is None:
+        da = da.chunk()
+    if profile is not None:
+        from tmip.encoding import encoding_for
+        to_netcdf_kwargs["encoding"] = encoding_for(da, profile)
+    write = da.to_netcdf(partial_path(path), compute=False, **to_netcdf_kwargs)
+    _, digests = dask.compute(write, chunk_digests(da, algorithm))
+    manifest = dict(
+        variable=da.name,
+        dims=list(da.dims),
+        shape=list(da.shape),
+        chunks=[list(c) for c in da.chunks],
+        dtype=str(da.dtype),
+        algorithm=algorithm,
+        digests=digests,
+    )
+    _write_json(manifest, manifest_path(path))
+    finalize_output(path, backend="netcdf")
+    return manifest
+
+
+def verify_archives(pairs):
+    """
+    compare the chunk digests of each source `da` to the manifest of its archived file `path`
+
+    `pairs` is a list of `(da, path)`. All source digests are computed in a
+    single `dask.compute`, and a list of reports (one dict per pair, with
+    `status` "pass", "fail", or "no manifest") is returned.
+    """
+    import dask
+    reports = []
+    lazy = []
+    for da, path in pairs:
+        report = dict(path=path, variable=da.name)
+        reports.append(report)
+        lazy.append(None)
+        if not os.path.isfile(manifest_path(path)):
+            report["status"] = "no manifest"
+            continue
+        with open(manifest_path(path)) as f:
+            manifest = json.load(f)
+        report["algorithm"] = manifest["algorithm"]
+        if list(da.dims) != manifest["dims"] or list(da.shape) != manifest["shape"]:
+            report["status"] = "fail"
+            report["reason"] = f"source is {dict(da.sizes)}, archive is {dict(zip(manifest['dims'], manifest['shape']))}"
+            continue
+        # Hash the source with the same chunks as when it was archived
+        da = da.chunk(dict(zip(manifest["dims"], map(tuple, manifest["chunks"]))))
+        lazy[-1] = (manifest, chunk_digests(da, manifest["algorithm"]))
+    computed, = dask.compute([None if x is None else x[1] for x in lazy])
+    for report, x, digests in zip(reports, lazy, computed):
+        if x is None:
+            continue
+        manifest = x[0]
+        mismatched = sorted(k for k, v in digests.items() if manifest["digests"].get(k) != v)
+        report["nchunks"] = len(digests)
+        report["mismatched_chunks"] = mismatched
+        report["status"] = "fail" if mismatched else "pass"
+    return reports
@@ -0,0 +1,164 @@
+"""
+Chunk plans advised from the on-disk chunking of the files and the reduction to do.
+
+Instead of tuning chunk dicts by hand in every script (e.g.,
+`{'time': -1, 'xu_ocean':180, 'yt_ocean':150, 'lev':25}`), `advise_chunks`
+starts from the storage chunks of the files (`_ChunkSizes`), so that every
+dask chunk reads whole storage chunks, and grows them (by multiples of the
+storage chunks) up to `target_bytes`, first along the dimensions that the
+reduction `op` goes through:
+- "timemean":    weighted time mean (time grown first, fewer partial sums)
+- "climatology": monthly/seasonal climatology (time chunks are whole years)
+- "yearlymax":   yearly maxima (time chunks are whole years)
+- "lonsum":      longitudinal sum (full longitudes, one time per chunk)
+
+`select_data`/`select_latest_data`/`open_manifest_data` (see `tmip.catalog`)
+accept `chunks="auto-for:<op>"` and resolve it with `auto_chunks` from the
+files of the catalog search.
+"""
+
+# Load math for lcm
+import math
+
+# Reductions that chunks can be advised for
+OPS = ("timemean", "climatology", "yearlymax", "lonsum")
+
+# Prefix of the `chunks` value that requests advised chunks
+AUTO_PREFIX = "auto-for:"
+
+# Default target size of a chunk
+TARGET_BYTES = 128 * 2**20
+
+
+def longitude_dim(dims):
+    """
+    return the longitude (x) dimension among `dims` (e.g., `xt_ocean`, `grid_xt_ocean`, `i`, `lon`)
+    """
+    for dim in dims:
+        if dim.startswith(("x", "grid_x", "lon")) or dim in ("i", "ni", "nlon"):
+            return dim
+    raise ValueError(f"No longitude dimension in {dims}")
+
+
+def storage_chunks(path, variable):
+    """
+    return the (sizes, storage chunks, itemsize) of `variable` in the NetCDF file `path`
+
+    Storage chunks come from the HDF5 chunking (as in `ncdump -s`'s `_ChunkSizes`),
+    or from a `_ChunkSizes` attribute; contiguous variables are one chunk.
+    """
+    import netCDF4
+    with netCDF4.Dataset(path) as nc:
+        var = nc[variable]
+        sizes = dict(zip(var.dimensions, var.shape))
+        chunking = var.chunking()
+        if chunking == "contiguous" or chunking is None:
+            chunking = getattr(var, "_ChunkSizes", var.shape)
+        storage = dict(zip(var.dimensions, (int(c) for c in chunking)))
+        return sizes, storage, var.dtype.itemsize
+
+
+def _chunk_bytes(chunks, itemsize):
+    """
+    return the size of a chunk of `chunks` (dim -> size)
+    """
+    return math.prod(chunks.values()) * itemsize
+
+
+def advise_chunks(sizes, storage, itemsize, op, target_bytes=TARGET_BYTES):
+    """
+    return a chunk dict for a variable of `sizes` stored with `storage` chunks, for reduction `op`
+
+    Full dimensions are returned as -1.
+    """
+    if op not in OPS:
+        raise ValueError(f"op has to be one of {OPS}, got {op}")
+    chunks = {dim: min(storage.get(dim, size), size) for dim, size in sizes.items()}
+    step = dict(chunks)
+    grow_first = []
+    # dimensions whose chunks are set by `op` (not grown)
+    fixed = []
+    if "time" in sizes:
+        if op in ("climatology", "yearlymax"):
+            # whole years per chunk
+            step["time"] = min(math.lcm(chunks["time"], 12), sizes["time"])
+            chunks["time"] = step["time"]
+            grow_first = ["time"]
+        elif op == "timemean":
+            grow_first = ["time"]
+        elif op == "lonsum":
+            chunks["time"] = step["time"] = 1
+            fixed = ["time"]
+    if op == "lonsum":
+        xdim = longitude_dim(sizes)
+        chunks[xdim] = step[xdim] = sizes[xdim]
+        fixed.append(xdim)
+    # then the other dimensions, from the fastest varying (contiguous on disk)
+    order = grow_first + [dim for dim in reversed(list(sizes)) if dim not in grow_first + fixed]
+    for dim in order:
+        while chunks[dim] < sizes[dim]:
+            grown = min(chunks[dim] + step[dim], sizes[dim])
+            if _chunk_bytes(dict(chunks, **{dim: grown}), itemsize) > target_bytes:
+                break
+            chunks[dim] = grown
+        if chunks[dim] < sizes[dim]:
+            break
+    return {dim: -1 if chunks[dim] == sizes[dim] else chunks[dim] for dim in sizes}
+
+
+def auto_chunks(paths, variable, op, target_bytes=TARGET_BYTES):
+    """
+    return the advised chunks of `variable` stored in files `paths` (concatenated along time) for `op`
+    """
+    paths = sorted(paths)
+    if not paths:
+        raise ValueError(f"No files to advise chunks of {variable}")
+    sizes, storage, itemsize = storage_chunks(paths[0], variable)
+    if "time" in sizes:
+        # (files are concatenated along time)
+        sizes["time"] *= len(paths)
+    chunks = advise_chunks(sizes, storage, itemsize, op, target_bytes)
+    print(f"Advised chunks for {variable} ({op}): {chunks} (storage chunks {storage})")
+    return chunks
+
+
+def merge_chunks(*chunks):
+    """
+    return the chunks for the dimensions of all `chunks` (smallest chunk of each dimension, -1 being the full dimension)
+    """
+    merged = {}
+    for plan in chunks:
+        for dim, size in plan.items():
+            if merged.get(dim, -1) == -1 or (size != -1 and size < merged[dim]):
+                merged[dim] = size
+    return merged
+
+
+def _rows_with(df, variable, column):
+    """
+    return the rows of catalog dataframe `df` whose `column` (a name or a list of names) has `variable`
+    """
+    if column is None:
+        return df
+    return df[df[column].map(lambda v: variable in v if isinstance(v, (list, tuple)) else v == variable)]
+
+
+def resolve_chunks(xarray_open_kwargs, df, variable, column=None):
+    """
+    return `xarray_open_kwargs` with `chunks="auto-for:<op>"` replaced by the advised chunks of `variable`
+
+    `df` is the catalog dataframe of the files to open (with a `path` column).
+    For a list of variables (see `tmip.catalog.select_variables`), chunks are
+    advised from the files of each variable (rows of `df` with the variable
+    in `column`) and merged (see `merge_chunks`).
+    Other `chunks` values are left as they are.
+    """
+    chunks = xarray_open_kwargs.get("chunks")
+    if not (isinstance(chunks, str) and chunks.startswith(AUTO_PREFIX)):
+        return xarray_open_kwargs
+    if variable is None:
+        raise ValueError(f"chunks={chunks} requires the variables to be selected")
+    op = chunks[len(AUTO_PREFIX):]
+    variables = [variable] if isinstance(variable, str) else variable
+    plans = [auto_chunks(_rows_with(df, v, column).path, v, op) for v in variables]
+    return dict(xarray_open_kwargs, chunks=merge_chunks(*plans))
@@ -0,0 +1,144 @@
+"""
+Days-in-month weighted climatologies and yearly means.
+
+Weights only depend on the (1D) time axis so they are cheap to build and check;
+the weighted reduction over the data is the only dask work.
+
+Monthly and seasonal climatologies are computed with a fused kernel
+(`fused_group_mean`): each time slice is added, with its weight, directly into
+its month/season of the output, so no weighted copy of the full field is ever
+made (this roughly halves peak memory for e.g. `tx_trans`/`ty_trans`).
+"""
+
+# Import numpy
+import numpy as np
+
+
+def _group_weights(ds, group, ngroups=None):
+    """
+    return days-in-month weights normalized within each `group` (e.g., "time.month")
+    """
+    # Make a DataArray with the number of days in each month, size = len(time)
+    month_length = ds.time.dt.days_in_month
+    # Calculate the weights by grouping by `group`
+    weights = month_length.groupby(group) / month_length.groupby(group).sum()
+    # Test that the sum of the weights for each group is 1.0
+    sums = weights.groupby(group).sum().values
+    np.testing.assert_allclose(sums, np.ones(len(sums) if ngroups is None else ngroups))
+    return month_length, weights
+
+
+def _group_weight_table(time, group, ngroups=None):
+    """
+    return the group labels, the group index of each time, and the normalized weight of each time
+
+    Same weights as `_group_weights` but as plain numpy arrays for `fused_group_mean`.
+    """
+    month_length = time.dt.days_in_month.values.astype(np.float64)
+    labels, index = np.unique(getattr(time.dt, group).values, return_inverse=True)
+    # Normalize the weights within each group
+    sums = np.bincount(index, weights=month_length, minlength=len(labels))
+    weights = month_length / sums[index]
+    # Test that the sum of the weights for each group is 1.0
+    np.testing.assert_allclose(
+        np.bincount(index, weights=weights, minlength=len(labels)),
+        np.ones(len(labels) if ngroups is None else ngroups)
+    )
+    return labels, index, weights
+
+
+def _fused_group_sum(x, index, weights, ngroups):
+    """
+    weighted sum of `x` (time last) into `ngroups` groups, one time slice at a time
+
+    NaNs count as zero (like xarray's `sum`), and only one time slice is
+    temporarily copied at a time.
+    """
+    out = np.zeros(x.shape[:-1] + (ngroups,), dtype=np.result_type(x.dtype, weights.dtype))
+    for t in range(x.shape[-1]):
+        xt = x[..., t]
+        out[..., index[t]] += weights[t] * np.where(np.isnan(xt), 0, xt)
+    return out
+
+
+def _fused_group_mean_da(da, group, labels, index, weights):
+    """
+    weighted mean of DataArray `da` for each `group` with the weight table of `_group_weight_table`
+    """
+    import xarray as xr
+    out = xr.apply_ufunc(
+        _fused_group_sum,
+        da,
+        input_core_dims=[["time"]],
+        output_core_dims=[[group]],
+        kwargs=dict(index=index, weights=weights, ngroups=len(labels)),
+        dask="parallelized",
+        output_dtypes=[np.result_type(da.dtype, weights.dtype)],
+        dask_gufunc_kwargs=dict(output_sizes={group: len(labels)}, allow_rechunk=True),
+        keep_attrs=True,
+    )
+    # Put the group dimension where time was
+    dims = [group if d == "time" else d for d in da.dims]
+    return out.assign_coords({group: labels}).transpose(*dims)
+
+
+def fused_group_mean(ds, group, ngroups=None):
+    """
+    days-in-month weighted mean of `ds` (Dataset or DataArray) for each `group` ("month" or "season") in a single reduction
+
+    Same result as the `groupby` climatologies, but each dask block is reduced by
+    `_fused_group_sum` (the whole time axis of a block is reduced at once, so
+    time is rechunked to a single chunk if needed).
+    For a Dataset, the kernel is mapped over the data variables with a time
+    dimension; the time-less ones (e.g., cell areas) are passed through.
+    """
+    import xarray as xr
+    labels, index, weights = _group_weight_table(ds.time, group, ngroups)
+    if isinstance(ds, xr.DataArray):
+        return _fused_group_mean_da(ds, group, labels, index, weights)
+    return ds.map(
+        lambda da: _fused_group_mean_da(da, group, labels, index, weights) if "time" in da.dims else da,
+        keep_attrs=True,
+    )
+
+
+def season_climatology(ds):
+    """
+    days-in-month weighted seasonal climatology (DJF, MAM, JJA, SON)
+    """
+    return fused_group_mean(ds, "season", 4)
+
+
+def month_climatology(ds):
+    """
+    days-in-month weighted monthly climatology
+
+    Also keeps track of the mean number of days per month in coordinate `mean_days_in_month`.
+    """
+    ds_out = fused_group_mean(ds, "month", 12)
+    # Keep track of mean number of days per month
+    mean_days_in_month = ds.time.dt.days_in_month.groupby("time.month").mean()
+    # And assign it to new coordinate
+    ds_out = ds_out.assign_coords(mean_days_in_month=('month', mean_days_in_month.data))
+    return ds_out
+
+
+def climatology(ds, lumpby):
+    """
+    monthly or seasonal climatology depending on `lumpby` ("month" or "season")
+    """
+    if lumpby == "month":
+        return month_climatology(ds)
+    elif lumpby == "season":
+        return season_climatology(ds)
+    else:
+        raise ValueError("lumpby has to be month or season")
+
+
+def yearlymeans(ds):
+    """
+    days-in-month weighted yearly means
+    """
+    _, weights = _group_weights(ds, "time.year")
+    # Calculate the weighted average
+    return (ds * weights).groupby("time.year").sum(dim="time")
@@ -0,0 +1,89 @@
+"""
+Dask cluster sized from the PBS allocation and the chunk plan of the data.
+
+Instead of hard-coding `Client(n_workers=24, threads_per_worker=1)` (and
+guessing `memory_limit`), `make_client` reads the CPUs and memory of the job
+(`$PBS_NCPUS`, `$PBS_VMEM`, or the machine's when not in a PBS job) and, when
+given the lazily opened data, the size of their largest dask chunk. It then
+picks the number of (single-threaded) workers so that each worker has enough
+memory for `chunk_factor` chunks at a time (input, intermediates, and output
+of a task), within `target_fraction` of its memory limit (below the point
+where distributed starts spilling/pausing), and logs its choice.
+"""
+
+# Import os for environment variables
+import os
+
+# Import numpy
+import numpy as np
+
+# Memory kept for the scheduler/client process
+RESERVED_FRACTION = 0.1
+
+
+def pbs_allocation():
+    """
+    return the (ncpus, memory in bytes) of the PBS job (of the machine outside of PBS jobs)
+    """
+    ncpus = int(os.environ.get("PBS_NCPUS", os.cpu_count()))
+    if "PBS_VMEM" in os.environ:
+        memory = int(os.environ["PBS_VMEM"])
+    else:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return ncpus, memory
+
+
+def chunk_plan(*objs):
+    """
+    return the (largest chunk, total) bytes of the dask-backed variables of `objs` (Datasets/DataArrays)
+    """
+    import xarray as xr
+    largest = 0
+    total = 0
+    for obj in objs:
+        variables = [obj] if isinstance(obj, xr.DataArray) else obj.data_vars.values()
+        for da in variables:
+            total += da.nbytes
+            if da.chunks is None:
+                continue
+            chunk = int(np.prod([max(c) for c in da.chunks])) * da.dtype.itemsize
+            largest = max(largest, chunk)
+    return largest, total
+
+
+def plan_cluster(ncpus, memory, chunk_bytes=0, chunk_factor=4, target_fraction=0.6, max_workers=None):
+    """
+    return the `Client` kwargs (n_workers, threads_per_worker, memory_limit) for `ncpus` and `memory`
+
+    Workers are single-threaded (one task in memory per worker), and there are
+    as many as CPUs unless `chunk_factor * chunk_bytes` per worker does not fit
+    in `target_fraction` of the memory of each worker, or `max_workers` is smaller.
+    """
+    usable = memory * (1 - RESERVED_FRACTION)
+    n_workers = ncpus if max_workers is None else min(ncpus, max_workers)
+    if chunk_bytes:
+        fit = int(usable * target_fraction // (chunk_factor * chunk_bytes))
+        if fit < 1:
+            print(f"Warning: chunks of {chunk_bytes / 2**20:.0f}MiB may not fit in {usable / 2**30:.0f}GiB with {chunk_factor} chunks per task")
+        n_workers = max(1, min(n_workers, fit))
+    return dict(n_workers=n_workers, threads_per_worker=1, memory_limit=int(usable // n_workers))
+
+
+def make_client(*objs, chunk_bytes=None, chunk_factor=4, max_workers=None):
+    """
+    start a dask `Client` sized from the PBS allocation and the chunks of `objs` (or `chunk_bytes`)
+
+    `max_workers` caps the number of workers (e.g., for I/O-bound jobs).
+    """
+    from dask.distributed import Client
+    ncpus, memory = pbs_allocation()
+    total = None
+    if chunk_bytes is None and objs:
+        chunk_bytes, total = chunk_plan(*objs)
+    kwargs = plan_cluster(ncpus, memory, chunk_bytes or 0, chunk_factor=chunk_factor, max_workers=max_workers)
+    print(f"Cluster for {ncpus} CPUs and {memory / 2**30:.0f}GiB"
+          + (f", largest chunk {chunk_bytes / 2**20:.0f}MiB" if chunk_bytes else "")
+          + (f", {total / 2**30:.1f}GiB of data" if total else "")
+          + f": {kwargs['n_workers']} workers x {kwargs['threads_per_worker']} thread,"
+          + f" {kwargs['memory_limit'] / 2**30:.1f}GiB each")
+    return Client(**kwargs)
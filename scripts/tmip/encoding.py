@@ -0,0 +1,123 @@
+"""
+Named NetCDF encoding profiles for the files written by the pipeline.
+
+Without an `encoding`, `to_netcdf` writes uncompressed variables with
+whatever chunking HDF5/dask chose. A profile sets, for every data variable:
+- the compression (`zlib`, or `zstd` if the netCDF-C plugin is available) and its level,
+- the byte shuffle filter,
+- `float32` storage of the `float64` data of an explicit list of variables
+  (only where the precision is not needed; everything else keeps its dtype),
+- `chunksizes` matched to how the file is read downstream.
+
+Profiles:
+- "archive":      lossless copies of raw model output (e.g., monthly transports
+                  archived to `/g/data/xv83`), one time per chunk
+- "derived":      lossless diagnostics computed by the pipeline (e.g., overturning
+                  streamfunctions, ensemble statistics, monthly forcing means),
+                  one time per chunk
+- "matrix-build": time-mean fields read whole by the Julia transport-matrix
+                  builders, with full-extent chunks; grid metrics and mass
+                  transports stay `float64` (for mass conservation), and only
+                  the tracers listed in its `float32` (temperature, salinity,
+                  age) are stored as `float32`
+
+Use `encoding_for(obj, profile)` as the `encoding` of `to_netcdf`,
+or `save_netcdf(obj, path, profile)` directly.
+"""
+
+# Import numpy
+import numpy as np
+
+# Encoding profiles
+# - compression: "zlib" or "zstd"
+# - complevel:   compression level
+# - shuffle:     byte shuffle filter before compression
+# - float32:     names of the float64 data variables to store as float32 (all others keep their dtype)
+# - chunks:      chunk size of the given dimensions (-1 for the full extent);
+#                other dimensions are stored with their full extent
+# - max_chunk_bytes: chunks above that size are split along their largest non-time dimension
+PROFILES = {
+    "archive": dict(
+        compression="zlib",
+        complevel=4,
+        shuffle=True,
+        float32=(),
+        chunks={"time": 1},
+        max_chunk_bytes=64 * 2**20,
+    ),
+    "matrix-build": dict(
+        compression="zlib",
+        complevel=1,
+        shuffle=True,
+        float32=("thetao", "so", "agessc"),
+        chunks={"time": 1},
+        max_chunk_bytes=256 * 2**20,
+    ),
+}
+# Diagnostics computed by the pipeline are stored like the archives
+# (a separate name, so that the outputs of each kind can be retuned on their own)
+PROFILES["derived"] = PROFILES["archive"]
+
+
+def _chunksizes(da, chunks, max_chunk_bytes, itemsize):
+    """
+    return the chunk sizes of `da` for the profile `chunks`, capped at `max_chunk_bytes`
+    """
+    sizes = [da.sizes[dim] if chunks.get(dim, -1) == -1 else min(chunks[dim], da.sizes[dim]) for dim in da.dims]
+    # split the largest non-time dimension until chunks fit
+    splittable = [i for i, dim in enumerate(da.dims) if dim != "time"]
+    while splittable and int(np.prod(sizes)) * itemsize > max_chunk_bytes:
+        i = max(splittable, key=lambda i: sizes[i])
+        if sizes[i] == 1:
+            break
+        sizes[i] = -(-sizes[i] // 2)
+    return [max(size, 1) for size in sizes]
+
+
+def variable_encoding(da, profile, chunks=None, name=None):
+    """
+    return the encoding of data variable `da` (named `name`, default `da.name`) for `profile`
+
+    `chunks` (dim -> size, -1 for full extent) overrides the chunk sizes of the
+    profile and is not capped (e.g., a full time series per chunk).
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"profile has to be one of {list(PROFILES)}, got {profile}")
+    settings = PROFILES[profile]
+    encoding = dict(shuffle=settings["shuffle"], complevel=settings["complevel"])
+    if settings["compression"] == "zlib":
+        encoding["zlib"] = True
+    else:
+        encoding["compression"] = settings["compression"]
+    dtype = da.dtype
+    name = da.name if name is None else name
+    if name in settings["float32"] and dtype == np.float64:
+        dtype = np.dtype(np.float32)
+        encoding["dtype"] = "float32"
+    if da.ndim > 0:
+        sizes = _chunksizes(da, settings["chunks"], settings["max_chunk_bytes"], dtype.itemsize)
+        for i, dim in enumerate(da.dims):
+            if chunks is not None and dim in chunks:
+                sizes[i] = da.sizes[dim] if chunks[dim] == -1 else min(chunks[dim], da.sizes[dim])
+        encoding["chunksizes"] = sizes
+    return encoding
+
+
+def encoding_for(obj, profile, chunks=None):
+    """
+    return the `to_netcdf` encoding of every data variable of `obj` (Dataset or DataArray) for `profile`
+    """
+    import xarray as xr
+    if isinstance(obj, xr.DataArray):
+        # (xarray saves unnamed DataArrays under this name)
+        variables = {"__xarray_dataarray_variable__" if obj.name is None else obj.name: obj}
+    else:
+        variables = obj.data_vars
+    return {name: variable_encoding(da, profile, chunks, name) for name, da in variables.items()}
+
+
+def save_netcdf(obj, path, profile, chunks=None, **kwargs):
+    """
+    `obj.to_netcdf(path)` with the encoding of `profile`
+    """
+    return obj.to_netcdf(path, encoding=encoding_for(obj, profile, chunks), **kwargs)
@@ -0,0 +1,358 @@
+"""
+Streaming statistics over the members of an ensemble.
+
+Computing `ensemblemean`, `ensemblestd`, `ensemblemax`, and `ensemblemin` of
+a lazy `member`-concatenated field as separate graphs (each followed by its
+own write) re-reads every member's files for each statistic, unless dask
+happens to keep them in memory. Instead, `ensemble_stats` visits the members
+one at a time: each member's field (e.g., the time mean of its age) is
+computed, then folded into running accumulators (Welford's mean and sum of
+squared deviations, and minimum/maximum), so that memory is bounded by one
+member plus the accumulators, and all statistics come from a single read.
+
+NaNs are skipped like xarray's `mean`/`std`/`min`/`max` (e.g., a point that
+is NaN in some members only is reduced over the others).
+
+Exact ensemble quantiles would need all members of every cell in memory.
+Instead, `ensemble_histogram` bins each member into per-cell histograms with
+fixed bins (`nbins` bins between the ensemble minimum and maximum of each
+cell, from `ensemble_stats`). The histogram of each member is computed on
+the dask workers, from the member's lazily opened field, and they are merged
+by summing them, and
+`histogram_quantiles` interpolates approximate quantiles (e.g., the median
+and the 5-95% range) from the merged histograms, within one bin width of
+the exact ones.
+
+Member outputs are found with `index_ensemble_outputs`, from the index of
+the output tree of `tmip.layout` (walked once, instead of stat-ing a guessed
+path for each of the possible members), and `open_ensemble` concatenates the
+files of the available members along a `member` dimension.
+
+`ensemble_timemean_diagnostics` chains these for the diagnose scripts
+(e.g., `diagnose_cyclo.py`): all-member time means (written to disk and
+read back one member at a time), statistics, histograms, and quantiles of the
+time mean of a member output.
+"""
+
+# Import numpy
+import numpy as np
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalog import extract_numbers, sort_members
+from tmip.layout import SCRATCH_DATADIR, index_outputs, find_outputs
+from tmip.output import save_output, open_output
+from tmip.averaging import write_outputs
+
+# Statistics returned by `ensemble_stats` (suffixes of the variable names)
+STATS = ("ensemblemean", "ensemblestd", "ensemblemax", "ensemblemin")
+
+# Default number of histogram bins and quantiles
+# (with fewer than 256 members, counts are `uint8`, i.e., 32 B per cell,
+# against 8 B per member and cell for the exact quantiles of a float64 stack)
+NBINS = 32
+QUANTILES = (0.05, 0.5, 0.95)
+
+# Target size of each block of histogram counts
+HISTOGRAM_BLOCK_BYTES = 64 * 2**20
+
+# Columns of the index of member outputs
+INDEX_COLUMNS = ["member", "window", "lumpby", "variable", "path"]
+
+
+def index_ensemble_outputs(model, experiment, root=SCRATCH_DATADIR, use_cache=True):
+    """
+    return the index (a DataFrame, see `INDEX_COLUMNS`) of every member output of `model`/`experiment` under `root`
+
+    Outputs are the "cyclo" products of `tmip.layout`, i.e.,
+    `{model}/{experiment}/{member}/{window}/cyclo{lumpby}/{variable}.nc`
+    (e.g., `r1i1p1f1/Jan1990-Dec1999/cyclomonth/ideal_mean_age.nc`),
+    found by `tmip.layout.index_outputs` (a single, cached, walk of the tree).
+    """
+    import pandas as pd
+    outputs = find_outputs(index_outputs(root, model, experiment, use_cache), product="cyclo")
+    rows = [[key.member, key.window, key.lumpby, key.variable, path] for key, path in outputs]
+    # (members in r/i/p/f order)
+    rows.sort(key=lambda row: (extract_numbers(row[0]), row))
+    index = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+    print(f"Indexed {len(index)} outputs of {index.member.nunique()} members of: ", model, experiment)
+    return index
+
+
+def select_ensemble(index, variable, window, lumpby, members=None):
+    """
+    return the rows of `index` for `variable` in `window` and `lumpby` (of `members` only, if given, e.g., `["r1i1p1f1"]`)
+    """
+    selected = index[(index.variable == variable) & (index.window == window) & (index.lumpby == lumpby)]
+    if members is not None:
+        selected = selected[selected.member.isin(members)]
+    return selected
+
+
+def ensemble_members(index, variable, window, lumpby):
+    """
+    return the (sorted) labels of the members with output `variable` in `window` and `lumpby`
+
+    Members are keyed by their full label, so that members that only differ
+    in their initialization/physics/forcing (e.g., `r1i1p1f1` and `r1i2p1f1`)
+    are kept apart.
+    """
+    return sort_members(select_ensemble(index, variable, window, lumpby).member)
+
+
+def open_ensemble(index, variable, window, lumpby, members=None, chunks=None):
+    """
+    open the `variable` outputs of the members of `index` as a lazy dataset concatenated along `member`
+
+    `member` is the member label (e.g., `r1i1p1f1`). Each file gets
+    its own `member` coordinate before concatenation, so that every data
+    variable is concatenated (no need for `data_vars='all'`).
+    """
+    import xarray as xr
+    selected = select_ensemble(index, variable, window, lumpby, members)
+    if selected.empty:
+        raise ValueError(f"No {variable} outputs for {window} cyclo{lumpby} (members {members})")
+    datasets = [
+        open_output(path, chunks={} if chunks is None else chunks).expand_dims(member=[member])
+        for member, path in zip(selected.member, selected.path)
+    ]
+    return xr.concat(datasets, dim="member", data_vars="minimal", coords="minimal", compat="override", join="outer")
+
+
+def new_accumulators(shape):
+    """
+    return empty accumulators for fields of `shape`
+    """
+    return dict(
+        count=np.zeros(shape),
+        mean=np.zeros(shape),
+        m2=np.zeros(shape),
+        max=np.full(shape, np.nan),
+        min=np.full(shape, np.nan),
+    )
+
+
+def update_accumulators(acc, x):
+    """
+    fold the field `x` (numpy array) of one more member into the accumulators `acc` (Welford)
+    """
+    valid = ~np.isnan(x)
+    x0 = np.where(valid, x, 0)
+    acc["count"] += valid
+    delta = np.where(valid, x0 - acc["mean"], 0)
+    acc["mean"] += delta / np.maximum(acc["count"], 1)
+    acc["m2"] += delta * (x0 - acc["mean"])
+    acc["max"] = np.fmax(acc["max"], x)
+    acc["min"] = np.fmin(acc["min"], x)
+    return acc
+
+
+def finalize_accumulators(acc, ddof=0):
+    """
+    return the mean, standard deviation (with `ddof` like xarray's `std`), maximum, and minimum from `acc`
+    """
+    count = acc["count"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, acc["mean"], np.nan)
+        std = np.sqrt(np.where(count > ddof, acc["m2"] / (count - ddof), np.nan))
+    return mean, std, acc["max"], acc["min"]
+
+
+def ensemble_stats(members, field, name, ddof=0):
+    """
+    return a Dataset of the ensemble statistics (see `STATS`) of `field(member)` over `members`, in one pass
+
+    `field(member)` returns the (lazy or not) DataArray of one member, which is
+    computed and folded into the accumulators before the next member is
+    visited (nothing else is kept). The variables are named `{name}_{stat}`
+    (e.g., `age_ensemblemean`).
+    """
+    import xarray as xr
+    acc = None
+    template = None
+    for i, member in enumerate(members):
+        print(f"Reducing member {member} ({i + 1}/{len(members)})")
+        da = field(member).compute()
+        if acc is None:
+            template = da
+            acc = new_accumulators(da.shape)
+        elif da.dims != template.dims or da.shape != template.shape:
+            raise ValueError(f"Member {member} has dims {dict(da.sizes)}, expected {dict(template.sizes)}")
+        update_accumulators(acc, da.values.astype(np.float64))
+    if acc is None:
+        raise ValueError(f"No members to reduce for {name}")
+    dtype = np.result_type(template.dtype, np.float32)
+    stats = finalize_accumulators(acc, ddof)
+    return xr.Dataset({
+        f'{name}_{stat}': template.copy(data=values.astype(dtype))
+        for stat, values in zip(STATS, stats)
+    })
+
+
+def _histogram_kernel(x, lo, hi, nbins, dtype):
+    """
+    return the counts (1, nbins, ...) of the members (first axis) of block `x` in the `nbins` bins between `lo` and `hi`
+    """
+    shape = x.shape[1:]
+    counts = np.zeros((nbins, int(np.prod(shape))), dtype=dtype)
+    cells = np.arange(counts.shape[1])
+    width = (hi - lo) / nbins
+    for member in x.reshape(x.shape[0], -1):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            index = np.where(width.ravel() > 0, np.floor((member - lo.ravel()) / width.ravel()), 0)
+        valid = ~np.isnan(member) & ~np.isnan(index)
+        index = np.clip(index[valid], 0, nbins - 1).astype(np.intp)
+        np.add.at(counts, (index, cells[valid]), 1)
+    return counts.reshape((1, nbins) + shape)
+
+
+def ensemble_histogram(da, lo, hi, nbins=NBINS, dim="member"):
+    """
+    return the lazy per-cell histogram counts (`bin` first) of `da` over `dim`, with `nbins` bins between `lo` and `hi`
+
+    `lo`/`hi` (e.g., the `ensemblemin`/`ensemblemax` of `ensemble_stats`) set
+    the bins of each cell. Each member of `da` is binned on its own, on the
+    dask workers, and the histograms of all members are merged by summing
+    (tree reduction), so that the members are never stacked in memory.
+    `da`, `lo`, and `hi` should be opened lazily from disk (e.g., with
+    `tmip.output.open_output`), so that every worker reads its own member
+    instead of receiving it from the client.
+    The other dimensions are rechunked so that each block of counts is about
+    `HISTOGRAM_BLOCK_BYTES`. Counts are the smallest unsigned integers that
+    fit the number of members.
+    """
+    import dask
+    import dask.array
+    import xarray as xr
+    da = da.transpose(dim, ...)
+    dtype = np.uint8 if da.sizes[dim] < 2**8 else np.uint16 if da.sizes[dim] < 2**16 else np.uint32
+    cells = max(1, HISTOGRAM_BLOCK_BYTES // (nbins * np.dtype(dtype).itemsize))
+    with dask.config.set({"array.chunk-size": f"{cells * da.dtype.itemsize}B"}):
+        da = da.chunk({d: (1 if d == dim else "auto") for d in da.dims})
+    spatial = da.isel({dim: 0}, drop=True)
+    lo = lo.broadcast_like(spatial).transpose(*spatial.dims).chunk(dict(zip(spatial.dims, da.chunks[1:])))
+    hi = hi.broadcast_like(spatial).transpose(*spatial.dims).chunk(dict(zip(spatial.dims, da.chunks[1:])))
+    counts = dask.array.map_blocks(
+        _histogram_kernel,
+        da.data,
+        lo.data[None].astype(np.float64),
+        hi.data[None].astype(np.float64),
+        nbins,
+        dtype,
+        new_axis=1,
+        chunks=((1,) * len(da.chunks[0]), (nbins,)) + da.chunks[1:],
+        dtype=dtype,
+    ).sum(axis=0, dtype=dtype)
+    return xr.DataArray(counts, dims=("bin",) + spatial.dims, coords=spatial.coords)
+
+
+def _order_statistic(counts, cdf, rank, lo, width):
+    """
+    return the value of the sample of (0-based) `rank`, spreading the samples of each bin evenly within it
+    """
+    k = np.minimum(np.argmax(cdf >= rank[..., None] + 1, axis=-1), counts.shape[-1] - 1)[..., None]
+    inbin = np.take_along_axis(counts, k, axis=-1)[..., 0]
+    before = np.take_along_axis(cdf, k, axis=-1)[..., 0] - inbin
+    with np.errstate(invalid="ignore", divide="ignore"):
+        frac = np.clip((rank - before + 0.5) / inbin, 0, 1)
+    return lo + (k[..., 0] + frac) * width
+
+
+def _quantiles_kernel(counts, lo, hi, q):
+    """
+    return the quantiles `q` (last axis) interpolated from `counts` (bins last) between `lo` and `hi`
+
+    Like numpy's default (linear) quantiles, between the two samples around
+    rank `q * (n - 1)`, located within their bins.
+    """
+    nbins = counts.shape[-1]
+    cdf = np.cumsum(counts, axis=-1, dtype=np.float64)
+    total = cdf[..., -1]
+    width = (hi - lo) / nbins
+    out = np.full(counts.shape[:-1] + (len(q),), np.nan)
+    for i, quantile in enumerate(q):
+        position = quantile * np.maximum(total - 1, 0)
+        below = np.floor(position)
+        above = np.minimum(below + 1, np.maximum(total - 1, 0))
+        frac = position - below
+        value = ((1 - frac) * _order_statistic(counts, cdf, below, lo, width)
+                 + frac * _order_statistic(counts, cdf, above, lo, width))
+        out[..., i] = np.where(total > 0, value, np.nan)
+    return out
+
+
+def histogram_quantiles(counts, lo, hi, q=QUANTILES):
+    """
+    return the approximate quantiles `q` (`quantile` dimension) from the histogram `counts` of `ensemble_histogram`
+    """
+    import xarray as xr
+    quantiles = xr.apply_ufunc(
+        _quantiles_kernel,
+        counts, lo, hi,
+        kwargs=dict(q=list(q)),
+        input_core_dims=[["bin"], [], []],
+        output_core_dims=[["quantile"]],
+        dask="parallelized",
+        output_dtypes=[np.float64],
+        dask_gufunc_kwargs=dict(output_sizes=dict(quantile=len(q))),
+    )
+    quantiles = quantiles.assign_coords(quantile=list(q)).transpose("quantile", ...)
+    return quantiles.astype(np.result_type(lo.dtype, np.float32))
+
+
+def ensemble_timemean_diagnostics(index, variable, data_variable, window, lumpby, outputdir,
+                                  timedim="Ti", chunks=None, label="", profile="derived"):
+    """
+    write the ensemble diagnostics of the time mean of `data_variable` (from the `variable` outputs of `index`) to `outputdir`
+
+    With `name = data_variable` (e.g., `age` from the `ideal_mean_age` outputs), writes:
+    - `{name}_timemean.nc`, the time means of all members (along `member`),
+      computed lazily from the member outputs (like the baseline),
+    - `{name}_ensemblemean/std/max/min.nc`, from one pass over the members of
+      `{name}_timemean.nc`, read back one member at a time (see `ensemble_stats`),
+    - `{name}_ensemblehistogram.nc` (with the bin edges `_min`/`_max`) and
+      `{name}_ensemblequantiles.nc` (see `ensemble_histogram`/`histogram_quantiles`).
+    Memory is bounded by one member plus the accumulators. Returns the statistics.
+    """
+    import xarray as xr
+    name = data_variable
+    members = ensemble_members(index, variable, window, lumpby)
+    print("Members: ", members)
+
+    # Time means of all members, written chunk by chunk (one member per chunk,
+    # so that each member is read back on its own below)
+    ds = open_ensemble(index, variable, window, lumpby, members=members, chunks=chunks)
+    timemean_all = ds[data_variable].mean(dim=[timedim])
+    print(f"\n{name}_timemean: ", timemean_all)
+    timemeanpath = f'{outputdir}/{name}_timemean.nc'
+    save_output(timemean_all.to_dataset(name=f'{name}_timemean'), timemeanpath, profile, chunks={"member": 1}, compute=True)
+    timemean_all = open_output(timemeanpath, chunks={"member": 1})[f'{name}_timemean']
+
+    # Single pass over the members: each member's time mean is read once,
+    # and folded into the ensemble mean/std/max/min accumulators
+    stats = ensemble_stats(members, lambda member: timemean_all.sel(member=member, drop=True), name)
+    print(f"\n{name}_stats: ", stats)
+    write_outputs({s: stats[[s]] for s in stats.data_vars}, outputdir, label=label, profile=profile)
+
+    # Ensemble quantiles (median and 5-95% range) from per-cell histograms
+    # (binned between the ensemble min and max of each cell), merged across members
+    # (the bin edges are read back lazily too, so that the workers read them from disk)
+    ensemblemin = open_output(f'{outputdir}/{name}_ensemblemin.nc', chunks={})[f'{name}_ensemblemin']
+    ensemblemax = open_output(f'{outputdir}/{name}_ensemblemax.nc', chunks={})[f'{name}_ensemblemax']
+    histogram = ensemble_histogram(timemean_all, ensemblemin, ensemblemax)
+    print(f"\n{name}_ensemblehistogram: ", histogram)
+    quantiles = histogram_quantiles(histogram.chunk({"bin": -1}), ensemblemin, ensemblemax)
+    print(f"\n{name}_ensemblequantiles: ", quantiles)
+    write_outputs(
+        {
+            f'{name}_ensemblehistogram': xr.Dataset({
+                f'{name}_ensemblehistogram': histogram,
+                f'{name}_ensemblehistogram_min': ensemblemin,
+                f'{name}_ensemblehistogram_max': ensemblemax,
+            }),
+            f'{name}_ensemblequantiles': quantiles.to_dataset(name=f'{name}_ensemblequantiles'),
+        },
+        outputdir,
+        label=label,
+        profile=profile,
+    )
+    return stats
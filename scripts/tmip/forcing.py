@@ -0,0 +1,72 @@
+"""
+Monthly reductions of high-frequency atmospheric forcing (e.g., JRA55-do 3-hourly winds).
+
+Computing `uas**2 + vas**2` and then `resample(time="1ME").mean()` builds
+two graph layers (the squared sum is materialized before it is averaged)
+and, when years are processed in a serial loop, the dask client only ever
+sees one small graph at a time. Instead, `monthly_speed_squared` computes
+the monthly means of the squared wind speed with a single blockwise kernel
+(each block of a year of `uas`/`vas` is squared, summed, and averaged by
+month in one pass), and the scripts submit every year at once with a bounded
+number of writes in flight (see `tmip.averaging.write_tasks`), before
+concatenating the monthly means of all years into a single compressed file.
+"""
+
+# Import numpy
+import numpy as np
+
+# Chunks to open a year of 3-hourly forcing with (whole year per block, so that months are not split)
+YEAR_CHUNKS = {"time": -1, "lat": 16}
+
+
+def _month_index(time):
+    """
+    return the (month index of each time, month labels) of the `time` coordinate
+
+    Labels are the month ends, like `resample(time="1ME")`.
+    """
+    import xarray as xr
+    months = time.dt.year.values * 12 + time.dt.month.values
+    _, index = np.unique(months, return_inverse=True)
+    labels = xr.DataArray(np.ones(time.size), coords=dict(time=time)).resample(time="1ME").count().time
+    return index, labels
+
+
+def _monthly_speed_squared_kernel(u, v, index, nmonths):
+    """
+    return the monthly means of `u**2 + v**2` (time last), one month at a time
+
+    NaNs are skipped like xarray's `mean`.
+    """
+    out = np.empty(u.shape[:-1] + (nmonths,), dtype=np.result_type(u.dtype, np.float32))
+    for month in range(nmonths):
+        um = u[..., index == month]
+        vm = v[..., index == month]
+        with np.errstate(invalid="ignore"):
+            out[..., month] = np.nanmean(um * um + vm * vm, axis=-1)
+    return out
+
+
+def monthly_speed_squared(uas, vas):
+    """
+    return the lazy monthly means of the squared wind speed `uas**2 + vas**2` (named `u2`)
+
+    `uas` and `vas` must be colocated and chunked with whole months in each
+    block (e.g., opened with `YEAR_CHUNKS`).
+    """
+    import xarray as xr
+    index, labels = _month_index(uas.time)
+    u2 = xr.apply_ufunc(
+        _monthly_speed_squared_kernel,
+        uas, vas,
+        kwargs=dict(index=index, nmonths=labels.size),
+        input_core_dims=[["time"], ["time"]],
+        output_core_dims=[["month"]],
+        exclude_dims={"time"},
+        dask="parallelized",
+        output_dtypes=[np.result_type(uas.dtype, np.float32)],
+        dask_gufunc_kwargs=dict(output_sizes=dict(month=labels.size)),
+    )
+    u2 = u2.rename(month="time").assign_coords(time=labels.values).transpose("time", ...)
+    u2.attrs = dict(long_name="monthly mean of squared wind speed (uas^2 + vas^2)", units="m2 s-2")
+    return u2.rename("u2")
@@ -0,0 +1,81 @@
+"""
+Helpers to open files written by earlier stages of the pipeline.
+
+Raw model history files (e.g., ACCESS-ESM `ocean_month.nc-YYYY1231`) contain
+hundreds of diagnostics: pass `keep_variables` to `open_my_dataset` to only
+decode the requested variables and their coordinate dependencies
+(see `variables_to_drop`) instead of maintaining a `drop_variables` list.
+"""
+
+# Load xarray for N-dimensional arrays
+import xarray as xr
+
+
+def needed_variables(nc, keep_variables):
+    """
+    return the names of `keep_variables` and of the variables they depend on in the open netCDF4 dataset `nc`
+
+    Dependencies are the coordinate variables of their dimensions and the
+    variables referenced by their `coordinates` and `bounds` attributes
+    (recursively). Only the file header is read.
+    """
+    needed = set()
+    stack = list(keep_variables)
+    while stack:
+        name = stack.pop()
+        if name in needed or name not in nc.variables:
+            continue
+        needed.add(name)
+        var = nc.variables[name]
+        stack.extend(var.dimensions)
+        for attr in ("coordinates", "bounds"):
+            if attr in var.ncattrs():
+                stack.extend(var.getncattr(attr).split())
+    return needed
+
+
+def variables_to_drop(paths, keep_variables):
+    """
+    return the variables of the files in `paths` that are not needed for `keep_variables`
+
+    Each file header is checked, so that a diagnostic added to some files only
+    is dropped too.
+    """
+    import netCDF4
+    drop = set()
+    for path in paths:
+        with netCDF4.Dataset(path) as nc:
+            drop |= set(nc.variables) - needed_variables(nc, keep_variables)
+    return sorted(drop)
+
+
+def open_my_dataset(paths, chunks=None, concat_dim="time", data_vars='minimal', keep_variables=None):
+    """
+    open all files and combine them along `concat_dim`
+
+    Defaults are for time-concatenation of monthly files. For concatenating
+    members, pass e.g. `concat_dim=[members_axis]` and `data_vars='all'`
+    (with `data_vars='minimal'` only one member is loaded it seems).
+    With `keep_variables`, every other variable (except coordinate dependencies)
+    is dropped before decoding.
+    """
+    if chunks is None:
+        chunks = {'time':-1, 'st_ocean':-1}
+    drop_variables = None if keep_variables is None else variables_to_drop(paths, keep_variables)
+    ds = xr.open_mfdataset(
+        paths,
+        chunks=chunks,
+        concat_dim=concat_dim,
+        compat='override',
+        preprocess=None,
+        engine='netcdf4',
+        data_vars=data_vars,
+        coords='minimal',
+        combine='nested',
+        parallel=True,
+        join='outer',
+        attrs_file=None,
+        combine_attrs='override',
+        drop_variables=drop_variables,
+    )
+    return ds
@@ -0,0 +1,290 @@
+"""
+Registry of the layout of the files written by the pipeline.
+
+Output paths used to be rebuilt by f-strings in every script (e.g.,
+`f'{datadir}/{model}/{experiment}/{member}/{start_time_str}-{end_time_str}/cyclo{lumpby}'`),
+each with its own copy of the special cases (CSIRO member labels are the
+CMIP6 realization + 4, the 2010s "decade" of the archived files is 2010-2014
+for historical and 2015-2019 for scenarios). Here, every product has a single
+path template (`LAYOUTS`), and an `OutputKey` (product, model, experiment,
+member, window, lumpby, variable, decade) maps to its path (`output_path`)
+and back (`parse_output_path`).
+
+`index_outputs` walks a data directory once and returns the keys of every
+existing product (key -> path, for O(1) lookups instead of globbing), cached
+under `$TMIP_CACHE_DIR/layout` and reused as long as none of the walked
+directories has changed.
+"""
+
+# Import os for paths/walking
+import os
+
+# Load re/string/json/hashlib to parse paths and cache the index
+import re
+import string
+import json
+import hashlib
+
+# Load namedtuple for the keys
+from collections import namedtuple
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.timewindow import time_window_strings
+from tmip.catalogcache import cache_root
+
+# Data directories
+SCRATCH_DATADIR = '/scratch/xv83/TMIP/data'
+GDATA_DATADIR = '/g/data/xv83/TMIP/data'
+
+# Path templates of each product (relative to a data directory)
+LAYOUTS = dict(
+    # time mean over a window (e.g., `average_unarchived_CMIP6_ACCESS_GM_variables.py`)
+    average="{model}/{experiment}/{member}/{window}/{variable}.nc",
+    # monthly/seasonal climatology over a window (e.g., `cyclo_average_*.py`)
+    cyclo="{model}/{experiment}/{member}/{window}/cyclo{lumpby}/{variable}.nc",
+    # ensemble diagnostics (e.g., `diagnose_cyclo.py`)
+    ensemble="{model}/{experiment}/all_members/{window}/cyclo{lumpby}/{variable}.nc",
+    # decadal archives of raw monthly output (e.g., `archive_unarchived_CMIP6_ACCESS_GM_files.py`)
+    archive="{model}/{experiment}/{member}/month_{variable}_{decade}s.nc",
+)
+
+# Patterns of the fields of the templates
+FIELD_PATTERNS = dict(
+    model=r"[^/]+",
+    experiment=r"[^/]+",
+    member=r"(?!all_members/)[^/]+",
+    window=r"[A-Z][a-z]{2}\d+-[A-Z][a-z]{2}\d+",
+    lumpby=r"month|season",
+    variable=r"[^/]+?",
+    decade=r"\d{4}",
+)
+
+# Key of a product (fields not in the template of the product are None)
+OutputKey = namedtuple(
+    "OutputKey",
+    ["product", "model", "experiment", "member", "window", "lumpby", "variable", "decade"],
+    defaults=(None,) * 7,
+)
+
+
+def CMIP6_member(member):
+    """
+    return the CMIP6 label of realization `member` (e.g., 1 -> `r1i1p1f1`)
+    """
+    return f'r{member}i1p1f1'
+
+
+def CSIRO_experiment(experiment):
+    """
+    return the CSIRO label of `experiment` (`HI` for historical, `SSP-370` otherwise)
+    """
+    if experiment == 'historical':
+        return 'HI'
+    else:
+        return 'SSP-370'
+
+
+def CSIRO_member(experiment, member):
+    """
+    return the CSIRO label of CMIP6 realization `member` of `experiment` (e.g., `HI-05` for 1)
+    """
+    return f'{CSIRO_experiment(experiment)}-{member+4:02d}' # note the +4!
+
+
+def parse_CSIRO_member(label):
+    """
+    return the CMIP6 realization of CSIRO member `label` (e.g., `HI-05` -> 1)
+    """
+    return int(label.rsplit("-", 1)[1]) - 4
+
+
+def decade_years(decade, experiment):
+    """
+    return the years archived in the file of `decade`
+
+    Historical runs go from 1850 to 2015, and future scenarios from 2015 to 2100,
+    so the 2010s are 2010-2014 for historical and 2015-2019 for scenarios.
+    """
+    if decade == 2010:
+        if (experiment == "historical"):
+            return range(2010, 2015)
+        else:
+            return range(2015, 2020)
+    else:
+        return range(decade, decade + 10)
+
+
+def window_string(year_start, num_years):
+    """
+    return the directory name of a time window (e.g., `Jan1990-Dec1999`)
+    """
+    start_time, end_time = time_window_strings(year_start, num_years)
+    return f'Jan{start_time}-Dec{end_time}'
+
+
+def parse_window(window):
+    """
+    return the (year_start, num_years) of time window `window` (e.g., `Jan1990-Dec1999` -> (1990, 10))
+    """
+    start, end = (int(re.sub(r"^[A-Za-z]+", "", s)) for s in window.split("-"))
+    return start, end - start + 1
+
+
+def _template(key):
+    """
+    return the template of the product of `key`
+    """
+    if key.product not in LAYOUTS:
+        raise ValueError(f"product has to be one of {list(LAYOUTS)}, got {key.product}")
+    return LAYOUTS[key.product]
+
+
+def output_path(key, root=SCRATCH_DATADIR):
+    """
+    return the path of the product of `key` under data directory `root`
+    """
+    fields = {k: v for k, v in key._asdict().items() if v is not None}
+    try:
+        return os.path.join(root, _template(key).format(**fields))
+    except KeyError as e:
+        raise ValueError(f"{key} is missing field {e} of the {key.product} layout") from None
+
+
+def output_dir(key, root=SCRATCH_DATADIR):
+    """
+    return the directory of the product of `key` under `root` (only the directory fields are needed)
+    """
+    directory = os.path.dirname(_template(key))
+    fields = {k: v for k, v in key._asdict().items() if v is not None}
+    try:
+        return os.path.join(root, directory.format(**fields))
+    except KeyError as e:
+        raise ValueError(f"{key} is missing field {e} of the {key.product} directory") from None
+
+
+def _regex(template):
+    """
+    return the compiled regex of `template` (with a named group for each field)
+    """
+    pattern = ""
+    for literal, field, _, _ in string.Formatter().parse(template):
+        pattern += re.escape(literal)
+        if field is not None:
+            pattern += f"(?P<{field}>{FIELD_PATTERNS[field]})"
+    return re.compile(f"^{pattern}$")
+
+
+# Compiled regexes of the templates
+LAYOUT_REGEXES = {product: _regex(template) for product, template in LAYOUTS.items()}
+
+
+def parse_output_path(path, root=SCRATCH_DATADIR):
+    """
+    return the `OutputKey` of `path` under data directory `root` (None if it is not a known product)
+    """
+    relpath = os.path.relpath(path, root)
+    for product, regex in LAYOUT_REGEXES.items():
+        match = regex.match(relpath)
+        if match:
+            fields = match.groupdict()
+            if "decade" in fields:
+                fields["decade"] = int(fields["decade"])
+            return OutputKey(product, **fields)
+    return None
+
+
+def _index_file(root, subdir):
+    """
+    return the cache file of the index of `subdir` of `root`
+    """
+    digest = hashlib.sha256(f'{os.path.abspath(root)}:{subdir}'.encode()).hexdigest()[:16]
+    return os.path.join(cache_root(), "layout", f'{digest}.json')
+
+
+def _walk(top):
+    """
+    return the (files, directory modification times) under `top`, from one `os.scandir` per directory
+
+    Zarr stores are listed as the NetCDF file they stand for (e.g., `umo.zarr` as `umo.nc`).
+    """
+    files = []
+    mtimes = {}
+    stack = [top]
+    while stack:
+        path = stack.pop()
+        try:
+            mtimes[path] = os.stat(path).st_mtime
+            with os.scandir(path) as entries:
+                for e in entries:
+                    if ".partial." in e.name:
+                        continue
+                    if e.is_dir() and e.name.endswith(".zarr"):
+                        # (outputs of the "zarr" backend are indexed by their NetCDF path, see `tmip.output`)
+                        files.append(f'{e.path[:-len(".zarr")]}.nc')
+                    elif e.is_dir():
+                        stack.append(e.path)
+                    elif e.name.endswith(".nc"):
+                        files.append(e.path)
+        except FileNotFoundError:
+            continue
+    return files, mtimes
+
+
+def _unchanged(mtimes):
+    """
+    return whether none of the directories of `mtimes` has changed (entries added/removed/renamed)
+    """
+    try:
+        return all(os.stat(path).st_mtime == mtime for path, mtime in mtimes.items())
+    except FileNotFoundError:
+        return False
+
+
+def index_outputs(root=SCRATCH_DATADIR, model=None, experiment=None, use_cache=True):
+    """
+    return the index (`OutputKey` -> path) of the products under `root` (of `model`/`experiment` only, if given)
+
+    The index is cached and reused as long as the walked directories are unchanged.
+    """
+    subdir = "/".join(s for s in (model, experiment) if s is not None)
+    cachefile = _index_file(root, subdir)
+    if use_cache and os.path.isfile(cachefile):
+        with open(cachefile) as f:
+            cached = json.load(f)
+        if _unchanged(cached["mtimes"]):
+            print(f"Loaded cached index of {len(cached['outputs'])} outputs of: ", os.path.join(root, subdir))
+            return {parse_output_path(path, root): path for path in cached["outputs"]}
+    files, mtimes = _walk(os.path.join(root, subdir))
+    files = sorted(set(files))
+    index = {}
+    for path in files:
+        key = parse_output_path(path, root)
+        if key is not None:
+            index[key] = path
+    print(f"Indexed {len(index)} outputs ({len(files)} files in {len(mtimes)} directories) of: ", os.path.join(root, subdir))
+    if use_cache:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        tmp = f'{cachefile}.{os.getpid()}.tmp'
+        with open(tmp, "w") as f:
+            json.dump(dict(outputs=sorted(index.values()), mtimes=mtimes), f)
+        os.replace(tmp, cachefile)
+    return index
+
+
+def find_outputs(index, **fields):
+    """
+    return the (key, path) of the outputs of `index` matching `fields` (e.g., `product="cyclo", variable="umo"`)
+
+    With all the fields of a key, use `index.get(OutputKey(...))` instead (O(1)).
+    """
+    return [(key, path) for key, path in index.items()
+            if all(getattr(key, k) == v for k, v in fields.items())]
+
+
+def index_frame(index):
+    """
+    return `index` as a DataFrame (one row per output, one column per key field and `path`), e.g., to audit outputs
+    """
+    import pandas as pd
+    return pd.DataFrame([dict(key._asdict(), path=path) for key, path in index.items()],
+                        columns=list(OutputKey._fields) + ["path"])
@@ -0,0 +1,106 @@
+"""
+Task ledger to resume sweeps that were interrupted (e.g., by the PBS walltime).
+
+The ledger is an append-only JSON-lines file with one record per status change
+of each output: its task key (e.g., model, experiment, member, time window,
+variable, lumpby), the fingerprint of its inputs (paths, sizes, and
+modification times of the input files, plus any parameters), and its status
+("pending", "done", or "failed"). The last record of each key wins.
+
+On restart, `needs_build` skips outputs whose last record is "done" with the
+same fingerprint and whose file exists. Outputs are written to a partial file
+and renamed when complete (see `tmip.output.save_output`), so an existing file
+is never a partial one.
+"""
+
+# Import os for path/stat
+import os
+
+# Load json/hashlib for the records and fingerprints
+import json
+import hashlib
+
+# Load datetime to timestamp records
+import datetime
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.output import output_exists
+
+
+def task_key(**fields):
+    """
+    return the canonical key of a task (e.g., `task_key(model=..., member=..., variable=...)`)
+    """
+    return json.dumps(fields, sort_keys=True, default=str)
+
+
+def input_fingerprint(paths, **params):
+    """
+    return a fingerprint of the input files `paths` (path, size, and modification time) and `params`
+    """
+    entries = []
+    for path in sorted(paths):
+        stat = os.stat(path)
+        entries.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+    payload = json.dumps(dict(inputs=entries, params=params), sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def load_ledger(path):
+    """
+    load the ledger at `path` (empty if it does not exist yet)
+
+    Returns a dict with the `path` of the ledger, the last `records` of each
+    task key, and the `pending` outputs of this run (output -> (key, fingerprint)).
+    """
+    records = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # (last line of a job killed while appending)
+                    continue
+                records[record["key"]] = record
+    print(f"Loaded {len(records)} task records from ledger: ", path)
+    return dict(path=path, records=records, pending={})
+
+
+def _append(ledger, record):
+    """
+    append `record` to the ledger file (and to its records)
+    """
+    record["time"] = datetime.datetime.now().isoformat(timespec="seconds")
+    ledger["records"][record["key"]] = record
+    os.makedirs(os.path.dirname(os.path.abspath(ledger["path"])), exist_ok=True)
+    with open(ledger["path"], "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def needs_build(ledger, output, key, fingerprint):
+    """
+    return False if `output` of task `key` is done with the same input `fingerprint`, else register it as pending
+
+    `ledger=None` always builds (no ledger).
+    """
+    if ledger is None:
+        return True
+    record = ledger["records"].get(key)
+    if (record is not None and record["status"] == "done" and record["fingerprint"] == fingerprint
+            and record["output"] == output and output_exists(output)):
+        print("Skipping (already built): ", output)
+        return False
+    ledger["pending"][output] = (key, fingerprint)
+    _append(ledger, dict(key=key, fingerprint=fingerprint, output=output, status="pending"))
+    return True
+
+
+def record_status(ledger, output, status):
+    """
+    record the `status` ("done" or "failed") of pending `output` (no-op without ledger or if not pending)
+    """
+    if ledger is None or output not in ledger["pending"]:
+        return
+    key, fingerprint = ledger["pending"].pop(output)
+    _append(ledger, dict(key=key, fingerprint=fingerprint, output=output, status=status))
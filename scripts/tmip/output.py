@@ -0,0 +1,223 @@
+"""
+Pluggable output backend for the files written by the pipeline.
+
+`to_netcdf` goes through a single HDF5 writer (and the HDF5 lock), so writes
+do not scale with the number of dask workers. With the "zarr" backend,
+`save_output(ds, f'{outputdir}/umo.nc', ...)` instead writes `umo.zarr`, with
+each worker writing its own chunks in parallel. Zarr stores can optionally be
+consolidated into the usual NetCDF file (`umo.nc`) for the Julia consumers.
+
+The backend is selected with `$TMIP_OUTPUT_BACKEND` ("netcdf", the default, or
+"zarr") and consolidation with `$TMIP_CONSOLIDATE_NETCDF=1`, so that the same
+scripts (and PBS jobs) can be switched without editing them.
+"""
+
+# Import os for environment variables/paths
+import os
+
+# Load shutil to replace existing Zarr stores
+import shutil
+
+# Available output backends
+BACKENDS = ("netcdf", "zarr")
+
+# Name under which xarray saves unnamed DataArrays
+UNNAMED = "__xarray_dataarray_variable__"
+
+
+def output_backend(backend=None):
+    """
+    return `backend`, or the one set by `$TMIP_OUTPUT_BACKEND` (default "netcdf")
+    """
+    backend = os.environ.get("TMIP_OUTPUT_BACKEND", "netcdf") if backend is None else backend
+    if backend not in BACKENDS:
+        raise ValueError(f"output backend has to be one of {BACKENDS}, got {backend}")
+    return backend
+
+
+def consolidate_netcdf(consolidate=None):
+    """
+    return `consolidate`, or whether `$TMIP_CONSOLIDATE_NETCDF` is set (to anything but "0")
+    """
+    if consolidate is None:
+        return os.environ.get("TMIP_CONSOLIDATE_NETCDF", "0") not in ("", "0")
+    return consolidate
+
+
+def zarr_path(path):
+    """
+    return the Zarr store path for NetCDF file `path` (e.g., `umo.nc` -> `umo.zarr`)
+    """
+    root, ext = os.path.splitext(path)
+    return f'{root}.zarr' if ext == ".nc" else f'{path}.zarr'
+
+
+def partial_path(path):
+    """
+    return the path to write `path` to before it is complete (e.g., `umo.nc` -> `umo.partial.nc`)
+    """
+    root, ext = os.path.splitext(path)
+    return f'{root}.partial{ext}'
+
+
+def output_exists(path, backend=None):
+    """
+    return whether output `path` exists (its Zarr store with the "zarr" backend)
+    """
+    if output_backend(backend) == "zarr":
+        return os.path.isdir(zarr_path(path))
+    return os.path.isfile(path)
+
+
+def open_output(path, backend=None, **kwargs):
+    """
+    open output `path` written by `save_output` (its Zarr store with the "zarr" backend)
+
+    `kwargs` are passed to `xr.open_dataset` (e.g., `chunks`).
+    """
+    import xarray as xr
+    if output_backend(backend) == "zarr":
+        return xr.open_dataset(zarr_path(path), engine="zarr", **kwargs)
+    return xr.open_dataset(path, engine="netcdf4", **kwargs)
+
+
+def open_outputs(paths, concat_dim="time", backend=None, **kwargs):
+    """
+    open outputs `paths` written by `save_output` and combine them along `concat_dim` (their Zarr stores with the "zarr" backend)
+
+    Defaults are those of `tmip.io.open_my_dataset` (e.g., for per-year
+    intermediate files); `kwargs` are passed to `xr.open_mfdataset` (e.g., `chunks`).
+    """
+    import xarray as xr
+    if output_backend(backend) == "zarr":
+        paths, engine = [zarr_path(path) for path in paths], "zarr"
+    else:
+        engine = "netcdf4"
+    kwargs = dict(dict(
+        compat='override',
+        data_vars='minimal',
+        coords='minimal',
+        combine='nested',
+        parallel=True,
+        join='outer',
+        combine_attrs='override',
+    ), **kwargs)
+    return xr.open_mfdataset(paths, concat_dim=concat_dim, engine=engine, **kwargs)
+
+
+def remove_output(path):
+    """
+    remove output `path` and its Zarr store (e.g., intermediate files that are no longer needed)
+    """
+    if os.path.isfile(path):
+        os.remove(path)
+    if os.path.isdir(zarr_path(path)):
+        shutil.rmtree(zarr_path(path))
+
+
+def finalize_output(path, backend=None):
+    """
+    rename the complete partial output of `path` (see `partial_path`) to `path`
+    """
+    if output_backend(backend) == "zarr":
+        partial, path = zarr_path(partial_path(path)), zarr_path(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    else:
+        partial = partial_path(path)
+    os.replace(partial, path)
+    return path
+
+
+def _as_dataset(obj):
+    """
+    return `obj` as a Dataset (DataArrays are named like `to_netcdf` does)
+    """
+    import xarray as xr
+    if isinstance(obj, xr.DataArray):
+        return obj.to_dataset(name=UNNAMED if obj.name is None else obj.name)
+    return obj
+
+
+def _zarr_compression(settings):
+    """
+    return the Zarr encoding of the compression of NetCDF encoding `settings` (see `tmip.encoding`)
+
+    Blosc applies the same compressor (zlib or zstd), level, and byte shuffle.
+    """
+    import zarr
+    cname = "zlib" if settings.get("zlib") else settings["compression"]
+    shuffle = settings.get("shuffle", False)
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        compressor = BloscCodec(cname=cname, clevel=settings["complevel"], shuffle="shuffle" if shuffle else "noshuffle")
+        return dict(compressors=(compressor,))
+    from numcodecs import Blosc
+    compressor = Blosc(cname=cname, clevel=settings["complevel"], shuffle=Blosc.SHUFFLE if shuffle else Blosc.NOSHUFFLE)
+    return dict(compressor=compressor)
+
+
+def to_zarr(obj, path, profile=None, chunks=None, compute=True):
+    """
+    write `obj` to the Zarr store `path`, chunked and compressed like the `profile` encoding (see `tmip.encoding`)
+
+    Dask chunks are aligned to the store chunks, so that every chunk is written
+    by a single worker, in parallel and without locks.
+    """
+    # (encodings of the opened source files, e.g. NetCDF chunks, do not apply to the store)
+    ds = _as_dataset(obj).drop_encoding()
+    encoding = {}
+    if profile is not None:
+        from tmip.encoding import variable_encoding
+        for name, da in ds.data_vars.items():
+            settings = variable_encoding(da, profile, chunks, name)
+            if "chunksizes" in settings:
+                ds[name] = da.chunk(dict(zip(da.dims, settings["chunksizes"])))
+            encoding[name] = _zarr_compression(settings)
+            if "dtype" in settings:
+                encoding[name]["dtype"] = settings["dtype"]
+    return ds.to_zarr(path, mode="w", encoding=encoding, compute=compute)
+
+
+def consolidate(path, profile=None, chunks=None):
+    """
+    export the Zarr store of NetCDF file `path` to `path` (with the encoding of `profile`)
+
+    Like `save_output`, the file is written to `partial_path(path)` and renamed when complete.
+    """
+    import xarray as xr
+    from tmip.encoding import save_netcdf
+    print("Consolidating to: ", path)
+    ds = xr.open_zarr(zarr_path(path))
+    if profile is None:
+        ds.to_netcdf(partial_path(path), compute=True)
+    else:
+        save_netcdf(ds, partial_path(path), profile, chunks, compute=True)
+    return finalize_output(path, backend="netcdf")
+
+
+def save_output(obj, path, profile=None, chunks=None, backend=None, consolidate_to_netcdf=None, compute=True):
+    """
+    save `obj` as NetCDF file `path`, or as its Zarr store (see `zarr_path`) with the "zarr" backend
+
+    `chunks` overrides the chunk sizes of `profile` (see `tmip.encoding.variable_encoding`).
+    The output is first written to `partial_path(path)` and renamed when
+    complete, so that a killed job never leaves a partial file at `path`.
+    With `compute=False`, returns the delayed write to `partial_path(path)`
+    (`finalize_output` and `consolidate`, if any, are then left to the caller).
+    """
+    backend = output_backend(backend)
+    if backend == "netcdf":
+        if profile is None:
+            write = obj.to_netcdf(partial_path(path), compute=compute)
+        else:
+            from tmip.encoding import save_netcdf
+            write = save_netcdf(obj, partial_path(path), profile, chunks, compute=compute)
+    else:
+        print("Writing Zarr store: ", zarr_path(path))
+        write = to_zarr(obj, zarr_path(partial_path(path)), profile, chunks, compute=compute)
+    if compute:
+        finalize_output(path, backend)
+        if backend == "zarr" and consolidate_netcdf(consolidate_to_netcdf):
+            consolidate(path, profile, chunks)
+    return write
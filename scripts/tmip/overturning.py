@@ -0,0 +1,113 @@
+"""
+Overturning streamfunctions from transports in density space (e.g., `ty_trans_rho`).
+
+The streamfunction is the longitudinal sum of the meridional transport,
+cumulatively summed along density and referenced to zero at the densest
+layer, i.e., `psi = lonsum.cumulative('potrho').sum() - lonsum.sum('potrho')`.
+
+`overturning_streamfunction` builds it in a single lazy pass: each block of
+the transport (one month x one density slab x one latitude band) is summed
+over longitude as soon as it is read, and the (small) longitudinal sums are
+then cumulatively summed along density for each month. Memory is thus bounded
+by one input block plus one latitude x density plane per month, and no
+intermediate `y_trans_rho_lonsum.nc` file is needed.
+
+Basin streamfunctions (e.g., Atlantic, Indo-Pacific, Southern) are obtained
+from the same single read by replacing the longitudinal sum with a masked
+matrix-multiply over longitude against all basin masks at once (`basin_masks`).
+"""
+
+# Import numpy
+import numpy as np
+
+
+def _reverse_cumsum_kernel(x):
+    """
+    minus the sum over denser layers (last axis is density), i.e. the reverse cumulative sum
+
+    Same as `cumsum - sum` but summed from the densest layer, so that the
+    streamfunction is exactly zero there.
+    """
+    out = np.zeros_like(x)
+    out[..., :-1] = -np.flip(np.nancumsum(np.flip(x[..., 1:], axis=-1), axis=-1), axis=-1)
+    return out
+
+
+# Default basins (variable names in the basin masks file)
+BASINS = ("atlantic", "indopacific", "southern")
+
+
+def basin_masks(path, trans, basins=BASINS, include_global=True, xdim="grid_xt_ocean", ydim="grid_yu_ocean"):
+    """
+    load basin masks from `path` on the (`ydim`, `xdim`) grid of `trans`, stacked along dimension `basin`
+
+    `path` is a NetCDF file with one 2D (lat, lon) 0/1 variable per basin.
+    Masks are matched to the grid of `trans` by position, so masks on the tracer
+    grid (`yt_ocean`, `xt_ocean`) can be used for `ty_trans_rho` (whose cells are
+    the northern faces of the tracer cells). With `include_global=True`, a
+    "global" mask of ones is added first, so that the global streamfunction
+    comes out of the same reduction.
+    """
+    import xarray as xr
+    # (the masks are small, so they are loaded and the file is closed right away)
+    with xr.open_dataset(path) as ds:
+        ds = ds[list(basins)].load()
+    masks = []
+    for basin in basins:
+        mask = ds[basin]
+        if mask.ndim != 2:
+            raise ValueError(f"basin mask {basin} has to be 2D (lat, lon), got dims {mask.dims}")
+        mask = xr.DataArray(mask.values, dims=(ydim, xdim))
+        if mask.shape != (trans.sizes[ydim], trans.sizes[xdim]):
+            raise ValueError(f"basin mask {basin} has shape {mask.shape}, expected {(trans.sizes[ydim], trans.sizes[xdim])}")
+        masks.append(mask.fillna(0).astype(trans.dtype))
+    if include_global:
+        basins = ("global",) + tuple(basins)
+        masks.insert(0, xr.DataArray(np.ones((trans.sizes[ydim], trans.sizes[xdim]), dtype=trans.dtype), dims=(ydim, xdim)))
+    masks = xr.concat(masks, dim="basin").assign_coords(basin=list(basins))
+    return masks.assign_coords({xdim: trans[xdim], ydim: trans[ydim]})
+
+
+def masked_lonsum(trans, masks=None, xdim="grid_xt_ocean"):
+    """
+    sum `trans` over longitude, within each basin of `masks` if given (lazy)
+
+    With `masks`, all basins are reduced in a single matrix-multiply over
+    longitude (one task per input block) and the output has a trailing `basin`
+    dimension. Missing values count as zero, like xarray's `sum`.
+    """
+    import xarray as xr
+    if masks is None:
+        return trans.sum(xdim)
+    return xr.dot(trans.fillna(0), masks, dim=xdim).transpose(..., "basin")
+
+
+def reverse_cumsum(lonsum, zdim="potrho"):
+    """
+    reverse cumulative sum of `lonsum` along density `zdim` (lazy, one latitude x density plane per month)
+    """
+    import xarray as xr
+    psi = xr.apply_ufunc(
+        _reverse_cumsum_kernel,
+        lonsum,
+        input_core_dims=[[zdim]],
+        output_core_dims=[[zdim]],
+        dask="parallelized",
+        output_dtypes=[lonsum.dtype],
+        dask_gufunc_kwargs=dict(allow_rechunk=True),
+        keep_attrs=True,
+    )
+    return psi.transpose(*lonsum.dims)
+
+
+def overturning_streamfunction(trans, masks=None, xdim="grid_xt_ocean", zdim="potrho"):
+    """
+    return the overturning streamfunction of the meridional transport `trans` (lazy)
+
+    `trans` should be chunked with one time per chunk and ideally full
+    longitudes (`xdim: -1`), e.g., `{'time': 1, 'potrho': 40, 'grid_yu_ocean': 135, 'grid_xt_ocean': -1}`
+    for the 0.1° grid (`_ChunkSizes = 1, 40, 135, 180`), so that each block is
+    reduced over longitude in a single task. With basin `masks` (see
+    `basin_masks`), every basin streamfunction is computed from the same read.
+    """
+    return reverse_cumsum(masked_lonsum(trans, masks, xdim=xdim), zdim=zdim)
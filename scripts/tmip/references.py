@@ -0,0 +1,151 @@
+"""
+Cached kerchunk reference indexes over raw model history files.
+
+Opening e.g. `/scratch/p66/.../history/ocn/ocean_month.nc-{year}1231` for every
+member x decade pays the HDF5 metadata cost on every open. `history_references`
+scans each file once with kerchunk (per-file references are cached, keyed by
+path, size and modification time), combines them along time into a single
+reference index per history directory (also cached), and `open_history` opens
+that index as a virtual Zarr store: chunks are read straight from the original
+files, without going through HDF5 again.
+
+References are cached in `$TMIP_CACHE_DIR/references` (default `~/.cache/tmip/references`).
+"""
+
+# Import os for makedirs/path/stat
+import os
+
+# Load json/hashlib to store references and build the cache keys
+import json
+import hashlib
+
+# import glob for searching directories
+from glob import glob
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalogcache import cache_root
+
+
+def references_dir():
+    """
+    return the directory where reference indexes are cached
+    """
+    return os.path.join(cache_root(), "references")
+
+
+def _file_key(path):
+    """
+    return a key for the current version (size and modification time) of file `path`
+    """
+    stat = os.stat(path)
+    payload = json.dumps(dict(path=os.path.abspath(path), size=stat.st_size, mtime=stat.st_mtime))
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def _write_json(obj, path):
+    """
+    write `obj` to `path` atomically (concurrent jobs may write the same entry)
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def _load_or_build(path, build):
+    """
+    load the references cached in `path`, or `build()` them and try to cache them
+    """
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    refs = build()
+    try:
+        _write_json(refs, path)
+    except OSError as e:
+        # e.g., read-only home: still return the references
+        print(f"Could not cache references to {path}: {e}")
+    return refs
+
+
+def file_references(path):
+    """
+    return the kerchunk references of a single NetCDF4/HDF5 file (scanned only once)
+    """
+    def build():
+        from kerchunk.hdf import SingleHdf5ToZarr
+        with open(path, "rb") as f:
+            return SingleHdf5ToZarr(f, path).translate()
+    cached = os.path.join(references_dir(), f'{os.path.basename(path)}-{_file_key(path)}.json')
+    return _load_or_build(cached, build)
+
+
+def _variables_without(refs, dim):
+    """
+    return the variables of the references `refs` that do not have dimension `dim`
+    """
+    variables = []
+    for key, value in refs["refs"].items():
+        if key.endswith("/.zattrs"):
+            attrs = json.loads(value) if isinstance(value, str) else value
+            if dim not in attrs.get("_ARRAY_DIMENSIONS", [dim]):
+                variables.append(key[:-len("/.zattrs")])
+    return variables
+
+
+def history_references(inputdir, pattern="ocean_month.nc-*1231", concat_dim="time"):
+    """
+    return the references of all files matching `pattern` in `inputdir`, combined along `concat_dim`
+
+    The combined index is rebuilt only when files are added or modified, and
+    then only new/modified files are scanned.
+    """
+    paths = sorted(glob(os.path.join(inputdir, pattern)))
+    if not paths:
+        raise ValueError(f"No files matching {pattern} in {inputdir}")
+    key = hashlib.sha256(json.dumps([_file_key(p) for p in paths]).encode()).hexdigest()[:16]
+    cached = os.path.join(references_dir(), f'combined-{key}.json')
+
+    def build():
+        from kerchunk.combine import MultiZarrToZarr
+        print(f"Building reference index of {len(paths)} files in: ", inputdir)
+        singles = [file_references(p) for p in paths]
+        return MultiZarrToZarr(
+            singles,
+            remote_protocol="file",
+            concat_dims=[concat_dim],
+            # decode times of each file (their units may differ)
+            coo_map={concat_dim: f'cf:{concat_dim}'},
+            identical_dims=_variables_without(singles[0], concat_dim),
+        ).translate()
+    return _load_or_build(cached, build)
+
+
+def open_references(refs, keep_variables=None, chunks=None):
+    """
+    open the references `refs` as a lazy dataset (virtual Zarr store)
+
+    Default `chunks={}` uses the chunks of the original files.
+    With `keep_variables`, only these variables (and their coordinates) are kept.
+    """
+    import xarray as xr
+    ds = xr.open_dataset(
+        "reference://",
+        engine="zarr",
+        chunks={} if chunks is None else chunks,
+        backend_kwargs=dict(
+            consolidated=False,
+            storage_options=dict(fo=refs, remote_protocol="file"),
+        ),
+    )
+    if keep_variables is not None:
+        ds = ds[list(keep_variables)]
+    return ds
+
+
+def open_history(inputdir, keep_variables=None, chunks=None, pattern="ocean_month.nc-*1231"):
+    """
+    open all the history files matching `pattern` in `inputdir` through their (cached) reference index
+    """
+    return open_references(history_references(inputdir, pattern), keep_variables=keep_variables, chunks=chunks)
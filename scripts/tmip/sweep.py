@@ -0,0 +1,291 @@
+"""
+Declarative sweeps of script runs, packed into right-sized jobs.
+
+A sweep file (TOML, or YAML if PyYAML is installed) lists the runs to do as
+the product of a `matrix` of parameters (e.g., subcatalog x window x variable
+set) for each script, instead of `sed`-ing placeholders into a `.sh` template
+and calling `qsub` in a loop (see `sweeps/` and `sweep.py`):
+
+    [job]
+    project = "y99"
+    walltime = "01:00:00"
+
+    [[sweep]]
+    name = "MOC_ACCESS-OM2-1"
+    script = "scripts/MOC_ACCESS-OM2-1.py"
+    args = ["{subcatalog}"]
+    inputs = "/g/data/ik11/outputs/access-om2/{subcatalog}/output*/ocean/*ty_trans_rho*.nc"
+    [sweep.matrix]
+    subcatalog = ["1deg_jra55_iaf_omip2_cycle1", "1deg_jra55_iaf_omip2_cycle2"]
+
+The input bytes of every run are estimated from its `inputs` glob, small runs
+are packed together into shared jobs (run one after the other, up to
+`max_job_bytes` of inputs per job), and the memory/CPUs of each job are sized
+from its largest run (`mem_per_input_byte`), on the smallest queue that fits,
+with `walltime` per run (at most `max_walltime` per job). Each [[sweep]] can
+override these settings (e.g., a longer `walltime` for the 0.1° runs).
+Jobs are then submitted through a backend: "pbs" (`qsub`) or "local"
+(subprocesses, to test sweeps off-cluster).
+"""
+
+# Import os for paths/environment
+import os
+
+# Load itertools for the product of the matrix
+import itertools
+
+# Load math for rounding resources
+import math
+
+# import glob for searching directories
+from glob import glob
+
+# Load subprocess to submit/run jobs
+import subprocess
+
+# Default job settings (overridden by the [job] table of the sweep file)
+JOB_DEFAULTS = dict(
+    project="y99",
+    storage="gdata/xv83+gdata/oi10+gdata/dk92+gdata/hh5+gdata/rr3+gdata/al33+gdata/fs38+gdata/xp65+gdata/p73+gdata/cj50+gdata/ik11",
+    walltime="01:00:00",
+    max_walltime="48:00:00",
+    jobfs="4GB",
+    workdir="~/Projects/TMIP/notebooks",
+    setup=[
+        "module purge",
+        "module use /g/data/xp65/public/modules",
+        "module load conda/analysis3",
+    ],
+    # packing/sizing
+    max_job_bytes=200e9,
+    mem_per_input_byte=0.5,
+    default_input_bytes=10e9,
+    min_mem_gb=16,
+)
+
+# Job settings that can be overridden for each [[sweep]]
+SWEEP_SETTINGS = ("walltime", "max_walltime", "jobfs", "max_job_bytes", "mem_per_input_byte", "default_input_bytes", "min_mem_gb")
+
+# Gadi queues, from smallest to largest (memory per CPU and maximum per job on one node)
+QUEUES = (
+    dict(name="normal", gb_per_cpu=4, max_cpus=48, max_mem_gb=190),
+    dict(name="hugemem", gb_per_cpu=30.625, max_cpus=48, max_mem_gb=1470),
+)
+
+
+def load_sweep(path):
+    """
+    load a sweep file (`.toml`, or `.yaml`/`.yml`)
+    """
+    if path.endswith((".yaml", ".yml")):
+        import yaml
+        with open(path) as f:
+            config = yaml.safe_load(f)
+    else:
+        import tomllib
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    job = dict(JOB_DEFAULTS, **config.get("job", {}))
+    sweeps = config.get("sweep", [])
+    if not sweeps:
+        raise ValueError(f"No [[sweep]] in {path}")
+    return job, sweeps
+
+
+def expand_runs(sweep):
+    """
+    return the list of runs of `sweep` (one dict per combination of its matrix)
+    """
+    runs = []
+    matrix = sweep.get("matrix", {})
+    keys = list(matrix)
+    for values in itertools.product(*(matrix[k] for k in keys)):
+        params = dict(zip(keys, values))
+        args = [str(arg).format(**params) for arg in sweep.get("args", [])]
+        runs.append(dict(
+            name=sweep["name"],
+            script=sweep["script"],
+            args=args,
+            label=".".join([sweep["name"]] + [a for a in args if a]),
+            inputs=sweep["inputs"].format(**params) if "inputs" in sweep else None,
+        ))
+    return runs
+
+
+def _seconds(walltime):
+    """
+    return the number of seconds of `walltime` ("HH:MM:SS")
+    """
+    h, m, s = map(int, walltime.split(":"))
+    return 3600 * h + 60 * m + s
+
+
+def _walltime(seconds):
+    """
+    return `seconds` as a walltime ("HH:MM:SS")
+    """
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def input_bytes(run, default):
+    """
+    return the total size of the input files of `run` (`default` if unknown)
+    """
+    if run["inputs"] is None:
+        return default
+    paths = glob(os.path.expanduser(run["inputs"]))
+    if not paths:
+        print(f"No inputs matching {run['inputs']}, assuming {default / 1e9:.0f}GB")
+        return default
+    return sum(os.path.getsize(p) for p in paths)
+
+
+def pack_jobs(runs, max_job_bytes, max_runs=None):
+    """
+    pack runs (with their `bytes`) into jobs of at most `max_job_bytes` inputs and `max_runs` runs (first-fit decreasing)
+
+    Runs larger than `max_job_bytes` get a job of their own.
+    """
+    jobs = []
+    for run in sorted(runs, key=lambda r: r["bytes"], reverse=True):
+        for job in jobs:
+            if job["bytes"] + run["bytes"] <= max_job_bytes and (max_runs is None or len(job["runs"]) < max_runs):
+                job["runs"].append(run)
+                job["bytes"] += run["bytes"]
+                break
+        else:
+            jobs.append(dict(runs=[run], bytes=run["bytes"]))
+    return jobs
+
+
+def size_job(job, settings):
+    """
+    set the queue, CPUs, memory, and walltime of `job` from the inputs of its largest run
+
+    Runs of a job are sequential, so the walltime is `walltime` per run.
+    """
+    largest = max(run["bytes"] for run in job["runs"])
+    mem_gb = max(settings["min_mem_gb"], largest * settings["mem_per_input_byte"] / 1e9)
+    for queue in QUEUES:
+        if mem_gb <= queue["max_mem_gb"]:
+            break
+    ncpus = min(queue["max_cpus"], max(1, math.ceil(mem_gb / queue["gb_per_cpu"])))
+    job.update(
+        queue=queue["name"],
+        ncpus=ncpus,
+        mem=f'{min(queue["max_mem_gb"], math.floor(ncpus * queue["gb_per_cpu"]))}GB',
+        walltime=_walltime(len(job["runs"]) * _seconds(settings["walltime"])),
+    )
+    return job
+
+
+def plan_jobs(job_settings, sweeps):
+    """
+    return the sized jobs of a sweep file (see `load_sweep`)
+
+    Runs are only packed with runs of the same [[sweep]] (similar sizes), and
+    each [[sweep]] can override the `SWEEP_SETTINGS` of the [job] table.
+    """
+    jobs = []
+    for sweep in sweeps:
+        settings = dict(job_settings, **{k: sweep[k] for k in SWEEP_SETTINGS if k in sweep})
+        runs = expand_runs(sweep)
+        for run in runs:
+            run["bytes"] = input_bytes(run, settings["default_input_bytes"])
+        max_runs = max(1, _seconds(settings["max_walltime"]) // _seconds(settings["walltime"]))
+        for i, job in enumerate(pack_jobs(runs, settings["max_job_bytes"], max_runs)):
+            job["name"] = f'{sweep["name"]}_{i}'
+            job["jobfs"] = settings["jobfs"]
+            jobs.append(size_job(job, settings))
+    return jobs
+
+
+def run_command(run):
+    """
+    return the shell command of `run` (output to `output/{label}.$PBS_JOBID.out` like the `.sh` scripts)
+    """
+    args = " ".join(a for a in run["args"] if a)
+    return f'python3 {run["script"]} {args} &> output/{run["label"]}.$PBS_JOBID.out'
+
+
+def job_script(job, settings):
+    """
+    return the PBS job script of `job`
+    """
+    lines = [
+        "#!/bin/bash",
+        "",
+        f'#PBS -P {settings["project"]}',
+        f'#PBS -N {job["name"]}',
+        f'#PBS -q {job["queue"]}',
+        f'#PBS -l ncpus={job["ncpus"]}',
+        f'#PBS -l mem={job["mem"]}',
+        f'#PBS -l jobfs={job["jobfs"]}',
+        f'#PBS -l walltime={job["walltime"]}',
+        f'#PBS -l storage={settings["storage"]}',
+        "#PBS -l wd",
+        "#PBS -o output/PBS/",
+        "#PBS -j oe",
+        "",
+        'echo "Going into TMIP notebooks directory"',
+        f'cd {settings["workdir"]}',
+        "",
+        *settings["setup"],
+        "",
+    ]
+    for run in job["runs"]:
+        lines += [f'echo "Running {run["label"]}"', run_command(run), ""]
+    return "\n".join(lines)
+
+
+def submit_pbs(job, settings):
+    """
+    submit `job` with `qsub` (job script read from stdin)
+    """
+    result = subprocess.run(["qsub"], input=job_script(job, settings), text=True, capture_output=True, check=True)
+    return result.stdout.strip()
+
+
+def submit_local(job, settings):
+    """
+    run the runs of `job` one after the other as local subprocesses (for testing off-cluster)
+
+    `PBS_NCPUS`/`PBS_VMEM` are set to the resources of the job and `PBS_JOBID` to "local".
+    """
+    env = dict(
+        os.environ,
+        PBS_JOBID="local",
+        PBS_NCPUS=str(job["ncpus"]),
+        PBS_VMEM=str(int(job["mem"][:-2]) * 2**30),
+    )
+    workdir = os.path.expanduser(settings["workdir"])
+    os.makedirs(os.path.join(workdir, "output"), exist_ok=True)
+    for run in job["runs"]:
+        print(f'Running {run["label"]}')
+        result = subprocess.run(run_command(run), shell=True, cwd=workdir, env=env, executable="/bin/bash")
+        if result.returncode != 0:
+            print(f'{run["label"]} failed with exit code {result.returncode}')
+    return "local"
+
+
+# Job submission backends (name -> function(job, settings) returning a job ID)
+BACKENDS = dict(pbs=submit_pbs, local=submit_local)
+
+
+def submit_jobs(jobs, settings, backend="pbs", dry_run=False):
+    """
+    submit every job through `backend` (or only print their scripts with `dry_run`)
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"backend has to be one of {list(BACKENDS)}, got {backend}")
+    jobids = []
+    for job in jobs:
+        print(f'\n{job["name"]}: {len(job["runs"])} run(s), {job["bytes"] / 1e9:.1f}GB of inputs, '
+              f'{job["queue"]} queue, {job["ncpus"]} CPUs, {job["mem"]}, {job["walltime"]}')
+        if dry_run:
+            print(job_script(job, settings))
+            continue
+        jobid = BACKENDS[backend](job, settings)
+        print("Submitted: ", jobid)
+        jobids.append(jobid)
+    return jobids
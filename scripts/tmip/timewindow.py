@@ -0,0 +1,17 @@
+"""
+Time-window helpers.
+"""
+
+
+def time_window_strings(year_start, num_years):
+    """
+    return strings for start_time and end_time
+
+    Years are zero-padded to 4 digits so that slicing cftime axes
+    (e.g., piControl years like 200) works and directory names are consistent.
+    """
+    # start_time is first second of year_start
+    start_time = f'{year_start:04d}'
+    # end_time is last second of last_year
+    end_time = f'{year_start + num_years - 1:04d}'
+    return start_time, end_time
@@ -0,0 +1,67 @@
+"""
+Shared fixtures of the tests of the shared TMIP helpers (scripts/tmip).
+
+Run with `python -m pytest -q` from the repository root.
+"""
+
+# Import os/sys to make `tmip` importable like from the scripts
+import os
+import sys
+
+# Import numpy/pandas/xarray
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Load pytest
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "scripts"))
+
+
+class FakeCatalog:
+    """
+    minimal stand-in for an intake-esm datastore (`df`, `search`, `to_dask`)
+    """
+    def __init__(self, df):
+        self.df = df.reset_index(drop=True)
+
+    def search(self, **kwargs):
+        mask = pd.Series(True, index=self.df.index)
+        for column, value in kwargs.items():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            mask &= self.df[column].map(
+                lambda v: any(x in v for x in values) if isinstance(v, (list, tuple)) else v in values
+            )
+        return FakeCatalog(self.df[mask])
+
+    def to_dask(self, xarray_open_kwargs, xarray_combine_by_coords_kwargs, parallel=True, preprocess=None):
+        return xr.open_mfdataset(sorted(self.df.path.unique()), combine="by_coords",
+                                 **xarray_combine_by_coords_kwargs, **xarray_open_kwargs)
+
+
+def monthly_field(years=3, start="2000-01-01", seed=0, nan=True):
+    """
+    return a random monthly (time, y, x) DataArray on a noleap calendar
+    """
+    rng = np.random.default_rng(seed)
+    time = xr.date_range(start, periods=12 * years, freq="MS", calendar="noleap", use_cftime=True)
+    data = rng.normal(size=(time.size, 3, 4))
+    if nan:
+        data[:, 0, 0] = np.nan
+    return xr.DataArray(data, dims=("time", "y", "x"), coords=dict(time=time), name="thetao")
+
+
+@pytest.fixture
+def availability_df():
+    rows = []
+    full = ['umo', 'vmo', 'uo', 'vo', 'mlotst', 'volcello', 'areacello', 'thetao', 'so']
+    for member in ["r1i1p1f1", "r2i1p1f1", "r10i1p1f1"]:
+        rows += [("historical", "ACCESS-ESM1-5", member, v) for v in full]
+    # r3 has no umo (only uo+vo), r4 has no thetao (neither)
+    rows += [("historical", "ACCESS-ESM1-5", "r3i1p1f1", v) for v in full if v != "umo"]
+    rows += [("historical", "ACCESS-ESM1-5", "r4i1p1f1", v) for v in full if v != "thetao"]
+    rows += [("ssp370", "ACCESS-ESM1-5", "r1i1p1f1", v) for v in full]
+    # duplicated rows (e.g., several files/versions)
+    rows += rows[:5]
+    return pd.DataFrame(rows, columns=["experiment_id", "source_id", "member_id", "variable_id"])
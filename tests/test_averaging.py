@@ -0,0 +1,68 @@
+"""
+Tests of `tmip.averaging`.
+"""
+
+# Import numpy/xarray
+import numpy as np
+import xarray as xr
+
+# Load pytest
+import pytest
+
+# Load the shared test fixtures (see conftest.py)
+from conftest import monthly_field
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.averaging import shared_days_in_month, yearlymax_reduction, build_averages
+
+
+def test_shared_days_in_month():
+    da = monthly_field()
+    cache = []
+    weights = shared_days_in_month(da.time, cache)
+    assert shared_days_in_month(da.copy().time, cache) is weights
+    assert len(cache) == 1
+    shared_days_in_month(da.time[:12], cache)
+    assert len(cache) == 2
+
+
+def test_build_averages():
+    da = monthly_field(years=4).chunk(time=7)
+    ds = da.to_dataset()
+    ds["mlotst"] = da
+    ds["volcello"] = xr.DataArray(np.ones((3, 4)), dims=("y", "x"))
+    outputs = build_averages(
+        lambda v: ds, ["thetao", "mlotst", "volcello", "missing"], "2001", "2002",
+        reducers=dict(mlotst="yearlymax", volcello="fixed"),
+    )
+    # unknown variables are reported and skipped
+    assert sorted(outputs) == ["mlotst", "mlotst_max", "thetao", "volcello"]
+    sliced = da.sel(time=slice("2001", "2002"))
+    expected = sliced.weighted(sliced.time.dt.days_in_month).mean(dim="time")
+    xr.testing.assert_allclose(outputs["thetao"]["thetao"].compute(), expected.compute())
+    yearlymax = sliced.groupby("time.year").max(dim="time")
+    xr.testing.assert_allclose(outputs["mlotst"]["mlotst"].compute(), yearlymax.mean(dim="year").compute())
+    xr.testing.assert_allclose(outputs["mlotst_max"]["mlotst"].compute(), sliced.max(dim="time").compute())
+
+
+@pytest.mark.parametrize("years_per_chunk", [1, 2])
+def test_yearlymax_reduction(years_per_chunk):
+    da = monthly_field(years=5)
+    # NaNs in some months of one cell (and in every month of another, see `monthly_field`)
+    da[3:20, 1, 1] = np.nan
+    da.attrs["units"] = "m"
+    # (a single time chunk)
+    da = da.chunk(time=-1)
+    yearlymax_mean, overall_max = yearlymax_reduction(da, years_per_chunk=years_per_chunk)
+    # time is reduced from year-aligned chunks, not from the whole series
+    rechunked = [key for name, layer in yearlymax_mean.data.dask.layers.items() if name.startswith("rechunk-merge")
+                 for key in layer]
+    assert max(key[-1] for key in rechunked) + 1 == -(-5 // years_per_chunk)
+    xr.testing.assert_allclose(yearlymax_mean.compute(), da.groupby("time.year").max(dim="time").mean(dim="year"))
+    xr.testing.assert_allclose(overall_max.compute(), da.max(dim="time"))
+    assert yearlymax_mean.attrs["units"] == "m" and overall_max.dtype == da.dtype
+
+
+def test_build_averages_unknown_reducer():
+    with pytest.raises(ValueError):
+        build_averages(lambda v: None, ["thetao"], "2000", "2000", reducers=dict(thetao="median"))
@@ -0,0 +1,107 @@
+"""
+Tests of `tmip.catalog` against the behaviour of the per-script copies it replaced.
+"""
+
+# Import numpy/pandas/xarray
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Load pytest
+import pytest
+
+# Load the shared test fixtures (see conftest.py)
+from conftest import FakeCatalog
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalog import (
+    find_latest_version, select_latest_cat, latest_version_manifest, select_manifest,
+    select_data, select_variables,
+    sort_members, summary_variable_availability,
+)
+
+
+# Baseline implementations (as they were copied in the scripts)
+
+def baseline_summary_variable_availability(df, cmip_version):
+    if cmip_version == "CMIP6":
+        variable_id = 'variable_id'
+        experiment_id = 'experiment_id'
+        source_id = 'source_id'
+        member_id = 'member_id'
+        list1 = ['umo', 'vmo', 'mlotst', 'volcello', 'areacello', 'thetao', 'so']
+        list2 = ['uo', 'vo', 'mlotst', 'volcello', 'areacello', 'thetao', 'so']
+    filtered_df_1 = df[df[variable_id].isin(list1)]
+    filtered_df_2 = df[df[variable_id].isin(list2)]
+    grouped_1 = filtered_df_1.groupby([experiment_id, source_id, member_id])
+    grouped_2 = filtered_df_2.groupby([experiment_id, source_id, member_id])
+    valid_groups_1 = grouped_1.filter(lambda x: set(list1).issubset(set(x[variable_id])))
+    valid_groups_2 = grouped_2.filter(lambda x: set(list2).issubset(set(x[variable_id])))
+    result_1 = valid_groups_1[[experiment_id, source_id, member_id]].drop_duplicates().reset_index(drop=True)
+    result_2 = valid_groups_2[[experiment_id, source_id, member_id]].drop_duplicates().reset_index(drop=True)
+    final_result_1 = result_1.groupby([experiment_id, source_id])[member_id].apply(list).reset_index()
+    final_result_2 = result_2.groupby([experiment_id, source_id])[member_id].apply(list).reset_index()
+    return pd.merge(final_result_1, final_result_2, on=[experiment_id, source_id], how='outer', suffixes=('_umo_vmo', '_uo_vo'))
+
+
+def test_sort_members():
+    members = ["r10i1p1f1", "r2i1p1f1", "r1i2p1f1", "r1i1p1f1"]
+    assert sort_members(members) == ["r1i1p1f1", "r1i2p1f1", "r2i1p1f1", "r10i1p1f1"]
+
+
+def test_latest_version(availability_df):
+    df = availability_df.drop_duplicates().assign(version="v20200101", path="")
+    df.loc[df.variable_id == "umo", "version"] = "v20210101"
+    cat = FakeCatalog(df)
+    assert find_latest_version(cat) == "v20210101"
+    assert (select_latest_cat(cat, variable_id="umo").df.version == "v20210101").all()
+    with pytest.raises(ValueError):
+        select_latest_cat(cat, variable_id="nope")
+
+
+def test_summary_variable_availability(availability_df):
+    expected = baseline_summary_variable_availability(availability_df, "CMIP6")
+    result = summary_variable_availability(availability_df, "CMIP6")
+    keys = ["experiment_id", "source_id"]
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    result = result.sort_values(keys).reset_index(drop=True)
+    assert list(result.columns) == list(expected.columns)
+    for column in ["member_id_umo_vmo", "member_id_uo_vo"]:
+        assert [sorted(m) for m in result[column]] == [sorted(m) for m in expected[column]]
+
+
+def test_latest_version_manifest(availability_df):
+    df = availability_df.drop_duplicates().assign(table_id="Omon", version="v20200101")
+    newer = df[df.variable_id == "so"].assign(version="v20210101")
+    manifest = latest_version_manifest(pd.concat([df, newer]), "CMIP6")
+    # one version per (source, experiment, member, variable, table), the latest
+    assert len(manifest) == len(df)
+    assert (select_manifest(manifest, variable_id="so").version == "v20210101").all()
+    assert (select_manifest(manifest, variable_id=["umo", "vmo"]).version == "v20200101").all()
+
+
+def test_select_variables(tmp_path):
+    # raw OM2-like files with several variables each
+    paths = []
+    for year in (2000, 2001):
+        time = xr.date_range(f"{year}-01-01", periods=12, freq="MS", calendar="noleap", use_cftime=True)
+        ds = xr.Dataset({
+            v: (("time", "y"), np.random.default_rng(year).normal(size=(12, 5)))
+            for v in ("tx_trans", "ty_trans", "mld", "temp")
+        }, coords=dict(time=time))
+        paths.append(str(tmp_path / f"ocean_month_{year}.nc"))
+        ds.to_netcdf(paths[-1])
+    df = pd.DataFrame([(p, ["tx_trans", "ty_trans", "mld", "temp"], "1mon") for p in paths],
+                      columns=["path", "variable", "frequency"])
+    cat = FakeCatalog(df)
+    ds = select_variables(cat, dict(chunks={}), ["tx_trans", "mld"], frequency="1mon")
+    assert sorted(ds.data_vars) == ["mld", "tx_trans"]
+    # same data as one open per variable
+    for v in ("tx_trans", "mld"):
+        expected = select_data(cat, dict(chunks={}), variable=v, frequency="1mon")[v]
+        xr.testing.assert_identical(ds[v].load(), expected.load())
+    with pytest.raises(ValueError):
+        select_variables(cat, dict(chunks={}), ["tx_trans", "nope"], frequency="1mon")
+    # with allow_missing, the variables found are still opened
+    ds = select_variables(cat, dict(chunks={}), ["tx_trans", "nope"], allow_missing=True, frequency="1mon")
+    assert list(ds.data_vars) == ["tx_trans"]
@@ -0,0 +1,62 @@
+"""
+Tests of `tmip.catalogcache` (without intake: only the cache keys and the catalog description).
+"""
+
+# Import os for utime
+import os
+
+# Import json to write the toy catalog
+import json
+
+# Load pandas for data manipulation
+import pandas as pd
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalogcache import cache_dir, read_esmcat, cache_key, _columns_with_iterables
+
+
+def toy_catalog(tmp_path):
+    """
+    write a toy intake-esm catalog (JSON + CSV) and return the path of its JSON
+    """
+    (tmp_path / "toy.csv").write_text("path,variable_id\n/a.nc,umo\n")
+    catalog_file = tmp_path / "toy.json"
+    catalog_file.write_text(json.dumps(dict(esmcat_version="0.1.0", catalog_file="toy.csv")))
+    return str(catalog_file)
+
+
+def test_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMIP_CACHE_DIR", str(tmp_path))
+    assert cache_dir() == os.path.join(str(tmp_path), "catalog")
+
+
+def test_read_esmcat(tmp_path):
+    esmcat, csv_file = read_esmcat(toy_catalog(tmp_path))
+    # the CSV is relative to the JSON
+    assert esmcat["esmcat_version"] == "0.1.0"
+    assert csv_file == str(tmp_path / "toy.csv")
+
+
+def test_cache_key_invalidation(tmp_path):
+    catalog_file = toy_catalog(tmp_path)
+    _, csv_file = read_esmcat(catalog_file)
+    query = dict(source_id="ACCESS-ESM1-5", variable_id=["umo", "vmo"])
+    key = cache_key("toy", catalog_file, csv_file, query)
+    # stable for the same search of the same catalog version
+    assert cache_key("toy", catalog_file, csv_file, dict(query)) == key
+    # a different query, catalog, or opening options is another entry
+    assert cache_key("toy", catalog_file, csv_file, dict(query, variable_id=["umo"])) != key
+    assert cache_key("other", catalog_file, csv_file, query) != key
+    assert cache_key("toy", catalog_file, csv_file, query, args=dict(obj=catalog_file)) != key
+    # and a new version of the catalog (JSON or CSV) invalidates it
+    for path in (csv_file, catalog_file):
+        mtime = os.path.getmtime(path)
+        os.utime(path, (mtime + 1, mtime + 1))
+        assert cache_key("toy", catalog_file, csv_file, query) != key
+        key = cache_key("toy", catalog_file, csv_file, query)
+
+
+def test_columns_with_iterables():
+    df = pd.DataFrame(dict(path=["/a.nc"], variable=[("umo", "vmo")], frequency=["mon"]))
+    assert _columns_with_iterables(df) == ["variable"]
+    assert _columns_with_iterables(df.iloc[:0]) == []
@@ -0,0 +1,28 @@
+"""
+Tests of `tmip.checksums`.
+"""
+
+# Import os for paths
+import os
+
+# Import xarray
+import xarray as xr
+
+# Load the shared test fixtures (see conftest.py)
+from conftest import monthly_field
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.output import partial_path
+from tmip.checksums import write_with_manifest, manifest_path, verify_archives
+
+
+def test_write_with_manifest(tmp_path):
+    da = monthly_field().chunk(time=12).rename("mld")
+    path = str(tmp_path / "month_mld_2000s.nc")
+    write_with_manifest(da, path, profile="archive")
+    # renamed once the manifest is written
+    assert os.path.isfile(path) and os.path.isfile(manifest_path(path))
+    assert not os.path.exists(partial_path(path))
+    xr.testing.assert_identical(xr.open_dataset(path)["mld"].load(), da.load())
+    report, = verify_archives([(da, path)])
+    assert report["status"] == "pass"
@@ -0,0 +1,15 @@
+"""
+Tests of `tmip.chunks`.
+"""
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.chunks import advise_chunks
+
+
+def test_advise_chunks_lonsum():
+    sizes = dict(time=120, st_ocean=50, yt_ocean=300, xt_ocean=360)
+    storage = dict(time=1, st_ocean=10, yt_ocean=150, xt_ocean=180)
+    # one time and full longitudes per chunk, even with room left to grow
+    chunks = advise_chunks(sizes, storage, 4, "lonsum")
+    assert chunks == dict(time=1, st_ocean=-1, yt_ocean=-1, xt_ocean=-1)
+    assert advise_chunks(sizes, storage, 4, "timemean")["time"] == -1
@@ -0,0 +1,80 @@
+"""
+Tests of `tmip.climatology` against the behaviour of the per-script copies it replaced.
+"""
+
+# Import numpy/xarray
+import numpy as np
+import xarray as xr
+
+# Load pytest
+import pytest
+
+# Load the shared test fixtures (see conftest.py)
+from conftest import monthly_field
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.climatology import month_climatology, season_climatology, climatology, yearlymeans
+
+
+# Baseline implementations (as they were copied in the scripts)
+
+def baseline_month_climatology(ds):
+    month_length = ds.time.dt.days_in_month
+    weights = month_length.groupby("time.month") / month_length.groupby("time.month").sum()
+    ds_out = (ds * weights).groupby("time.month").sum(dim="time")
+    mean_days_in_month = month_length.groupby("time.month").mean()
+    return ds_out.assign_coords(mean_days_in_month=('month', mean_days_in_month.data))
+
+
+def baseline_season_climatology(ds):
+    month_length = ds.time.dt.days_in_month
+    weights = month_length.groupby("time.season") / month_length.groupby("time.season").sum()
+    return (ds * weights).groupby("time.season").sum(dim="time")
+
+
+def test_yearlymeans():
+    da = monthly_field(nan=False)
+    weights = da.time.dt.days_in_month
+    expected = (da * weights).groupby("time.year").sum() / weights.groupby("time.year").sum()
+    xr.testing.assert_allclose(yearlymeans(da), expected)
+
+
+@pytest.mark.parametrize("chunks", [None, dict(time=5)])
+def test_month_climatology(chunks):
+    da = monthly_field()
+    if chunks is not None:
+        da = da.chunk(chunks)
+    result = month_climatology(da).compute()
+    expected = baseline_month_climatology(da).compute()
+    xr.testing.assert_allclose(result.transpose(*expected.dims), expected)
+    xr.testing.assert_equal(result.mean_days_in_month, expected.mean_days_in_month)
+    assert result.dims == ("month", "y", "x")
+
+
+def test_season_climatology():
+    da = monthly_field().chunk(time=6)
+    result = season_climatology(da).compute()
+    expected = baseline_season_climatology(da).compute()
+    xr.testing.assert_allclose(result.transpose(*expected.dims), expected.sel(season=result.season))
+    xr.testing.assert_allclose(climatology(da, "season").compute(), result)
+    with pytest.raises(ValueError):
+        climatology(da, "year")
+
+
+@pytest.mark.parametrize("lumpby", ["month", "season"])
+def test_climatology_dataset(lumpby):
+    da = monthly_field().chunk(time=5)
+    ds = xr.Dataset(dict(
+        thetao=da,
+        so=(da * 2).rename("so"),
+        areacello=xr.DataArray(np.arange(12.0).reshape(3, 4), dims=("y", "x")),
+    ))
+    result = climatology(ds, lumpby).compute()
+    baseline = baseline_month_climatology if lumpby == "month" else baseline_season_climatology
+    expected = baseline(ds).compute()
+    for v in ("thetao", "so"):
+        # same as the baseline groupby, and as the DataArray climatology
+        xr.testing.assert_allclose(result[v], expected[v].sel({lumpby: result[lumpby]}))
+        xr.testing.assert_allclose(result[v], climatology(ds[v], lumpby).compute())
+    # time-less variables are passed through
+    xr.testing.assert_identical(result.areacello, ds.areacello)
@@ -0,0 +1,59 @@
+"""
+Tests of `tmip.cluster`.
+"""
+
+# Import numpy/xarray
+import numpy as np
+import xarray as xr
+
+# Load pytest
+import pytest
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.cluster import RESERVED_FRACTION, pbs_allocation, chunk_plan, plan_cluster, make_client
+
+GiB = 2**30
+MiB = 2**20
+
+
+def test_pbs_allocation(monkeypatch):
+    monkeypatch.setenv("PBS_NCPUS", "48")
+    monkeypatch.setenv("PBS_VMEM", str(190 * GiB))
+    assert pbs_allocation() == (48, 190 * GiB)
+    # (the machine's outside of PBS jobs)
+    monkeypatch.delenv("PBS_NCPUS")
+    monkeypatch.delenv("PBS_VMEM")
+    ncpus, memory = pbs_allocation()
+    assert ncpus >= 1 and memory > 0
+
+
+def test_chunk_plan():
+    da = xr.DataArray(np.zeros((12, 10, 20)), dims=("time", "y", "x"), name="umo")
+    ds = xr.Dataset(dict(umo=da.chunk(time=1, y=5), vmo=da.chunk(time=4).astype("float32")))
+    # largest chunk: 4 x 10 x 20 float32, and unchunked data only count in the total
+    assert chunk_plan(ds, da) == (4 * 10 * 20 * 4, 12 * 10 * 20 * (8 + 4 + 8))
+
+
+@pytest.mark.parametrize("chunk_bytes, max_workers, n_workers", [
+    (0, None, 48),                # no chunks: one worker per CPU
+    (100 * MiB, None, 48),        # small chunks: one worker per CPU
+    (1 * GiB, None, 25),          # 4 chunks of 1GiB within 60% of each worker's memory
+    (100 * MiB, 12, 12),          # capped
+    (100 * GiB, None, 1),         # too large: a single worker (with a warning)
+])
+def test_plan_cluster(chunk_bytes, max_workers, n_workers):
+    kwargs = plan_cluster(48, 190 * GiB, chunk_bytes, max_workers=max_workers)
+    assert kwargs["n_workers"] == n_workers and kwargs["threads_per_worker"] == 1
+    assert kwargs["memory_limit"] == int(190 * GiB * (1 - RESERVED_FRACTION) // n_workers)
+    if chunk_bytes and n_workers > 1:
+        assert 4 * chunk_bytes <= 0.6 * kwargs["memory_limit"]
+
+
+def test_make_client(monkeypatch):
+    monkeypatch.setenv("PBS_NCPUS", "4")
+    monkeypatch.setenv("PBS_VMEM", str(2 * GiB))
+    # chunks of 128MiB: only 2 workers fit in 90% of 2GiB
+    with make_client(chunk_bytes=128 * MiB) as client:
+        workers = client.scheduler_info()["workers"].values()
+        assert len(workers) == 2
+        assert all(w["nthreads"] == 1 and w["memory_limit"] == int(2 * GiB * 0.9 // 2) for w in workers)
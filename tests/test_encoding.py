@@ -0,0 +1,30 @@
+"""
+Tests of `tmip.encoding`.
+"""
+
+# Import numpy/xarray
+import numpy as np
+import xarray as xr
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.encoding import PROFILES, encoding_for
+
+
+def test_matrix_build_keeps_float64():
+    ds = xr.Dataset(dict(
+        umo=(("time", "x"), np.ones((2, 3))),
+        volcello=(("x",), np.ones(3)),
+        thetao=(("time", "x"), np.ones((2, 3))),
+    ))
+    encoding = encoding_for(ds, "matrix-build")
+    # mass transports and grid metrics stay float64, listed tracers are float32
+    assert "dtype" not in encoding["umo"] and "dtype" not in encoding["volcello"]
+    assert encoding["thetao"]["dtype"] == "float32"
+    assert all("dtype" not in e for e in encoding_for(ds, "archive").values())
+
+
+def test_derived_is_archive():
+    ds = xr.Dataset(dict(psi=(("time", "x"), np.ones((2, 3)))))
+    # derived diagnostics are stored like the archives
+    assert PROFILES["derived"] is PROFILES["archive"]
+    assert encoding_for(ds, "derived") == encoding_for(ds, "archive")
@@ -0,0 +1,110 @@
+"""
+Tests of `tmip.ensemble`.
+"""
+
+# Load warnings to silence the all-NaN warnings of numpy
+import warnings
+
+# Import numpy/xarray
+import numpy as np
+import xarray as xr
+
+# Load pytest
+import pytest
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.catalog import sort_members
+from tmip.ensemble import (
+    STATS, NBINS, QUANTILES, index_ensemble_outputs, ensemble_members, open_ensemble, ensemble_stats,
+    ensemble_histogram, histogram_quantiles, ensemble_timemean_diagnostics,
+)
+
+
+def ensemble_field(nmembers=7, seed=0):
+    """
+    return a random (member, y, x) DataArray with NaNs in some members of some cells and in all members of one cell
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(size=(nmembers, 3, 4))
+    data[: nmembers // 2, 1, 1] = np.nan
+    data[:, 0, 0] = np.nan
+    members = [f'r{i + 1}i1p1f1' for i in range(nmembers)]
+    return xr.DataArray(data, dims=("member", "y", "x"), coords=dict(member=members), name="age")
+
+
+@pytest.mark.parametrize("ddof", [0, 1])
+def test_ensemble_stats(ddof):
+    da = ensemble_field()
+    stats = ensemble_stats(list(da.member.values), lambda m: da.sel(member=m, drop=True), "age", ddof=ddof)
+    assert list(stats.data_vars) == [f'age_{stat}' for stat in STATS]
+    # same as xarray's reductions over members (NaNs skipped)
+    xr.testing.assert_allclose(stats.age_ensemblemean, da.mean("member"))
+    xr.testing.assert_allclose(stats.age_ensemblestd, da.std("member", ddof=ddof))
+    xr.testing.assert_allclose(stats.age_ensemblemax, da.max("member"))
+    xr.testing.assert_allclose(stats.age_ensemblemin, da.min("member"))
+
+
+@pytest.mark.parametrize("nbins", [NBINS, 8])
+def test_histogram_quantiles(tmp_path, nbins):
+    da = ensemble_field(nmembers=40)
+    # a cell where all members are equal (lo == hi)
+    da[:, 2, 3] = 3.0
+    # lazily opened, like the time means of `ensemble_timemean_diagnostics`
+    da.to_dataset().to_netcdf(tmp_path / "age.nc")
+    da = xr.open_dataset(tmp_path / "age.nc", chunks={"member": 1}).age
+    lo, hi = da.min("member").compute(), da.max("member").compute()
+    counts = ensemble_histogram(da, lo, hi, nbins=nbins)
+    assert counts.dtype == np.uint8 and counts.sizes["bin"] == nbins
+    # every (non-NaN) member is counted once
+    xr.testing.assert_equal(counts.sum("bin").astype(int), da.count("member"))
+    quantiles = histogram_quantiles(counts.chunk({"bin": -1}), lo, hi).compute()
+    with warnings.catch_warnings():
+        # (all-NaN cells)
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected = np.nanquantile(da.values, QUANTILES, axis=0)
+    width = ((hi - lo) / nbins).values
+    # within one bin width of the exact quantiles, NaN where all members are NaN
+    assert np.array_equal(np.isnan(quantiles.values), np.isnan(expected))
+    valid = ~np.isnan(expected)
+    assert np.all(np.abs(quantiles.values - expected)[valid] <= np.broadcast_to(width, expected.shape)[valid] + 1e-12)
+    assert (quantiles[:, 2, 3] == 3.0).all()
+
+
+def test_ensemble_timemean_diagnostics(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMIP_CACHE_DIR", str(tmp_path / "cache"))
+    root = tmp_path / "data"
+    rng = np.random.default_rng(0)
+    ages = ensemble_field().expand_dims(Ti=12, axis=1).copy(data=rng.normal(size=(7, 12, 3, 4)))
+    for member in ages.member.values:
+        cyclodir = root / "ACCESS-ESM1-5" / "historical" / member / "Jan1990-Dec1999" / "cyclomonth"
+        cyclodir.mkdir(parents=True)
+        ages.sel(member=member, drop=True).to_dataset().to_netcdf(cyclodir / "ideal_mean_age.nc")
+    index = index_ensemble_outputs("ACCESS-ESM1-5", "historical", str(root))
+    outputdir = tmp_path / "all_members"
+    outputdir.mkdir()
+    stats = ensemble_timemean_diagnostics(index, "ideal_mean_age", "age", "Jan1990-Dec1999", "month", str(outputdir))
+    # time means of all members are written (one member per chunk), and the statistics are theirs
+    timemean = ages.mean("Ti")
+    with xr.open_dataset(outputdir / "age_timemean.nc") as ds:
+        xr.testing.assert_allclose(ds.age_timemean.load(), timemean)
+        assert ds.age_timemean.encoding["chunksizes"][0] == 1
+    xr.testing.assert_allclose(stats.age_ensemblemean, timemean.mean("member"))
+    xr.testing.assert_allclose(stats.age_ensemblestd, timemean.std("member"))
+    for name in ["age_ensemblemean", "age_ensemblehistogram", "age_ensemblequantiles"]:
+        assert (outputdir / f'{name}.nc').is_file()
+
+
+def test_ensemble_members_keyed_by_label(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMIP_CACHE_DIR", str(tmp_path / "cache"))
+    root = tmp_path / "data"
+    members = ["r10i1p1f1", "r1i2p1f1", "r2i1p1f1", "r1i1p1f1"]
+    for i, member in enumerate(members):
+        cyclodir = root / "ACCESS-ESM1-5" / "historical" / member / "Jan1990-Dec1999" / "cyclomonth"
+        cyclodir.mkdir(parents=True)
+        xr.Dataset(dict(age=("x", np.full(3, float(i))))).to_netcdf(cyclodir / "ideal_mean_age.nc")
+    index = index_ensemble_outputs("ACCESS-ESM1-5", "historical", str(root))
+    # members that only differ in i/p/f are kept apart
+    assert ensemble_members(index, "ideal_mean_age", "Jan1990-Dec1999", "month") == sort_members(members)
+    ds = open_ensemble(index, "ideal_mean_age", "Jan1990-Dec1999", "month")
+    assert list(ds.member.values) == sort_members(members)
+    assert ds.age.sel(member="r1i2p1f1").values.tolist() == [1.0] * 3
@@ -0,0 +1,35 @@
+"""
+Tests of `tmip.forcing`.
+"""
+
+# Import numpy/pandas/xarray
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.forcing import YEAR_CHUNKS, monthly_speed_squared
+
+
+def winds(year=1990, seed=0):
+    """
+    return random 3-hourly (time, lat, lon) `uas` and `vas` over `year`, with NaNs, chunked like the scripts
+    """
+    rng = np.random.default_rng(seed)
+    time = pd.date_range(f'{year}-01-01', f'{year}-12-31T21:00', freq="3h")
+    coords = dict(time=time, lat=np.linspace(-60, 60, 20), lon=np.arange(5.0))
+    dims = ("time", "lat", "lon")
+    uas = xr.DataArray(rng.normal(size=(time.size, 20, 5)), dims=dims, coords=coords, name="uas")
+    vas = xr.DataArray(rng.normal(size=(time.size, 20, 5)), dims=dims, coords=coords, name="vas")
+    uas[:100, 0, 0] = np.nan
+    return uas.chunk(YEAR_CHUNKS), vas.chunk(YEAR_CHUNKS)
+
+
+def test_monthly_speed_squared():
+    uas, vas = winds()
+    u2 = monthly_speed_squared(uas, vas)
+    assert u2.name == "u2" and u2.attrs["units"] == "m2 s-2"
+    assert u2.dims == ("time", "lat", "lon") and u2.chunks[1] == uas.chunks[1]
+    # same as the baseline (squared sum, then monthly means), month-end labels
+    expected = (uas**2 + vas**2).resample(time="1ME").mean()
+    xr.testing.assert_allclose(u2.compute(), expected.compute())
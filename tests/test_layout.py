@@ -0,0 +1,84 @@
+"""
+Tests of `tmip.layout`.
+"""
+
+# Import os for utime
+import os
+
+# Import numpy/xarray
+import numpy as np
+import xarray as xr
+
+# Load pytest
+import pytest
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.layout import (
+    OutputKey, CMIP6_member, CSIRO_member, parse_CSIRO_member, decade_years, window_string, parse_window,
+    output_path, output_dir, parse_output_path, index_outputs,
+)
+from tmip.output import save_output
+
+
+def test_index_zarr_outputs(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMIP_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("TMIP_OUTPUT_BACKEND", "zarr")
+    root = str(tmp_path / "data")
+    key = OutputKey("cyclo", "ACCESS-ESM1-5", "historical", "r1i1p1f1", "Jan1990-Dec1999", "month", "umo")
+    path = output_path(key, root)
+    save_output(xr.Dataset(dict(umo=("x", np.ones(3)))), path)
+    # Zarr stores are indexed by the NetCDF path they stand for
+    assert index_outputs(root, use_cache=False) == {key: path}
+
+
+@pytest.mark.parametrize("key", [
+    OutputKey("average", "ACCESS-ESM1-5", "historical", "r1i1p1f1", "Jan1990-Dec1999", variable="umo"),
+    OutputKey("cyclo", "ACCESS-ESM1-5", "ssp370", "r3i1p1f1", "Jan2090-Dec2099", "season", "ideal_mean_age"),
+    OutputKey("ensemble", "ACCESS-ESM1-5", "historical", window="Jan1990-Dec1999", lumpby="month", variable="age_ensemblemean"),
+    OutputKey("archive", "ACCESS-ESM1-5", "historical", CSIRO_member("historical", 1), variable="ty_trans_gm", decade=2010),
+    OutputKey("archive", "ACCESS-ESM1-5", "ssp370", CSIRO_member("ssp370", 3), variable="ty_trans_gm", decade=2090),
+])
+def test_output_path_round_trip(key):
+    path = output_path(key, "/data")
+    assert parse_output_path(path, "/data") == key
+    assert os.path.dirname(path) == output_dir(key, "/data")
+
+
+def test_labels():
+    assert CSIRO_member("historical", 1) == "HI-05" and CSIRO_member("ssp370", 3) == "SSP-370-07"
+    assert parse_CSIRO_member(CSIRO_member("ssp370", 3)) == 3
+    assert CMIP6_member(2) == "r2i1p1f1"
+    # the 2010s archive is 2010-2014 for historical and 2015-2019 for scenarios
+    assert list(decade_years(2010, "historical")) == [2010, 2011, 2012, 2013, 2014]
+    assert list(decade_years(2010, "ssp370")) == [2015, 2016, 2017, 2018, 2019]
+    assert list(decade_years(1990, "historical")) == list(range(1990, 2000))
+    assert parse_window(window_string(1990, 10)) == (1990, 10)
+    # unknown products and missing fields are errors
+    with pytest.raises(ValueError):
+        output_path(OutputKey("timeseries", "ACCESS-ESM1-5"))
+    with pytest.raises(ValueError):
+        output_path(OutputKey("cyclo", "ACCESS-ESM1-5", "historical"))
+
+
+def test_index_cache_invalidation(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMIP_CACHE_DIR", str(tmp_path / "cache"))
+    root = str(tmp_path / "data")
+    keys = [OutputKey("average", "ACCESS-ESM1-5", "historical", member, "Jan1990-Dec1999", variable="umo")
+            for member in ["r1i1p1f1", "r2i1p1f1"]]
+    for key in keys:
+        os.makedirs(output_dir(key, root))
+    open(output_path(keys[0], root), "w").close()
+    assert index_outputs(root) == {keys[0]: output_path(keys[0], root)}
+    # the cached index is reused while no walked directory has changed...
+    directory = output_dir(keys[1], root)
+    mtime = os.stat(directory).st_mtime
+    open(output_path(keys[1], root), "w").close()
+    os.utime(directory, (mtime, mtime))
+    assert list(index_outputs(root)) == keys[:1]
+    # ...and rebuilt when one has
+    os.utime(directory, (mtime + 1, mtime + 1))
+    assert sorted(index_outputs(root)) == keys
+    # (also when a walked directory is removed)
+    os.remove(output_path(keys[1], root))
+    os.rmdir(directory)
+    assert list(index_outputs(root)) == keys[:1]
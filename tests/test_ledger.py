@@ -0,0 +1,65 @@
+"""
+Tests of `tmip.ledger`.
+"""
+
+# Import os for utime
+import os
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.ledger import task_key, input_fingerprint, load_ledger, needs_build, record_status
+
+
+def build(tmp_path, fingerprint):
+    """
+    return the (ledger, output, key) of a task that was built and recorded "done" with `fingerprint`
+    """
+    ledgerpath = str(tmp_path / "ledger.jsonl")
+    output = str(tmp_path / "umo.nc")
+    key = task_key(model="ACCESS-ESM1-5", member="r1i1p1f1", variable="umo")
+    ledger = load_ledger(ledgerpath)
+    assert needs_build(ledger, output, key, fingerprint)
+    with open(output, "w") as f:
+        f.write("built")
+    record_status(ledger, output, "done")
+    return ledgerpath, output, key
+
+
+def test_resume_done(tmp_path):
+    inputfile = tmp_path / "input.nc"
+    inputfile.write_text("input")
+    fingerprint = input_fingerprint([str(inputfile)], lumpby="month")
+    ledgerpath, output, key = build(tmp_path, fingerprint)
+    # a restarted job skips it
+    assert not needs_build(load_ledger(ledgerpath), output, key, fingerprint)
+    # unless the inputs (or parameters) changed
+    os.utime(inputfile, (0, 0))
+    assert input_fingerprint([str(inputfile)], lumpby="month") != fingerprint
+    assert input_fingerprint([str(inputfile)], lumpby="season") != fingerprint
+    assert needs_build(load_ledger(ledgerpath), output, key, input_fingerprint([str(inputfile)], lumpby="month"))
+
+
+def test_resume_missing_output(tmp_path):
+    ledgerpath, output, key = build(tmp_path, "abc")
+    os.remove(output)
+    assert needs_build(load_ledger(ledgerpath), output, key, "abc")
+
+
+def test_resume_failed(tmp_path):
+    ledgerpath = str(tmp_path / "ledger.jsonl")
+    ledger = load_ledger(ledgerpath)
+    assert needs_build(ledger, "out.nc", "k", "abc")
+    record_status(ledger, "out.nc", "failed")
+    assert needs_build(load_ledger(ledgerpath), "out.nc", "k", "abc")
+    # no-op for outputs that are not pending, and without ledger
+    record_status(ledger, "other.nc", "done")
+    assert needs_build(None, "out.nc", "k", "abc")
+
+
+def test_truncated_last_line(tmp_path):
+    ledgerpath, output, key = build(tmp_path, "abc")
+    # a job killed while appending a record
+    with open(ledgerpath, "a") as f:
+        f.write('{"key": ' + '"' + key.replace('"', '\\"') + '", "status": "pen')
+    ledger = load_ledger(ledgerpath)
+    assert len(ledger["records"]) == 1 and ledger["records"][key]["status"] == "done"
+    assert not needs_build(ledger, output, key, "abc")
@@ -0,0 +1,44 @@
+"""
+Tests of `tmip.output`.
+"""
+
+# Import os for paths
+import os
+
+# Import xarray
+import xarray as xr
+
+# Load pytest
+import pytest
+
+# Load the shared test fixtures (see conftest.py)
+from conftest import monthly_field
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.output import partial_path, zarr_path, save_output, output_exists, open_output, open_outputs
+
+
+def test_save_output_zarr_consolidated(tmp_path):
+    import zarr
+    da = monthly_field().chunk(time=12).rename("mld")
+    path = str(tmp_path / "mld.nc")
+    save_output(da, path, "derived", backend="zarr", consolidate_to_netcdf=True)
+    # compressed like the NetCDF profile, and consolidated without leaving partial outputs
+    assert "zlib" in str(zarr.open_array(f'{zarr_path(path)}/mld').compressors)
+    assert not os.path.exists(partial_path(path)) and not os.path.exists(zarr_path(partial_path(path)))
+    xr.testing.assert_allclose(xr.open_dataset(path)["mld"].load(), da.load())
+
+
+@pytest.mark.parametrize("backend", ["netcdf", "zarr"])
+def test_open_outputs(tmp_path, monkeypatch, backend):
+    monkeypatch.setenv("TMIP_OUTPUT_BACKEND", backend)
+    da = monthly_field(years=2)
+    paths = []
+    for year, yearly in da.groupby("time.year"):
+        paths.append(str(tmp_path / f"thetao_{year}.nc"))
+        save_output(yearly.to_dataset(), paths[-1], "derived")
+    # read back from whichever backend wrote them (without consolidation for zarr)
+    assert all(output_exists(path) for path in paths)
+    assert os.path.isfile(paths[0]) == (backend == "netcdf")
+    xr.testing.assert_allclose(open_outputs(paths, chunks={'time':-1})["thetao"].load(), da)
+    xr.testing.assert_allclose(open_output(paths[0])["thetao"].load(), da.isel(time=slice(0, 12)))
@@ -0,0 +1,63 @@
+"""
+Tests of `tmip.overturning`.
+"""
+
+# Import numpy/xarray
+import numpy as np
+import xarray as xr
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.overturning import basin_masks, overturning_streamfunction
+
+
+def transport(seed=0):
+    """
+    return a random (time, potrho, grid_yu_ocean, grid_xt_ocean) transport, chunked like the 0.1° files, with land NaNs
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(size=(2, 5, 4, 6))
+    data[:, :, 0, :2] = np.nan
+    return xr.DataArray(
+        data,
+        dims=("time", "potrho", "grid_yu_ocean", "grid_xt_ocean"),
+        coords=dict(potrho=np.linspace(1028, 1032, 5), grid_yu_ocean=np.arange(4.0), grid_xt_ocean=np.arange(6.0)),
+        name="ty_trans_rho",
+    ).chunk({"time": 1, "potrho": 2, "grid_yu_ocean": 2, "grid_xt_ocean": -1})
+
+
+def write_masks(path):
+    """
+    write (tracer-grid) masks that partition the grid into the default basins
+    """
+    atlantic = np.zeros((4, 6))
+    atlantic[1:, :3] = 1
+    indopacific = np.zeros((4, 6))
+    indopacific[1:, 3:] = 1
+    southern = np.zeros((4, 6))
+    southern[0, :] = 1
+    dims = ("yt_ocean", "xt_ocean")
+    xr.Dataset(dict(atlantic=(dims, atlantic), indopacific=(dims, indopacific), southern=(dims, southern))).to_netcdf(path)
+
+
+def test_overturning_streamfunction():
+    trans = transport()
+    psi = overturning_streamfunction(trans)
+    # same as the baseline formula, zero at the densest layer
+    lonsum = trans.sum("grid_xt_ocean")
+    expected = lonsum.cumsum("potrho") - lonsum.sum("potrho")
+    xr.testing.assert_allclose(psi.compute(), expected.compute())
+    assert (psi.isel(potrho=-1) == 0).all()
+
+
+def test_basin_streamfunctions(tmp_path):
+    write_masks(tmp_path / "basins.nc")
+    trans = transport()
+    masks = basin_masks(tmp_path / "basins.nc", trans)
+    assert list(masks.basin.values) == ["global", "atlantic", "indopacific", "southern"]
+    psi = overturning_streamfunction(trans, masks).compute()
+    assert psi.dims == trans.dims[:-1] + ("basin",)
+    # the global streamfunction is the one without masks, and the basins partition it
+    xr.testing.assert_allclose(psi.sel(basin="global", drop=True), overturning_streamfunction(trans).compute())
+    xr.testing.assert_allclose(psi.sel(basin="global", drop=True), psi.drop_sel(basin="global").sum("basin"))
+    # the masks file is closed (and can be overwritten)
+    write_masks(tmp_path / "basins.nc")
@@ -0,0 +1,70 @@
+"""
+Tests of `tmip.references`.
+"""
+
+# Import os for utime
+import os
+
+# Import numpy/xarray
+import numpy as np
+import xarray as xr
+
+# Load pytest
+import pytest
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.references import references_dir, history_references, open_history
+
+# (kerchunk and h5py are only needed by these helpers)
+pytest.importorskip("kerchunk")
+pytest.importorskip("h5py")
+
+
+def write_history(inputdir, years):
+    """
+    write toy yearly `ocean_month.nc-{year}1231` history files (monthly `temp`, static `area_t`) in `inputdir`
+    """
+    rng = np.random.default_rng(0)
+    for year in years:
+        time = xr.date_range(f'{year}-01-16', periods=12, freq="MS", calendar="noleap", use_cftime=True)
+        ds = xr.Dataset(
+            dict(
+                temp=(("time", "yt_ocean", "xt_ocean"), rng.normal(size=(12, 3, 4)).astype("float32")),
+                area_t=(("yt_ocean", "xt_ocean"), np.ones((3, 4))),
+            ),
+            coords=dict(time=time, yt_ocean=np.arange(3.0), xt_ocean=np.arange(4.0)),
+        )
+        # (each file has its own time units, like the raw history)
+        ds.time.encoding["units"] = f'days since {year}-01-01'
+        ds.to_netcdf(inputdir / f'ocean_month.nc-{year}1231', format="NETCDF4", unlimited_dims=["time"])
+
+
+def test_open_history(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMIP_CACHE_DIR", str(tmp_path / "cache"))
+    inputdir = tmp_path / "history"
+    inputdir.mkdir()
+    write_history(inputdir, [1990, 1991, 1992])
+    ds = open_history(str(inputdir), keep_variables=["temp"])
+    # same as opening all the files
+    paths = sorted(str(p) for p in inputdir.iterdir())
+    with xr.open_mfdataset(paths, combine="nested", concat_dim="time", data_vars="minimal", coords="minimal",
+                           compat="override") as expected:
+        xr.testing.assert_allclose(ds.temp.load(), expected.temp.load())
+    assert len(os.listdir(references_dir())) == 3 + 1
+
+
+def test_history_references_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMIP_CACHE_DIR", str(tmp_path / "cache"))
+    inputdir = tmp_path / "history"
+    inputdir.mkdir()
+    write_history(inputdir, [1990, 1991])
+    refs = history_references(str(inputdir))
+    assert history_references(str(inputdir)) == refs
+    # a modified file is scanned again (and only it)
+    path = inputdir / "ocean_month.nc-19911231"
+    mtime = os.path.getmtime(path)
+    os.utime(path, (mtime + 1, mtime + 1))
+    history_references(str(inputdir))
+    assert len(os.listdir(references_dir())) == 2 + 1 + 2
+    with pytest.raises(ValueError):
+        history_references(str(tmp_path))
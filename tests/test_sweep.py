@@ -0,0 +1,101 @@
+"""
+Tests of `tmip.sweep` (run locally, with the "local" backend).
+"""
+
+# Load pytest
+import pytest
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.sweep import (
+    JOB_DEFAULTS, load_sweep, expand_runs, pack_jobs, size_job, plan_jobs, job_script, submit_jobs,
+)
+
+
+def test_expand_runs():
+    sweep = dict(
+        name="MOC",
+        script="scripts/MOC.py",
+        args=["{subcatalog}", "{window}"],
+        inputs="/data/{subcatalog}/*.nc",
+        matrix=dict(subcatalog=["a", "b"], window=["1990", "2000"]),
+    )
+    runs = expand_runs(sweep)
+    # one run per combination of the matrix, in order
+    assert [run["args"] for run in runs] == [["a", "1990"], ["a", "2000"], ["b", "1990"], ["b", "2000"]]
+    assert runs[1]["label"] == "MOC.a.2000"
+    assert runs[2]["inputs"] == "/data/b/*.nc"
+    # no matrix: a single run, without inputs
+    run, = expand_runs(dict(name="JRA", script="scripts/JRA.py"))
+    assert run["args"] == [] and run["inputs"] is None and run["label"] == "JRA"
+
+
+def test_pack_jobs():
+    runs = [dict(label=str(i), bytes=b) for i, b in enumerate([60, 50, 40, 30, 20, 250])]
+    jobs = pack_jobs(runs, max_job_bytes=100)
+    # every run in one job, jobs within max_job_bytes (except a larger run on its own)
+    assert sorted(run["label"] for job in jobs for run in job["runs"]) == [str(i) for i in range(6)]
+    for job in jobs:
+        assert job["bytes"] == sum(run["bytes"] for run in job["runs"])
+        assert job["bytes"] <= 100 or len(job["runs"]) == 1
+    # (first-fit decreasing: 250 | 60 + 40 | 50 + 30 + 20)
+    assert len(jobs) == 3
+    # and at most max_runs runs per job
+    assert all(len(job["runs"]) <= 1 for job in pack_jobs(runs, 1000, max_runs=1))
+
+
+@pytest.mark.parametrize("largest, queue, ncpus, mem", [
+    (1e9, "normal", 4, "16GB"),         # min_mem_gb
+    (100e9, "normal", 13, "52GB"),
+    (1000e9, "hugemem", 17, "520GB"),
+    (10000e9, "hugemem", 48, "1470GB"),  # at most a full hugemem node
+])
+def test_size_job(largest, queue, ncpus, mem):
+    settings = dict(JOB_DEFAULTS, mem_per_input_byte=0.5, walltime="01:30:00")
+    job = dict(runs=[dict(bytes=largest), dict(bytes=largest / 2)], bytes=1.5 * largest)
+    size_job(job, settings)
+    assert (job["queue"], job["ncpus"], job["mem"]) == (queue, ncpus, mem)
+    # runs of a job are sequential
+    assert job["walltime"] == "03:00:00"
+
+
+def test_plan_jobs_max_walltime():
+    settings = dict(JOB_DEFAULTS, walltime="05:00:00", max_walltime="12:00:00", max_job_bytes=1e15)
+    sweep = dict(name="s", script="s.py", args=["{x}"], matrix=dict(x=list(range(5))))
+    jobs = plan_jobs(settings, [sweep])
+    # at most 2 runs of 5 hours per 12-hour job
+    assert [len(job["runs"]) for job in jobs] == [2, 2, 1]
+    assert max(job["walltime"] for job in jobs) == "10:00:00"
+
+
+def test_submit_local(tmp_path, monkeypatch):
+    script = tmp_path / "write_args.py"
+    script.write_text(
+        "import os, sys\n"
+        "with open(f'ran.{sys.argv[1]}.txt', 'w') as f:\n"
+        "    f.write(os.environ['PBS_NCPUS'] + ' ' + os.environ['PBS_JOBID'])\n"
+    )
+    sweepfile = tmp_path / "toy.toml"
+    sweepfile.write_text(
+        "[job]\n"
+        f'workdir = "{tmp_path}"\n'
+        "default_input_bytes = 1e9\n"
+        "\n"
+        "[[sweep]]\n"
+        'name = "toy"\n'
+        f'script = "{script}"\n'
+        'args = ["{member}"]\n'
+        "[sweep.matrix]\n"
+        'member = ["r1", "r2", "r3"]\n'
+    )
+    settings, sweeps = load_sweep(str(sweepfile))
+    jobs = plan_jobs(settings, sweeps)
+    # small runs are packed into a single job
+    assert len(jobs) == 1 and len(jobs[0]["runs"]) == 3
+    assert "#PBS -q normal" in job_script(jobs[0], settings)
+    assert submit_jobs(jobs, settings, backend="local") == ["local"]
+    # every run ran in the work directory, with the resources of the job
+    for member in ["r1", "r2", "r3"]:
+        assert (tmp_path / f"ran.{member}.txt").read_text() == f'{jobs[0]["ncpus"]} local'
+        assert (tmp_path / "output" / f"toy.{member}.local.out").is_file()
+    with pytest.raises(ValueError):
+        submit_jobs(jobs, settings, backend="slurm")
@@ -0,0 +1,12 @@
+"""
+Tests of `tmip.timewindow`.
+"""
+
+# Load shared TMIP helpers (see scripts/tmip)
+from tmip.timewindow import time_window_strings
+
+
+def test_time_window_strings():
+    assert time_window_strings(1990, 10) == ("1990", "1999")
+    # zero-padded so that slicing cftime axes works
+    assert time_window_strings(200, 1) == ("0200", "0200")